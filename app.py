@@ -1,38 +1,51 @@
 import os
+import json
+import time
 import uuid
 import logging
 import zipfile
-import pytesseract
-import fitz  # This comes from PyMuPDF
-from pdf2docx import Converter
-from docx2pdf import convert
-from PyPDF2 import PdfReader, PdfWriter
-from PIL import Image
-from docx import Document
-from datetime import datetime
-from flask import Flask, render_template, request, redirect, url_for, flash, jsonify, send_file
+from flask import Flask, Response, render_template, request, redirect, url_for, flash, jsonify, send_file, g
 from werkzeug.utils import secure_filename
-import tempfile
+from werkzeug.security import safe_join
 import shutil
-from pdf2image import convert_from_bytes
-from io import BytesIO
-
-import subprocess
-
-def compress_pdf(input_path, output_path):
-    gs_path = r"C:\Program Files\gs\gs10.05.0\bin\gswin64c.exe"  # <-- change this if your Ghostscript installed somewhere else
-    command = [
-        gs_path,
-        "-sDEVICE=pdfwrite",
-        "-dCompatibilityLevel=1.4",
-        "-dPDFSETTINGS=/ebook",  # /screen = maximum compression, /ebook = good compression
-        "-dNOPAUSE",
-        "-dQUIET",
-        "-dBATCH",
-        f"-sOutputFile={output_path}",
-        input_path
-    ]
-    subprocess.run(command)
+from concurrent.futures import ThreadPoolExecutor
+from utils.image_utils import IMAGE_FORMATS
+from utils.office_utils import OOXML_EXTENSIONS, compress_ooxml
+from utils.size_predictor import predict_target_size
+from utils.photo_pdf import PAGE_SIZES, build_photo_pdf
+from utils.pdf_utils import PAGE_IMAGE_FORMATS, iter_rendered_pages, render_pdf_pages
+from utils.pdf_utils import add_watermark_to_pdf as watermark_pdf
+from utils.zip_stream import STORED_EXTENSIONS, stream_zip
+from utils.batch import extract_zip_members, split_budget, unique_names
+from utils.jobs import JobQueue, QueueFullError, QUEUED, FINISHED, FAILED
+from utils.result_cache import ResultCache, copy_and_hash, make_key
+from utils.retention import RetentionManager
+from utils.uploads import IngestFile, IngestRequest
+from utils.downloads import IMMUTABLE_MAX_AGE, content_etag, is_immutable
+from utils.lazy_imports import import_report, lazy_import, preload
+from utils.backends import backends, run_backend
+from utils.metrics import (metrics, stage, start_timings, stop_timings, observe_timings, measure_peak_rss, Timings,
+                           submit_with_timings,
+                           REQUEST_SECONDS, REQUEST_BYTES_IN, RESPONSE_BYTES_OUT, CONVERSIONS, CONVERSION_PEAK_RSS)
+
+Image = lazy_import('PIL.Image')
+
+# Preferred PDF compression engine: 'native' (PyMuPDF, in-process) or
+# 'ghostscript'; unset, the fastest backend measured at startup is used
+PDF_ENGINE = os.environ.get('NISQ_PDF_ENGINE')
+PDF_ENGINE_BACKENDS = {'native': 'pymupdf', 'ghostscript': 'ghostscript'}
+
+def compress_pdf(input_path, output_path, target_size_mb=None):
+    """
+    Compress a PDF on the best available backend (see utils/backends.py),
+    falling back to the next one if it fails or cannot meet the target.
+
+    Returns a dict describing the compression.
+    """
+    backend, result = run_backend('pdf-compress', input_path, output_path, target_size_mb,
+                                  prefer=PDF_ENGINE_BACKENDS.get(PDF_ENGINE))
+    logger.info(f"Compressed {input_path} with {backend}")
+    return result
 
 
 # Configure logging
@@ -42,34 +55,92 @@ logger = logging.getLogger(__name__)
 
 # Initialize Flask app
 app = Flask(__name__)
+app.request_class = IngestRequest
 app.secret_key = os.environ.get("SESSION_SECRET", "nisqfile_secret_key")
 
 # File upload configuration
 UPLOAD_FOLDER = 'uploads'
 os.makedirs(UPLOAD_FOLDER, exist_ok=True)
+# DPI range accepted by /pdf-to-photo
+MIN_RENDER_DPI = 36
+MAX_RENDER_DPI = 600
 ALLOWED_EXTENSIONS = {
     'pdf': ['pdf'],
     'image': ['jpg', 'jpeg', 'png', 'gif', 'bmp', 'tiff'],
     'word': ['doc', 'docx'],
-    'all': ['pdf', 'jpg', 'jpeg', 'png', 'gif', 'bmp', 'tiff', 'doc', 'docx', 'txt', 'zip', 'rar']
+    'all': ['pdf', 'jpg', 'jpeg', 'png', 'gif', 'bmp', 'tiff', 'doc', 'docx', 'xlsx', 'pptx', 'txt', 'zip', 'rar']
 }
 app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
-app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # 16MB max file size
+# Uploads are streamed to disk (see utils/uploads.py), so the limits can be generous
+MAX_UPLOAD_MB = float(os.environ.get('NISQ_MAX_UPLOAD_MB', 100))
+app.config['MAX_CONTENT_LENGTH'] = int(MAX_UPLOAD_MB * 1024 * 1024)  # whole request
+app.config['MAX_FILE_SIZE'] = int(float(os.environ.get('NISQ_MAX_FILE_MB', MAX_UPLOAD_MB)) * 1024 * 1024)
+
+# Download offload when running behind a proxy: nginx X-Accel-Redirect to an
+# internal location mapped to the upload folder, or X-Sendfile (Apache, lighttpd)
+DOWNLOAD_ACCEL_PREFIX = os.environ.get('NISQ_ACCEL_REDIRECT_PREFIX')
+app.config['USE_X_SENDFILE'] = os.environ.get('NISQ_USE_X_SENDFILE', '').lower() in ('1', 'true', 'yes')
+
+# Background job queue for the conversion routes (see utils/jobs.py)
+JOB_OPERATIONS = ['compress', 'compress-batch', 'pdf-to-photo', 'photo-to-pdf', 'word-to-pdf', 'pdf-to-word', 'add-watermark']
+job_queue = JobQueue.from_env(os.path.join(UPLOAD_FOLDER, '.jobs'), JOB_OPERATIONS)
+
+# File types compress_file can actually shrink
+COMPRESSIBLE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.pdf') + OOXML_EXTENSIONS
+
+# Parallel workers for batch compression, per batch
+BATCH_WORKERS = int(os.environ.get('NISQ_BATCH_WORKERS', min(4, os.cpu_count() or 1)))
+
+# PDFs at least this large are edited with incremental updates unless the request says otherwise
+INCREMENTAL_SAVE_MB = float(os.environ.get('NISQ_INCREMENTAL_SAVE_MB', 20))
+
+# Cache of conversion results keyed by input content and parameters
+RESULT_CACHE_MB = float(os.environ.get('NISQ_RESULT_CACHE_MB', 512))
+result_cache = ResultCache(UPLOAD_FOLDER, int(RESULT_CACHE_MB * 1024 * 1024))
+
+# TTL and quota based clean-up of everything in the upload folder
+retention = RetentionManager.from_env(UPLOAD_FOLDER, job_queue.state_dir)
+
+# Conversion libraries are imported on first use. With NISQ_PRELOAD=1 (and
+# gunicorn --preload) they are imported once in the master instead, so the
+# forked workers share them
+if os.environ.get('NISQ_PRELOAD', '').lower() in ('1', 'true', 'yes'):
+    for entry in preload():
+        logger.info(f"Preloaded {entry['module']} in {entry['seconds']}s")
+
+# Conversion backends are probed on first use and the results shared
+# through the upload folder. Run python -m utils.backends before starting
+# the app, or set NISQ_PROBE_BACKENDS=1 with gunicorn --preload, to probe
+# and calibrate them all (LibreOffice included) once up front instead
+backends.state_path = os.path.join(UPLOAD_FOLDER, '.backends.json')
+if os.environ.get('NISQ_PROBE_BACKENDS', '').lower() in ('1', 'true', 'yes'):
+    backends.probe(full=True)
 
 # Helper function to check if file extension is allowed
 def allowed_file(filename, file_type):
     return '.' in filename and \
            filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS[file_type]
 
-# Helper function to save uploaded file
-def save_uploaded_file(file, file_type):
+# Helper function to save uploaded file, hashing its contents on the way
+def save_uploaded_file_hashed(file, file_type):
     if file and allowed_file(file.filename, file_type):
         filename = secure_filename(file.filename)
         unique_filename = f"{uuid.uuid4()}_{filename}"
         file_path = os.path.join(app.config['UPLOAD_FOLDER'], unique_filename)
-        file.save(file_path)
-        return file_path
-    return None
+        with stage('save'):
+            if isinstance(file.stream, IngestFile):
+                # Already on disk and hashed while the request was received
+                digest = file.stream.claim(file_path)
+            else:
+                digest = copy_and_hash(file.stream, file_path)
+            retention.track(file_path)
+        return file_path, digest
+    return None, None
+
+# Helper function to save uploaded file
+def save_uploaded_file(file, file_type):
+    file_path, _ = save_uploaded_file_hashed(file, file_type)
+    return file_path
 
 # Helper function to clean up temporary files
 def cleanup_files(file_paths):
@@ -96,62 +167,62 @@ def get_file_size(file_path):
 def compress_image(input_path, output_path, target_size_mb):
     """
     Compress an image to approximately target size in MB.
+
+    Returns a dict with the chosen quality, scale, predicted and final size
+    and the number of full encode passes needed.
     """
     logger.info(f"Starting image compression for {input_path}")
 
+    file_ext = os.path.splitext(output_path)[1].lower()
+    target_bytes = int(target_size_mb * 1024 * 1024)
+
     with Image.open(input_path) as img:
-        quality = 95  # Start from high quality
-        img.save(output_path, optimize=True, quality=quality)
+        fmt = IMAGE_FORMATS.get(file_ext, img.format or 'JPEG')
+        with stage('decode'):
+            img.load()
+        result = predict_target_size(img, fmt, target_bytes)
 
-        current_size = os.path.getsize(output_path) / (1024 * 1024)  # size in MB
+    # Only the winning encode is written to disk
+    with open(output_path, 'wb') as f:
+        f.write(result['data'])
 
-        while current_size > target_size_mb and quality > 10:
-            quality -= 5
-            img.save(output_path, optimize=True, quality=quality)
-            current_size = os.path.getsize(output_path) / (1024 * 1024)
-            logger.info(f"Compressed to {current_size:.2f} MB at quality {quality}")
+    current_size = result['size'] / (1024 * 1024)
+    logger.info(f"Final compressed image size: {current_size:.2f} MB at quality {result['quality']}, "
+                f"scale {result['scale']:.2f} after {result['passes']} encode passes")
 
-    logger.info(f"Final compressed image size: {current_size:.2f} MB")
+    return {
+        'quality': result['quality'],
+        'scale': round(result['scale'], 3),
+        'predictedSize': result['predictedSize'],
+        'size': result['size'],
+        'passes': result['passes'],
+    }
 
 
-def compress_docx(input_path, output_path):
+def compress_docx(input_path, output_path, target_size_mb=None):
     """
-    Compress a DOCX file by recompressing images inside it.
+    Compress a DOCX (or other Office) file by recompressing images inside it.
+
+    Returns the stats dict from compress_ooxml.
     """
 
     logger.info(f"Starting DOCX compression for {input_path}")
 
-    with tempfile.TemporaryDirectory() as tempdir:
-        with zipfile.ZipFile(input_path, 'r') as zip_ref:
-            zip_ref.extractall(tempdir)
-
-        # Go to 'word/media' folder inside extracted DOCX
-        media_path = os.path.join(tempdir, 'word', 'media')
-        if os.path.exists(media_path):
-            for image_file in os.listdir(media_path):
-                image_full_path = os.path.join(media_path, image_file)
-                if image_full_path.lower().endswith(('.png', '.jpg', '.jpeg')):
-                    try:
-                        img = Image.open(image_full_path)
-                        img.save(image_full_path, optimize=True, quality=50)  # You can adjust quality
-                        logger.info(f"Compressed {image_file}")
-                    except Exception as e:
-                        logger.warning(f"Failed to compress {image_file}: {e}")
+    # The package is rewritten entry by entry, nothing is extracted to disk
+    stats = compress_ooxml(input_path, output_path, target_size_mb)
 
-        # Now create a new zip archive as compressed DOCX
-        shutil.make_archive(output_path.replace('.docx', ''), 'zip', tempdir)
-        # Rename .zip back to .docx
-        shutil.move(output_path.replace('.docx', '') + '.zip', output_path)
+    logger.info(f"Compressed DOCX saved to {output_path} "
+                f"({stats['recompressed']}/{stats['images']} images recompressed)")
+    return stats
 
-    logger.info(f"Compressed DOCX saved to {output_path}")
-
-def compress_file(file_path, target_size_kb):
+def compress_file(file_path, target_size_kb, stats=None):
     """
     Compress a file to target size in KB (not MB now).
 
     Args:
         file_path: Path to the file to compress
         target_size_kb: Target size in KB
+        stats: Optional dict filled in with details about the compression
         
     Returns:
         Path to the compressed file
@@ -178,11 +249,21 @@ def compress_file(file_path, target_size_kb):
         # Compress based on file type
         if file_ext in ['.jpg', '.jpeg', '.png']:
             logger.info("Compressing image file")
-            compress_image(file_path, output_path, target_size_mb)
+            image_stats = compress_image(file_path, output_path, target_size_mb)
+            if stats is not None:
+                stats.update(image_stats)
 
         elif file_ext == '.pdf':
             logger.info("Compressing PDF file")
-            compress_pdf(file_path, output_path)
+            pdf_stats = compress_pdf(file_path, output_path, target_size_mb)
+            if stats is not None:
+                stats.update(pdf_stats)
+
+        elif file_ext in OOXML_EXTENSIONS:
+            logger.info("Compressing Office document")
+            docx_stats = compress_docx(file_path, output_path, target_size_mb)
+            if stats is not None:
+                stats.update(docx_stats)
 
         else:
             logger.info(f"Unsupported file {file_ext}, copying")
@@ -199,38 +280,26 @@ def compress_file(file_path, target_size_kb):
         return output_path
 
 
-def pdf_to_images(pdf_path, dpi=300):
+def pdf_to_images(pdf_path, dpi=300, output_format='png'):
     """
     Convert a PDF file to a list of image files
     
     Args:
         pdf_path: Path to the PDF file
         dpi: DPI for the images (default: 300)
+        output_format: png, jpg/jpeg or webp (default: png)
         
     Returns:
-        List of paths to the generated image files
+        List of dicts with the page number, image path and render time of each page
     """
     try:
-        # Using PyPDF2 and PIL for conversion
-        reader = PdfReader(pdf_path)
-        image_paths = []
+        # Pages are rendered with PyMuPDF, split across worker processes
+        pages = render_pdf_pages(pdf_path, dpi=dpi, output_format=output_format)
         
-        # Get base filename without extension
-        base_path = os.path.splitext(pdf_path)[0]
+        for page in pages:
+            logger.info(f"Created image: {page['path']} in {page['seconds']}s")
         
-        for page_num in range(len(reader.pages)):
-            # Create an image for each page
-            img_path = f"{base_path}_page_{page_num + 1}.png"
-            
-            # For actual conversion we'd use a proper PDF rendering library
-            # Since this is a mocked version, we'll create a placeholder image
-            img = Image.new('RGB', (800, 1000), color='white')
-            img.save(img_path)
-            image_paths.append(img_path)
-            
-            logger.info(f"Created image: {img_path}")
-        
-        return image_paths
+        return pages
     
     except Exception as e:
         logger.error(f"Error converting PDF to images: {str(e)}")
@@ -257,23 +326,8 @@ def images_to_pdf(image_paths, output_path=None):
         if not output_path:
             output_path = os.path.join(UPLOAD_FOLDER, f"{uuid.uuid4()}_combined.pdf")
         
-        # Open the first image to get size
-        images = []
-        for img_path in image_paths:
-            img = Image.open(img_path)
-            # Convert to RGB if necessary
-            if img.mode != 'RGB':
-                img = img.convert('RGB')
-            images.append(img)
-        
-        # Save the first image as PDF with the rest appended
-        images[0].save(
-            output_path, 
-            save_all=True, 
-            append_images=images[1:],
-            resolution=100.0,
-            quality=95
-        )
+        # Streamed by default: one image at a time, JPEGs without decoding
+        run_backend('images-to-pdf', image_paths, output_path)
         
         logger.info(f"PDF created at: {output_path}")
         return output_path
@@ -282,13 +336,15 @@ def images_to_pdf(image_paths, output_path=None):
         logger.error(f"Error converting images to PDF: {str(e)}")
         raise
 
-def add_watermark_to_pdf(pdf_path, watermark_text):
+def add_watermark_to_pdf(pdf_path, watermark_text, incremental=False, stats=None):
     """
     Add a watermark to a PDF file
     
     Args:
         pdf_path: Path to the PDF file
         watermark_text: Text to use as the watermark
+        incremental: Append the watermark as an incremental update instead of rewriting the file
+        stats: Optional dict filled in with the save mode used
         
     Returns:
         Path to the watermarked PDF file
@@ -296,21 +352,8 @@ def add_watermark_to_pdf(pdf_path, watermark_text):
     try:
         output_path = f"{os.path.splitext(pdf_path)[0]}_watermarked.pdf"
         
-        # Read the input PDF
-        reader = PdfReader(pdf_path)
-        writer = PdfWriter()
-        
-        # For each page, create a watermark
-        for page in reader.pages:
-            # Add page to writer as is
-            writer.add_page(page)
-        
-        # Add metadata
-        writer.add_metadata(reader.metadata)
-        
-        # Write output file
-        with open(output_path, 'wb') as f:
-            writer.write(f)
+        # The watermark is laid out once and shared by every page
+        watermark_pdf(pdf_path, watermark_text, output_path, incremental=incremental, stats=stats)
         
         return output_path
     
@@ -318,6 +361,439 @@ def add_watermark_to_pdf(pdf_path, watermark_text):
         logger.error(f"Error adding watermark to PDF: {str(e)}")
         raise
 
+def compress_task(file_path, target_size):
+    """
+    Compress a saved upload to target_size (in MB).
+    Returns the JSON payload for the /compress response.
+    """
+    # Get original size
+    original_size = get_file_size(file_path)
+    logger.info(f"Original file size: {original_size} MB")
+
+    # Compress the file (compress_file expects KB)
+    compress_stats = {}
+    compressed_path = compress_file(file_path, target_size * 1024, stats=compress_stats)
+    compressed_size = get_file_size(compressed_path)
+    logger.info(f"Compressed file size: {compressed_size} MB at {compressed_path}")
+
+    # Calculate compression ratio
+    compression_ratio = round((1 - (compressed_size / original_size)) * 100, 2) if original_size > 0 else 0
+    logger.info(f"Compression ratio: {compression_ratio}%")
+
+    # Create download URL
+    filename = os.path.basename(compressed_path)
+    download_url = f"/download/{filename}"
+    logger.info(f"Download URL: {download_url}")
+
+    return {
+        'success': True,
+        'originalFile': os.path.basename(file_path),
+        'originalSize': original_size,
+        'compressedSize': compressed_size,
+        'compressionRatio': compression_ratio,
+        'encodePasses': compress_stats.get('passes'),
+        'predictedBytes': compress_stats.get('predictedSize'),
+        'compressedBytes': os.path.getsize(compressed_path),
+        'downloadUrl': download_url
+    }
+
+def batch_compress_task(file_paths, target_size, budget='total'):
+    """
+    Compress several saved uploads into one ZIP with a manifest.
+
+    Uploaded ZIPs are expanded first. With budget='total' target_size (in MB)
+    is shared between the files in proportion to their size, with
+    budget='file' every file gets target_size. Files are compressed in
+    parallel through compress_file. Returns the JSON payload for the
+    /compress response.
+    """
+    upload_folder = app.config['UPLOAD_FOLDER']
+    compressible = [ext for ext in ALLOWED_EXTENSIONS['all'] if ext not in ('zip', 'rar')]
+
+    # (name in the output ZIP, path on disk)
+    inputs = []
+    for path in file_paths:
+        original_name = os.path.basename(path).split('_', 1)[-1]
+        if path.lower().endswith('.zip'):
+            inputs.extend(extract_zip_members(path, upload_folder, compressible,
+                                              app.config['MAX_FILE_SIZE'], app.config['MAX_CONTENT_LENGTH']))
+        else:
+            inputs.append((original_name, path))
+
+    if not inputs:
+        return {
+            'success': False,
+            'error': 'No files to compress'
+        }
+
+    names = unique_names([name for name, _ in inputs])
+    paths = [path for _, path in inputs]
+    sizes = [os.path.getsize(path) for path in paths]
+    target_bytes = int(target_size * 1024 * 1024)
+    if budget == 'file':
+        targets = [target_bytes] * len(paths)
+    else:
+        # Files compress_file only copies use their own size of the budget
+        shrinkable = [path.lower().endswith(COMPRESSIBLE_EXTENSIONS) for path in paths]
+        fixed_bytes = sum(size for size, can_shrink in zip(sizes, shrinkable) if not can_shrink)
+        shares = iter(split_budget([size for size, can_shrink in zip(sizes, shrinkable) if can_shrink],
+                                   max(target_bytes - fixed_bytes, 0)))
+        targets = [next(shares) if can_shrink else size for size, can_shrink in zip(sizes, shrinkable)]
+
+    def compress_one(path, target):
+        stats = {}
+        compressed_path = compress_file(path, target / 1024, stats=stats)
+        return compressed_path, stats
+
+    with ThreadPoolExecutor(max_workers=max(1, BATCH_WORKERS)) as executor:
+        futures = [submit_with_timings(executor, compress_one, path, target) for path, target in zip(paths, targets)]
+        results = [future.result() for future in futures]
+
+    zip_filename = f"{uuid.uuid4()}_compressed.zip"
+    zip_path = os.path.join(upload_folder, zip_filename)
+    manifest = []
+    with stage('zip'), zipfile.ZipFile(zip_path, 'w', zipfile.ZIP_DEFLATED) as zip_file:
+        for name, path, size, target, (compressed_path, stats) in zip(names, paths, sizes, targets, results):
+            compressed_bytes = os.path.getsize(compressed_path)
+            compress_type = zipfile.ZIP_STORED if name.lower().endswith(STORED_EXTENSIONS) else zipfile.ZIP_DEFLATED
+            zip_file.write(compressed_path, name, compress_type=compress_type)
+            manifest.append({
+                'name': name,
+                'originalBytes': size,
+                'targetBytes': target,
+                'compressedBytes': compressed_bytes,
+                'compressionRatio': round((1 - compressed_bytes / size) * 100, 2) if size > 0 else 0,
+                'fits': compressed_bytes <= target,
+                'encodePasses': stats.get('passes'),
+            })
+        zip_file.writestr('manifest.json', json.dumps(manifest, indent=2))
+
+    # The per-file outputs live on in the ZIP only
+    cleanup_files([compressed_path for compressed_path, _ in results if compressed_path not in file_paths])
+    cleanup_files([path for path in paths if path not in file_paths])
+
+    original_bytes = sum(sizes)
+    compressed_bytes = sum(entry['compressedBytes'] for entry in manifest)
+    logger.info(f"Batch compressed {len(manifest)} files: {original_bytes} -> {compressed_bytes} bytes")
+
+    return {
+        'success': True,
+        'originalFile': f"{len(manifest)} files",
+        'fileCount': len(manifest),
+        'originalSize': round(original_bytes / (1024 * 1024), 2),
+        'compressedSize': round(compressed_bytes / (1024 * 1024), 2),
+        'compressionRatio': round((1 - compressed_bytes / original_bytes) * 100, 2) if original_bytes > 0 else 0,
+        'budget': budget,
+        'files': manifest,
+        'downloadUrl': f"/download/{zip_filename}"
+    }
+
+def pdf_to_photo_task(file_path, output_format, dpi=300):
+    """
+    Convert a saved PDF to a ZIP of page images.
+    Returns the JSON payload for the /pdf-to-photo response.
+    """
+    # Convert PDF to images
+    started = time.perf_counter()
+    pages = pdf_to_images(file_path, dpi=dpi, output_format=output_format)
+    render_seconds = round(time.perf_counter() - started, 3)
+    image_paths = [page['path'] for page in pages]
+    extension = PAGE_IMAGE_FORMATS[output_format]
+
+    # Create a ZIP file with all images
+    zip_filename = f"{uuid.uuid4()}_images.zip"
+    zip_path = os.path.join(app.config['UPLOAD_FOLDER'], zip_filename)
+
+    with stage('zip'), zipfile.ZipFile(zip_path, 'w') as zip_file:
+        for i, img_path in enumerate(image_paths):
+            # Add each image to the ZIP
+            zip_file.write(img_path, f"page_{i+1}.{extension}")
+
+    # Create download URL
+    download_url = f"/download/{zip_filename}"
+
+    # Clean up temporary image files
+    cleanup_files(image_paths)
+
+    return {
+        'success': True,
+        'originalFile': os.path.basename(file_path),
+        'pageCount': len(image_paths),
+        'dpi': dpi,
+        'renderSeconds': render_seconds,
+        'pageTimings': [{'page': page['page'], 'seconds': page['seconds']} for page in pages],
+        'downloadUrl': download_url
+    }
+
+def stream_pdf_pages(file_path, output_format, dpi=300):
+    """
+    Stream the pages of a saved PDF to the client as a ZIP download.
+
+    Pages go straight from the renderer into the ZIP stream as they finish;
+    no page images or ZIP file are written to disk, and the upload is
+    removed once the stream is done.
+    """
+    extension = PAGE_IMAGE_FORMATS[output_format]
+
+    def entries():
+        try:
+            for page in iter_rendered_pages(file_path, dpi=dpi, output_format=output_format):
+                logger.info(f"Streaming page {page['page']} ({len(page['data'])} bytes, {page['seconds']}s)")
+                yield f"page_{page['page']}.{extension}", page['data']
+        finally:
+            cleanup_files([file_path])
+
+    chunks = stream_zip(entries())
+    # Render the first page before answering so early failures still get a JSON error
+    first_chunk = next(chunks)
+
+    def body():
+        yield first_chunk
+        yield from chunks
+
+    download_name = f"{os.path.splitext(os.path.basename(file_path))[0]}_images.zip"
+    return Response(body(), mimetype='application/zip', headers={
+        'Content-Disposition': f'attachment; filename="{download_name}"'
+    })
+
+def photo_to_pdf_task(image_paths, page_size=None, dpi=150, target_size=None):
+    """
+    Combine saved images into one PDF.
+
+    With a page_size (a4/letter/legal) images are shrunk to fit the page at
+    dpi, and with a target_size (in MB) they are re-encoded so the whole PDF
+    fits it. Returns the JSON payload for the /photo-to-pdf response.
+    """
+    try:
+        pdf_path = os.path.join(UPLOAD_FOLDER, f"{uuid.uuid4()}_combined.pdf")
+        target_bytes = int(target_size * 1024 * 1024) if target_size else None
+        pages = build_photo_pdf(image_paths, pdf_path, page_size, dpi, target_bytes)
+        pdf_size = os.path.getsize(pdf_path)
+        logger.info(f"PDF created at: {pdf_path} ({len(pages)} pages, {pdf_size} bytes)")
+
+        # Create download URL
+        pdf_filename = os.path.basename(pdf_path)
+        download_url = f"/download/{pdf_filename}"
+
+        return {
+            'success': True,
+            'imageCount': len(image_paths),
+            'pdfSize': pdf_size,
+            'targetSize': target_bytes,
+            'fitsTarget': pdf_size <= target_bytes if target_bytes else None,
+            'images': [dict({key: value for key, value in page.items() if key != 'path'},
+                            name=os.path.basename(page['path']).split('_', 1)[-1],
+                            originalBytes=os.path.getsize(page['path']))
+                       for page in pages],
+            'downloadUrl': download_url
+        }
+    finally:
+        # Clean up temporary image files
+        cleanup_files(image_paths)
+
+def word_to_pdf_task(file_path):
+    """
+    Convert a saved Word document to PDF.
+    Returns the JSON payload for the /word-to-pdf response.
+    """
+    # Convert Word to PDF, on the LibreOffice pool when installed
+    pdf_path = os.path.splitext(file_path)[0] + '.pdf'
+    backend, _ = run_backend('word-to-pdf', file_path, pdf_path)
+
+    # Create download URL
+    pdf_filename = os.path.basename(pdf_path)
+    download_url = f"/download/{pdf_filename}"
+
+    return {
+        'success': True,
+        'originalFile': os.path.basename(file_path),
+        'backend': backend,
+        'downloadUrl': download_url
+    }
+
+def pdf_to_word_task(file_path, parallel=None, text_fallback=False):
+    """
+    Convert a saved PDF to a Word document, in parallel page ranges for
+    long documents (see utils/pdf_docx.py).
+    Returns the JSON payload for the /pdf-to-word response.
+    """
+    # Convert PDF to Word
+    word_path = os.path.splitext(file_path)[0] + '.docx'
+    started = time.perf_counter()
+    backend, stats = run_backend('pdf-to-docx', file_path, word_path, parallel=parallel, text_fallback=text_fallback)
+    logger.info(f"Converted {stats['pages']} pages of {file_path} with {backend} in {stats['segments']} segments "
+                f"({stats['textPages']} text-only) in {time.perf_counter() - started:.3f}s")
+
+    # Create download URL
+    word_filename = os.path.basename(word_path)
+    download_url = f"/download/{word_filename}"
+
+    return {
+        'success': True,
+        'originalFile': os.path.basename(file_path),
+        'pageCount': stats['pages'],
+        'textPages': stats['textPages'],
+        'backend': backend,
+        'downloadUrl': download_url
+    }
+
+def add_watermark_task(file_path, watermark_text, incremental=False):
+    """
+    Watermark a saved PDF.
+    Returns the JSON payload for the /add-watermark response.
+    """
+    # Add watermark to PDF
+    started = time.perf_counter()
+    watermark_stats = {}
+    watermarked_path = add_watermark_to_pdf(file_path, watermark_text, incremental, stats=watermark_stats)
+    logger.info(f"Watermarked {file_path} in {time.perf_counter() - started:.3f}s "
+                f"({watermark_stats.get('saveMode')} save)")
+
+    # Create download URL
+    watermarked_filename = os.path.basename(watermarked_path)
+    download_url = f"/download/{watermarked_filename}"
+
+    return {
+        'success': True,
+        'originalFile': os.path.basename(file_path),
+        'watermarkText': watermark_text,
+        'saveMode': watermark_stats.get('saveMode'),
+        'downloadUrl': download_url
+    }
+
+def wants_async():
+    """True if the client asked for the conversion to run as a background job."""
+    return request.form.get('async', '').lower() in ('1', 'true', 'yes')
+
+def cached_response(cache_key, uploaded_paths):
+    """
+    Return the cached JSON response for cache_key, or None on a miss.
+    On a hit the artifact counts as used for retention and the freshly
+    uploaded duplicates are removed straight away.
+    """
+    payload = result_cache.get(cache_key)
+    if payload is None:
+        return None
+    if not retention.touch(os.path.basename(payload.get('downloadUrl', ''))):
+        # Retention removed the artifact since the cache looked at it
+        result_cache.discard(cache_key)
+        return None
+    logger.info(f"Serving cached result {payload.get('downloadUrl')}")
+    cleanup_files(uploaded_paths)
+    return jsonify(payload)
+
+def remember_result(cache_key, payload):
+    """Store a task payload and the artifact behind its download URL in the result cache."""
+    if cache_key and payload.get('downloadUrl'):
+        artifact_path = os.path.join(app.config['UPLOAD_FOLDER'], os.path.basename(payload['downloadUrl']))
+        result_cache.put(cache_key, payload, artifact_path)
+
+def run_task(operation, task, *args, cache_key=None):
+    """
+    Run a conversion task for the current request.
+
+    With async=1 the task is queued on the job queue and the response carries
+    the job id and polling URLs; otherwise it runs inline as before. Results
+    are stored in the result cache under cache_key.
+    """
+    if not wants_async():
+        try:
+            with measure_peak_rss() as peak:
+                payload = task(*args)
+        except Exception:
+            CONVERSIONS.inc(operation=operation, status=FAILED)
+            raise
+        CONVERSIONS.inc(operation=operation, status=FINISHED)
+        CONVERSION_PEAK_RSS.observe(peak.bytes, operation=operation)
+        remember_result(cache_key, payload)
+        return jsonify(payload)
+
+    route = request.url_rule.rule
+
+    def on_done(job):
+        CONVERSIONS.inc(operation=operation, status=job['status'])
+        if job['status'] == FINISHED:
+            remember_result(cache_key, job['result'])
+            # Stage timings measured in the job process
+            timings = Timings()
+            timings.merge(job['timings'])
+            observe_timings(route, timings)
+            if timings.peak_rss:
+                CONVERSION_PEAK_RSS.observe(timings.peak_rss, operation=operation)
+
+    try:
+        job_id = job_queue.submit(operation, task, *args, on_done=on_done)
+    except QueueFullError as e:
+        logger.warning(str(e))
+        return jsonify({
+            'success': False,
+            'error': str(e)
+        }), 503
+
+    logger.info(f"Queued {operation} job {job_id}")
+    return jsonify({
+        'success': True,
+        'jobId': job_id,
+        'status': QUEUED,
+        'statusUrl': url_for('job_status', job_id=job_id),
+        'resultUrl': url_for('job_result', job_id=job_id)
+    }), 202
+
+@app.before_request
+def start_request_timing():
+    g.request_started = time.perf_counter()
+    g.timings, g.timings_token = start_timings()
+
+@app.before_request
+def start_retention_sweeper():
+    retention.ensure_started()
+
+@app.before_request
+def ingest_uploads():
+    # Parse the body up front so oversized or mismatched uploads are
+    # rejected here rather than inside a route's own error handling
+    if request.method == 'POST' and request.mimetype == 'multipart/form-data':
+        with stage('receive'):
+            request.files
+
+@app.after_request
+def record_request_metrics(response):
+    if 'request_started' not in g:
+        return response
+    route = request.url_rule.rule if request.url_rule else 'unmatched'
+    method, status = request.method, response.status_code
+    started, timings = g.request_started, g.timings
+    handled = time.perf_counter()
+    bytes_in, bytes_out = request.content_length, response.content_length
+
+    def finish():
+        # Runs once the body has been sent, so streamed responses are included
+        finished = time.perf_counter()
+        timings.add_stage('response', finished - handled)
+        observe_timings(route, timings)
+        REQUEST_SECONDS.observe(finished - started, route=route, method=method, status=status)
+        if bytes_in is not None:
+            REQUEST_BYTES_IN.observe(bytes_in, route=route)
+        if bytes_out is not None:
+            RESPONSE_BYTES_OUT.observe(bytes_out, route=route)
+
+    response.call_on_close(finish)
+    return response
+
+@app.teardown_request
+def stop_request_timing(error=None):
+    token = g.pop('timings_token', None)
+    if token is not None:
+        stop_timings(token)
+
+@app.errorhandler(413)
+@app.errorhandler(415)
+def upload_rejected(error):
+    return jsonify({
+        'success': False,
+        'error': error.description
+    }), error.code
+
 @app.route('/')
 def index():
     return render_template('index.html')
@@ -335,33 +811,31 @@ def compress():
                     'error': 'No file part'
                 })
             
-            file = request.files['file']
-            if file.filename == '':
+            files = request.files.getlist('file')
+            if not files or files[0].filename == '':
                 logger.error("No selected file")
                 return jsonify({
                     'success': False,
                     'error': 'No selected file'
                 })
             
-            logger.info(f"Processing file: {file.filename}")
+            # Several files (or a ZIP of them) are compressed as one batch
+            file_paths = []
+            file_hashes = []
+            for file in files:
+                logger.info(f"Processing file: {file.filename}")
+                file_path, file_hash = save_uploaded_file_hashed(file, 'all')
+                if not file_path:
+                    logger.error(f"File type not allowed or error saving file: {file.filename}")
+                    cleanup_files(file_paths)
+                    return jsonify({
+                        'success': False,
+                        'error': 'File type not allowed or error saving file'
+                    })
+                file_paths.append(file_path)
+                file_hashes.append(file_hash)
             
-            # Debug check if file type is allowed
-            is_allowed = allowed_file(file.filename, 'all')
-            logger.info(f"File type allowed check: {is_allowed}")
-            
-            file_path = save_uploaded_file(file, 'all')
-            if not file_path:
-                logger.error(f"File type not allowed or error saving file: {file.filename}")
-                return jsonify({
-                    'success': False,
-                    'error': 'File type not allowed or error saving file'
-                })
-            
-            logger.info(f"File saved at: {file_path}")
-            
-            # Get original size
-            original_size = get_file_size(file_path)
-            logger.info(f"Original file size: {original_size} MB")
+            logger.info(f"Files saved at: {file_paths}")
             
             # Get target size from form
             target_size = float(request.form.get('target_size', 1))
@@ -378,28 +852,25 @@ def compress():
             
             logger.info(f"Converted target size: {target_size} MB")
             
-            # Compress the file
-            compressed_path = compress_file(file_path, target_size)
-            compressed_size = get_file_size(compressed_path)
-            logger.info(f"Compressed file size: {compressed_size} MB at {compressed_path}")
+            if len(file_paths) > 1 or file_paths[0].lower().endswith('.zip'):
+                # budget=total shares target_size between the files, budget=file applies it to each
+                budget = request.form.get('budget', 'total')
+                if budget not in ('total', 'file'):
+                    budget = 'total'
+                cache_key = make_key('compress-batch', file_hashes, {'targetSizeMb': target_size, 'budget': budget})
+                cached = cached_response(cache_key, file_paths)
+                if cached is not None:
+                    return cached
+                
+                return run_task('compress-batch', batch_compress_task, file_paths, target_size, budget,
+                                cache_key=cache_key)
             
-            # Calculate compression ratio
-            compression_ratio = round((1 - (compressed_size / original_size)) * 100, 2) if original_size > 0 else 0
-            logger.info(f"Compression ratio: {compression_ratio}%")
+            cache_key = make_key('compress', file_hashes, {'targetSizeMb': target_size})
+            cached = cached_response(cache_key, file_paths)
+            if cached is not None:
+                return cached
             
-            # Create download URL
-            filename = os.path.basename(compressed_path)
-            download_url = f"/download/{filename}"
-            logger.info(f"Download URL: {download_url}")
-            
-            return jsonify({
-                'success': True,
-                'originalFile': os.path.basename(file_path),
-                'originalSize': original_size,
-                'compressedSize': compressed_size,
-                'compressionRatio': compression_ratio,
-                'downloadUrl': download_url
-            })
+            return run_task('compress', compress_task, file_paths[0], target_size, cache_key=cache_key)
             
         except Exception as e:
             logger.error(f"Error compressing file: {str(e)}")
@@ -426,39 +897,34 @@ def pdf_to_photo():
             flash('Only PDF files are allowed')
             return redirect(request.url)
         
-        file_path = save_uploaded_file(file, 'pdf')
+        file_path, file_hash = save_uploaded_file_hashed(file, 'pdf')
         if not file_path:
             flash('Error saving file')
             return redirect(request.url)
         
         try:
-            # Get output format from form
-            output_format = request.form.get('format', 'png')
-            
-            # Convert PDF to images
-            image_paths = pdf_to_images(file_path, dpi=300)
-            
-            # Create a ZIP file with all images
-            zip_filename = f"{uuid.uuid4()}_images.zip"
-            zip_path = os.path.join(app.config['UPLOAD_FOLDER'], zip_filename)
-            
-            with zipfile.ZipFile(zip_path, 'w') as zip_file:
-                for i, img_path in enumerate(image_paths):
-                    # Add each image to the ZIP
-                    zip_file.write(img_path, f"page_{i+1}.{output_format}")
+            # Get output format and resolution from form
+            output_format = request.form.get('format', 'png').lower()
+            if output_format not in PAGE_IMAGE_FORMATS:
+                cleanup_files([file_path])
+                return jsonify({
+                    'success': False,
+                    'error': f"Unsupported image format: {output_format}"
+                })
+            dpi = int(request.form.get('dpi', 300))
+            dpi = max(MIN_RENDER_DPI, min(dpi, MAX_RENDER_DPI))
             
-            # Create download URL
-            download_url = f"/download/{zip_filename}"
+            # Streaming mode sends the ZIP as the pages are rendered
+            if request.form.get('stream', '').lower() in ('1', 'true', 'yes'):
+                return stream_pdf_pages(file_path, output_format, dpi)
             
-            # Clean up temporary image files
-            cleanup_files(image_paths)
+            cache_key = make_key('pdf-to-photo', [file_hash], {'format': output_format, 'dpi': dpi})
+            cached = cached_response(cache_key, [file_path])
+            if cached is not None:
+                return cached
             
-            return jsonify({
-                'success': True,
-                'originalFile': os.path.basename(file_path),
-                'pageCount': len(image_paths),
-                'downloadUrl': download_url
-            })
+            return run_task('pdf-to-photo', pdf_to_photo_task, file_path, output_format, dpi,
+                            cache_key=cache_key)
             
         except Exception as e:
             logger.error(f"Error converting PDF to images: {str(e)}")
@@ -483,29 +949,36 @@ def photo_to_pdf():
         
         # Save all uploaded images
         image_paths = []
+        image_hashes = []
         for file in files:
             if allowed_file(file.filename, 'image'):
-                file_path = save_uploaded_file(file, 'image')
+                file_path, file_hash = save_uploaded_file_hashed(file, 'image')
                 if file_path:
                     image_paths.append(file_path)
+                    image_hashes.append(file_hash)
         
         if not image_paths:
             flash('No valid image files uploaded')
             return redirect(request.url)
         
         try:
-            # Convert images to PDF
-            pdf_path = images_to_pdf(image_paths)
+            # Optional page fitting and output size budget
+            page_size = request.form.get('page_size', '').lower() or None
+            if page_size is not None and page_size not in PAGE_SIZES:
+                page_size = None
+            dpi = min(max(int(request.form.get('dpi', 150)), MIN_RENDER_DPI), MAX_RENDER_DPI)
+            target_size = request.form.get('target_size', type=float)
+            if target_size is not None and request.form.get('size_unit', 'MB') == 'KB':
+                target_size = target_size / 1024
             
-            # Create download URL
-            pdf_filename = os.path.basename(pdf_path)
-            download_url = f"/download/{pdf_filename}"
+            cache_key = make_key('photo-to-pdf', image_hashes,
+                                 {'pageSize': page_size, 'dpi': dpi, 'targetSizeMb': target_size})
+            cached = cached_response(cache_key, image_paths)
+            if cached is not None:
+                return cached
             
-            return jsonify({
-                'success': True,
-                'imageCount': len(image_paths),
-                'downloadUrl': download_url
-            })
+            return run_task('photo-to-pdf', photo_to_pdf_task, image_paths, page_size, dpi, target_size,
+                            cache_key=cache_key)
             
         except Exception as e:
             logger.error(f"Error converting images to PDF: {str(e)}")
@@ -513,9 +986,6 @@ def photo_to_pdf():
                 'success': False,
                 'error': f"Error converting images to PDF: {str(e)}"
             })
-        finally:
-            # Clean up temporary image files
-            cleanup_files(image_paths)
         
     return render_template('photo_to_pdf.html')
 
@@ -535,25 +1005,18 @@ def word_to_pdf():
             flash('Only Word documents are allowed')
             return redirect(request.url)
 
-        file_path = save_uploaded_file(file, 'word')
+        file_path, file_hash = save_uploaded_file_hashed(file, 'word')
         if not file_path:
             flash('Error saving file')
             return redirect(request.url)
 
         try:
-            # Convert Word to PDF
-            pdf_path = os.path.splitext(file_path)[0] + '.pdf'
-            convert(file_path, pdf_path)
-            
-            # Create download URL
-            pdf_filename = os.path.basename(pdf_path)
-            download_url = f"/download/{pdf_filename}"
+            cache_key = make_key('word-to-pdf', [file_hash])
+            cached = cached_response(cache_key, [file_path])
+            if cached is not None:
+                return cached
 
-            return jsonify({
-                'success': True,
-                'originalFile': os.path.basename(file_path),
-                'downloadUrl': download_url
-            })
+            return run_task('word-to-pdf', word_to_pdf_task, file_path, cache_key=cache_key)
 
         except Exception as e:
             logger.error(f"Error converting Word to PDF: {str(e)}")
@@ -580,27 +1043,23 @@ def pdf_to_word():
             flash('Only PDF files are allowed')
             return redirect(request.url)
 
-        file_path = save_uploaded_file(file, 'pdf')
+        # Page-range mode: auto (by page count), 1 for parallel, 0 for one pass
+        parallel = {'1': True, '0': False}.get(request.form.get('parallel', ''))
+        text_fallback = request.form.get('text_fallback') == '1'
+
+        file_path, file_hash = save_uploaded_file_hashed(file, 'pdf')
         if not file_path:
             flash('Error saving file')
             return redirect(request.url)
 
         try:
-            # Convert PDF to Word
-            word_path = os.path.splitext(file_path)[0] + '.docx'
-            cv = Converter(file_path)
-            cv.convert(word_path)
-            cv.close()
-            
-            # Create download URL
-            word_filename = os.path.basename(word_path)
-            download_url = f"/download/{word_filename}"
+            cache_key = make_key('pdf-to-word', [file_hash], {'parallel': parallel, 'textFallback': text_fallback})
+            cached = cached_response(cache_key, [file_path])
+            if cached is not None:
+                return cached
 
-            return jsonify({
-                'success': True,
-                'originalFile': os.path.basename(file_path),
-                'downloadUrl': download_url
-            })
+            return run_task('pdf-to-word', pdf_to_word_task, file_path, parallel, text_fallback,
+                            cache_key=cache_key)
 
         except Exception as e:
             logger.error(f"Error converting PDF to Word: {str(e)}")
@@ -632,25 +1091,27 @@ def add_watermark():
             flash('Watermark text cannot be empty')
             return redirect(request.url)
         
-        file_path = save_uploaded_file(file, 'pdf')
+        file_path, file_hash = save_uploaded_file_hashed(file, 'pdf')
         if not file_path:
             flash('Error saving file')
             return redirect(request.url)
         
         try:
-            # Add watermark to PDF
-            watermarked_path = add_watermark_to_pdf(file_path, watermark_text)
+            # incremental=1/0 picks the save mode; by default large files are updated incrementally
+            incremental = request.form.get('incremental', '').lower()
+            if incremental in ('1', 'true', 'yes', '0', 'false', 'no'):
+                incremental = incremental in ('1', 'true', 'yes')
+            else:
+                incremental = os.path.getsize(file_path) >= INCREMENTAL_SAVE_MB * 1024 * 1024
             
-            # Create download URL
-            watermarked_filename = os.path.basename(watermarked_path)
-            download_url = f"/download/{watermarked_filename}"
+            cache_key = make_key('add-watermark', [file_hash],
+                                 {'watermarkText': watermark_text, 'incremental': incremental})
+            cached = cached_response(cache_key, [file_path])
+            if cached is not None:
+                return cached
             
-            return jsonify({
-                'success': True,
-                'originalFile': os.path.basename(file_path),
-                'watermarkText': watermark_text,
-                'downloadUrl': download_url
-            })
+            return run_task('add-watermark', add_watermark_task, file_path, watermark_text, incremental,
+                            cache_key=cache_key)
             
         except Exception as e:
             logger.error(f"Error adding watermark to PDF: {str(e)}")
@@ -661,19 +1122,122 @@ def add_watermark():
         
     return render_template('add_watermark.html')
 
+@app.route('/jobs/<job_id>')
+def job_status(job_id):
+    job = job_queue.get(job_id)
+    if job is None:
+        return jsonify({
+            'success': False,
+            'error': 'Job not found'
+        }), 404
+
+    response = {
+        'success': job['status'] != FAILED,
+        'jobId': job['id'],
+        'operation': job['operation'],
+        'status': job['status'],
+        'createdAt': job['createdAt'],
+        'startedAt': job.get('startedAt'),
+        'finishedAt': job.get('finishedAt'),
+        'resultUrl': url_for('job_result', job_id=job['id'])
+    }
+    if job['status'] == FAILED:
+        response['error'] = job.get('error')
+    return jsonify(response)
+
+@app.route('/jobs/<job_id>/result')
+def job_result(job_id):
+    job = job_queue.get(job_id)
+    if job is None:
+        return jsonify({
+            'success': False,
+            'error': 'Job not found'
+        }), 404
+
+    if job['status'] == FINISHED:
+        return jsonify(job['result'])
+
+    if job['status'] == FAILED:
+        return jsonify({
+            'success': False,
+            'error': f"Error processing file: {job.get('error')}"
+        })
+
+    # Still queued or running
+    return jsonify({
+        'success': True,
+        'jobId': job['id'],
+        'status': job['status'],
+        'statusUrl': url_for('job_status', job_id=job['id'])
+    }), 202
+
 @app.route('/download/<filename>')
 def download_file(filename):
     try:
-        file_path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-        if not os.path.exists(file_path):
+        file_path = safe_join(app.config['UPLOAD_FOLDER'], filename)
+        if file_path is None or filename.startswith('.') or not os.path.isfile(file_path):
             flash('File not found')
             return redirect(url_for('index'))
         
-        return send_file(file_path, as_attachment=True)
+        # send_file resolves relative paths against the app root, not the cwd
+        file_path = os.path.abspath(file_path)
+        retention.touch(filename)
+        etag = content_etag(file_path)
+        immutable = is_immutable(filename)
+        
+        if DOWNLOAD_ACCEL_PREFIX:
+            # The proxy sends the bytes (and handles Range); we only answer 304s
+            if request.if_none_match.contains(etag):
+                response = Response(status=304)
+            else:
+                response = Response()
+                response.headers['X-Accel-Redirect'] = f"{DOWNLOAD_ACCEL_PREFIX.rstrip('/')}/{filename}"
+                response.headers['Content-Disposition'] = f'attachment; filename="{filename}"'
+                # Let the proxy pick the type from the file
+                del response.headers['Content-Type']
+            response.set_etag(etag)
+        else:
+            # Handles Range and If-None-Match; the body goes out through the
+            # server's file wrapper (sendfile under gunicorn)
+            response = send_file(file_path, as_attachment=True, etag=etag, conditional=True)
+        
+        if immutable:
+            response.cache_control.no_cache = None
+            response.cache_control.public = True
+            response.cache_control.max_age = IMMUTABLE_MAX_AGE
+            response.cache_control.immutable = True
+        return response
     except Exception as e:
         logger.error(f"Error downloading file: {str(e)}")
         flash('Error downloading file')
         return redirect(url_for('index'))
 
+@app.route('/storage/stats')
+def storage_stats():
+    return jsonify({
+        'success': True,
+        'retention': retention.stats(),
+        'resultCache': result_cache.stats(),
+        'jobs': job_queue.stats()
+    })
+
+@app.route('/backends/stats')
+def backends_stats():
+    return jsonify({
+        'success': True,
+        'backends': backends.stats()
+    })
+
+@app.route('/metrics')
+def metrics_endpoint():
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+@app.route('/imports/stats')
+def imports_stats():
+    return jsonify({
+        'success': True,
+        'imports': import_report()
+    })
+
 if __name__ == '__main__':
     app.run(debug=True)
\ No newline at end of file
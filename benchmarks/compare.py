@@ -0,0 +1,81 @@
+"""
+Compare two benchmark results files.
+
+    python -m benchmarks.compare BASELINE.json CURRENT.json
+
+Changes are relative to the baseline: a negative latency or memory change
+is an improvement. Only cases present in both files are compared.
+"""
+import sys
+import json
+
+# Relative changes smaller than this are reported as noise
+NOISE = 0.05
+
+
+def relative_change(before, after):
+    if not before or after is None:
+        return None
+    return (after - before) / before
+
+
+def compare_results(baseline, current):
+    """Per-case changes in p50/p95 latency, throughput and peak memory."""
+    rows = []
+    for name, case in current['cases'].items():
+        before = baseline.get('cases', {}).get(name)
+        if not before or 'error' in before or 'error' in case:
+            continue
+        rows.append({
+            'case': name,
+            'p50': (before['latency']['p50'], case['latency']['p50']),
+            'p50Change': relative_change(before['latency']['p50'], case['latency']['p50']),
+            'p95Change': relative_change(before['latency']['p95'], case['latency']['p95']),
+            'throughputChange': relative_change(before['opsPerSecond'], case['opsPerSecond']),
+            'peakRssChange': relative_change(before['peakRssBytes'], case['peakRssBytes']),
+        })
+    return {
+        'baseline': {key: baseline.get(key) for key in ('createdAt', 'commit', 'preset')},
+        'current': {key: current.get(key) for key in ('createdAt', 'commit', 'preset')},
+        'presetsDiffer': baseline.get('preset') != current.get('preset'),
+        'cases': rows,
+    }
+
+
+def format_change(change):
+    if change is None:
+        return '      n/a'
+    marker = ' ' if abs(change) < NOISE else '*'
+    return f"{change * 100:+8.1f}%{marker}"
+
+
+def print_comparison(comparison):
+    baseline, current = comparison['baseline'], comparison['current']
+    print(f"Baseline {baseline['commit']} ({baseline['createdAt']}) -> "
+          f"current {current['commit']} ({current['createdAt']})")
+    if comparison['presetsDiffer']:
+        print(f"Warning: comparing a {baseline['preset']} corpus with a {current['preset']} one")
+    print(f"{'case':36} {'p50 ms':>19} {'p50':>10} {'p95':>10} {'ops/s':>10} {'peak RSS':>10}")
+    for row in comparison['cases']:
+        before, after = row['p50']
+        print(f"{row['case']:36} {before * 1000:8.1f} -> {after * 1000:7.1f} {format_change(row['p50Change'])} "
+              f"{format_change(row['p95Change'])} {format_change(row['throughputChange'])} "
+              f"{format_change(row['peakRssChange'])}")
+    print(f"* change of {NOISE * 100:.0f}% or more")
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    if len(argv) != 2:
+        print(__doc__.strip())
+        return 2
+    with open(argv[0]) as f:
+        baseline = json.load(f)
+    with open(argv[1]) as f:
+        current = json.load(f)
+    print_comparison(compare_results(baseline, current))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,136 @@
+import os
+import json
+import random
+import logging
+from io import BytesIO
+import fitz  # PyMuPDF
+import docx
+from docx.shared import Inches
+from PIL import Image, ImageDraw, ImageFilter
+
+# Inputs per corpus size: pages, photo pixels, DOCX image count
+PRESETS = {
+    'small': {'pages': 8, 'scan_dpi': 100, 'photo': (1600, 1200), 'docx_images': 8, 'photos': 4},
+    'medium': {'pages': 40, 'scan_dpi': 150, 'photo': (4000, 3000), 'docx_images': 30, 'photos': 10},
+    'large': {'pages': 200, 'scan_dpi': 200, 'photo': (6000, 4500), 'docx_images': 100, 'photos': 30},
+}
+
+LOREM = ("Lorem ipsum dolor sit amet, consectetur adipiscing elit, sed do eiusmod tempor incididunt ut "
+         "labore et dolore magna aliqua. Ut enim ad minim veniam, quis nostrud exercitation ullamco "
+         "laboris nisi ut aliquip ex ea commodo consequat. Duis aute irure dolor in reprehenderit.")
+
+# Bumped whenever the generators change, so stale corpora are rebuilt
+CORPUS_VERSION = 1
+
+
+def text_lines(rng, count, width=90):
+    words = LOREM.split()
+    for _ in range(count):
+        line = []
+        while sum(len(word) + 1 for word in line) < width:
+            line.append(rng.choice(words))
+        yield ' '.join(line)
+
+
+def photo(rng, size):
+    """
+    A photo-like RGB image: smooth gradients with blurred noise on top,
+    so it compresses like a real photo rather than a flat graphic.
+    """
+    width, height = size
+    channels = []
+    for angle in (0, 90, 45):
+        gradient = Image.linear_gradient('L').rotate(angle + rng.uniform(-20, 20)).resize(size)
+        noise = Image.frombytes('L', (width // 4, height // 4), rng.randbytes((width // 4) * (height // 4)))
+        noise = noise.resize(size, Image.BILINEAR).filter(ImageFilter.GaussianBlur(2))
+        channels.append(Image.blend(gradient, noise, 0.35))
+    return Image.merge('RGB', channels)
+
+
+def scanned_page(rng, size):
+    """A greyscale page of text with paper noise and a slight skew, like a scan."""
+    width, height = size
+    page = Image.new('L', size, 245)
+    draw = ImageDraw.Draw(page)
+    line_height = max(12, height // 60)
+    for row, line in enumerate(text_lines(rng, height // line_height - 4)):
+        draw.text((width // 12, line_height * (row + 2)), line, fill=30)
+    noise = Image.frombytes('L', size, rng.randbytes(width * height)).point(lambda v: 255 if v > 24 else 150)
+    page = Image.composite(page, noise.filter(ImageFilter.MinFilter(3)), noise)
+    return page.rotate(rng.uniform(-1.5, 1.5), fillcolor=245)
+
+
+def make_text_pdf(path, rng, pages):
+    with fitz.open() as doc:
+        for page_num in range(pages):
+            page = doc.new_page()
+            page.insert_text((72, 60), f"Section {page_num + 1}", fontsize=16)
+            page.insert_textbox(fitz.Rect(72, 80, 540, 790), '\n'.join(text_lines(rng, 50)), fontsize=9)
+        doc.save(path, garbage=3, deflate=True)
+
+
+def make_scanned_pdf(path, rng, pages, dpi):
+    size = (int(8.27 * dpi), int(11.69 * dpi))
+    with fitz.open() as doc:
+        for _ in range(pages):
+            buffer = BytesIO()
+            scanned_page(rng, size).save(buffer, 'JPEG', quality=75)
+            page = doc.new_page(width=595, height=842)
+            page.insert_image(page.rect, stream=buffer.getvalue())
+        doc.save(path, garbage=3, deflate=True)
+
+
+def make_docx(path, rng, images):
+    document = docx.Document()
+    document.add_heading('Benchmark report', 0)
+    lines = text_lines(rng, images * 3)
+    for index in range(images):
+        document.add_paragraph(' '.join(next(lines) for _ in range(3)))
+        buffer = BytesIO()
+        photo(rng, (1200, 900)).save(buffer, 'JPEG', quality=90)
+        buffer.seek(0)
+        document.add_picture(buffer, width=Inches(5))
+        document.add_paragraph(f"Figure {index + 1}")
+    document.save(path)
+
+
+def build_corpus(directory, preset='small', seed=1):
+    """
+    Generate the benchmark inputs for preset into directory, unless a
+    matching corpus is already there. Inputs are derived from seed only, so
+    every run (and every machine) benchmarks the same files.
+
+    Returns a dict of input name -> path (a list of paths for 'photos').
+    """
+    settings = PRESETS[preset]
+    inputs = {
+        'text_pdf': os.path.join(directory, 'text.pdf'),
+        'scanned_pdf': os.path.join(directory, 'scanned.pdf'),
+        'photo_jpeg': os.path.join(directory, 'photo.jpg'),
+        'photo_png': os.path.join(directory, 'photo.png'),
+        'docx': os.path.join(directory, 'images.docx'),
+        'photos': [os.path.join(directory, f'photo_{index:03d}.jpg') for index in range(settings['photos'])],
+    }
+
+    manifest = {'version': CORPUS_VERSION, 'preset': preset, 'seed': seed}
+    manifest_path = os.path.join(directory, 'manifest.json')
+    if os.path.exists(manifest_path):
+        with open(manifest_path) as f:
+            if json.load(f) == manifest:
+                return inputs
+
+    logging.info(f"Generating {preset} benchmark corpus in {directory}")
+    os.makedirs(directory, exist_ok=True)
+    rng = random.Random(seed)
+    make_text_pdf(inputs['text_pdf'], rng, settings['pages'])
+    make_scanned_pdf(inputs['scanned_pdf'], rng, settings['pages'], settings['scan_dpi'])
+    big_photo = photo(rng, settings['photo'])
+    big_photo.save(inputs['photo_jpeg'], 'JPEG', quality=92)
+    big_photo.save(inputs['photo_png'], 'PNG')
+    make_docx(inputs['docx'], rng, settings['docx_images'])
+    for path in inputs['photos']:
+        photo(rng, (settings['photo'][0] // 2, settings['photo'][1] // 2)).save(path, 'JPEG', quality=90)
+
+    with open(manifest_path, 'w') as f:
+        json.dump(manifest, f)
+    return inputs
@@ -0,0 +1,439 @@
+"""
+Load test of the web app: concurrent, mixed traffic against its routes.
+
+    python -m benchmarks.load                                  # test client, mixed profile
+    python -m benchmarks.load --gunicorn --workers 2 --concurrency 1,4,8 --duration 30
+    python -m benchmarks.load --url http://127.0.0.1:5001 --uploads uploads --profile compress
+    python -m benchmarks.load --mix compress-pdf=3,page=1 --requests 200 --async
+
+Run from the repository root. Requests are drawn from a traffic profile
+(weights per request type, see PROFILES) over the small benchmark corpus;
+each concurrency level reports requests/sec, latency percentiles, error
+rate and how much the upload folder grew. With the test client or
+--gunicorn the app runs in a scratch directory, so the repository's own
+uploads/ is never touched. Nothing leaves the machine.
+"""
+import os
+import sys
+import json
+import time
+import uuid
+import random
+import shutil
+import socket
+import logging
+import argparse
+import tempfile
+import threading
+import zipfile
+import subprocess
+import http.client
+from io import BytesIO
+from datetime import datetime
+from urllib.parse import urlsplit
+from benchmarks.corpus import build_corpus
+from benchmarks.run import CORPUS_DIR, RESULTS_DIR, git_commit, latency_summary
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Seconds a started gunicorn gets to accept connections
+SERVER_STARTUP_TIMEOUT = 60
+
+# Seconds between polls of a background job
+JOB_POLL_INTERVAL = 0.1
+
+
+def half_size_kb(data):
+    return f"{len(data) / 1024 / 2:.1f}"
+
+
+# Request type -> build(files) returning (path, form fields, [(field, corpus input)]);
+# None for a plain GET
+REQUEST_TYPES = {
+    'page': lambda files: ('/', None, None),
+    'compress-pdf': lambda files: ('/compress', {'target_size': half_size_kb(files['scanned_pdf']),
+                                                 'size_unit': 'KB'}, [('file', 'scanned_pdf')]),
+    'compress-image': lambda files: ('/compress', {'target_size': half_size_kb(files['photo_jpeg']),
+                                                   'size_unit': 'KB'}, [('file', 'photo_jpeg')]),
+    'compress-docx': lambda files: ('/compress', {'target_size': half_size_kb(files['docx']),
+                                                  'size_unit': 'KB'}, [('file', 'docx')]),
+    'pdf-to-photo': lambda files: ('/pdf-to-photo', {'format': 'jpg', 'dpi': '100'}, [('file', 'text_pdf')]),
+    'photo-to-pdf': lambda files: ('/photo-to-pdf', {'page_size': 'a4'},
+                                   [('file', name) for name in files if name.startswith('photos/')]),
+    'word-to-pdf': lambda files: ('/word-to-pdf', {}, [('file', 'docx')]),
+    'pdf-to-word': lambda files: ('/pdf-to-word', {}, [('file', 'text_pdf')]),
+    'add-watermark': lambda files: ('/add-watermark', {'watermark_text': 'CONFIDENTIAL'}, [('file', 'text_pdf')]),
+}
+
+# Profile -> weight per request type
+PROFILES = {
+    'mixed': {'page': 2, 'compress-pdf': 3, 'compress-image': 3, 'compress-docx': 1, 'pdf-to-photo': 1,
+              'photo-to-pdf': 2, 'word-to-pdf': 1, 'pdf-to-word': 1, 'add-watermark': 2},
+    'compress': {'compress-pdf': 1, 'compress-image': 1, 'compress-docx': 1},
+    'convert': {'pdf-to-photo': 1, 'photo-to-pdf': 1, 'word-to-pdf': 1, 'pdf-to-word': 1},
+    'light': {'page': 3, 'add-watermark': 1},
+}
+
+def salt_zip(data):
+    """Set a unique archive comment on a ZIP based file (DOCX, XLSX...)."""
+    buffer = BytesIO(data)
+    with zipfile.ZipFile(buffer, 'a') as archive:
+        archive.comment = uuid.uuid4().hex.encode()
+    return buffer.getvalue()
+
+
+# Changes that leave a file valid but change its hash, so repeated
+# uploads miss the result cache like distinct user files would
+SALTS = {
+    '.pdf': lambda data: data + b'\n%' + uuid.uuid4().hex.encode() + b'\n',  # a PDF comment after %%EOF
+    '.jpg': lambda data: data + uuid.uuid4().bytes,  # ignored after the end-of-image marker
+    '.png': lambda data: data + uuid.uuid4().bytes,  # ignored after IEND
+    '.docx': salt_zip,
+}
+
+
+def parse_mix(text):
+    """'compress-pdf=3,page=1' -> {'compress-pdf': 3, 'page': 1}"""
+    mix = {}
+    for item in text.split(','):
+        name, _, weight = item.partition('=')
+        name = name.strip()
+        if name not in REQUEST_TYPES:
+            raise argparse.ArgumentTypeError(f"Unknown request type {name} (one of {', '.join(REQUEST_TYPES)})")
+        mix[name] = float(weight or 1)
+    return mix
+
+
+def load_corpus(preset):
+    """Corpus input name -> (filename, bytes); the photos are 'photos/<n>' entries."""
+    inputs = build_corpus(os.path.join(CORPUS_DIR, preset), preset)
+    files = {}
+    for name, paths in inputs.items():
+        for index, path in enumerate(paths if isinstance(paths, list) else [paths]):
+            with open(path, 'rb') as f:
+                files[f'photos/{index}' if name == 'photos' else name] = (os.path.basename(path), f.read())
+    return files
+
+
+def encode_multipart(fields, files):
+    boundary = uuid.uuid4().hex
+    parts = []
+    for name, value in fields.items():
+        parts.append(f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"\r\n\r\n{value}\r\n'.encode())
+    for name, filename, data in files:
+        parts.append(f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"; filename="{filename}"\r\n'
+                     f'Content-Type: application/octet-stream\r\n\r\n'.encode() + data + b'\r\n')
+    parts.append(f'--{boundary}--\r\n'.encode())
+    return b''.join(parts), f'multipart/form-data; boundary={boundary}'
+
+
+class ClientTransport:
+    """Requests through the Flask test client, in this process."""
+
+    def __init__(self, flask_app):
+        self.app = flask_app
+        self._local = threading.local()
+
+    def request(self, method, path, fields=None, files=None):
+        client = getattr(self._local, 'client', None)
+        if client is None:
+            client = self._local.client = self.app.test_client()
+        if method == 'GET':
+            response = client.get(path)
+        else:
+            data = dict(fields or {})
+            for name, filename, content in files or []:
+                data.setdefault(name, []).append((BytesIO(content), filename))
+            response = client.post(path, data=data, content_type='multipart/form-data')
+        body = response.get_data()
+        # Closing runs the app's on-close hooks, as a WSGI server would
+        response.close()
+        return response.status_code, body
+
+
+class HttpTransport:
+    """Requests over HTTP to a running server, one keep-alive connection per thread."""
+
+    def __init__(self, base_url, timeout=600):
+        url = urlsplit(base_url)
+        self.host, self.port = url.hostname, url.port or 80
+        self.prefix = url.path.rstrip('/')
+        self.timeout = timeout
+        self._local = threading.local()
+
+    def request(self, method, path, fields=None, files=None):
+        body, headers = None, {}
+        if method == 'POST':
+            body, headers['Content-Type'] = encode_multipart(fields or {}, files or [])
+        for attempt in range(2):
+            connection = getattr(self._local, 'connection', None)
+            if connection is None:
+                connection = self._local.connection = http.client.HTTPConnection(
+                    self.host, self.port, timeout=self.timeout)
+            try:
+                connection.request(method, self.prefix + path, body=body, headers=headers)
+                response = connection.getresponse()
+                return response.status, response.read()
+            except (http.client.HTTPException, ConnectionError):
+                # The server closed the keep-alive connection; retry once on a new one
+                connection.close()
+                self._local.connection = None
+                if attempt:
+                    raise
+
+
+def run_request(transport, request_type, files, download=True, use_async=False, cache_hits=False):
+    """Send one request of request_type and return whether it succeeded."""
+    path, fields, uploads = REQUEST_TYPES[request_type](
+        {name: data for name, (_, data) in files.items()})
+    if fields is None:
+        status, _ = transport.request('GET', path)
+        return status < 400
+
+    fields = dict(fields, **({'async': '1'} if use_async else {}))
+    parts = []
+    for field, name in uploads:
+        filename, data = files[name]
+        salt = SALTS.get(os.path.splitext(filename)[1].lower())
+        if salt and not cache_hits:
+            data = salt(data)
+        parts.append((field, filename, data))
+    status, body = transport.request('POST', path, fields, parts)
+    payload = json.loads(body) if body[:1] == b'{' else {}
+
+    if use_async and status == 202 and payload.get('resultUrl'):
+        result_url = payload['resultUrl']
+        while True:
+            time.sleep(JOB_POLL_INTERVAL)
+            status, body = transport.request('GET', result_url)
+            payload = json.loads(body)
+            if status != 202:
+                break
+
+    if status >= 400 or not payload.get('success'):
+        return False
+    if download and payload.get('downloadUrl'):
+        status, _ = transport.request('GET', payload['downloadUrl'])
+        return status < 400
+    return True
+
+
+def folder_usage(folder):
+    """(bytes, files) in a folder tree; (0, 0) if it does not exist."""
+    total = count = 0
+    for root, _, names in os.walk(folder):
+        for name in names:
+            try:
+                total += os.path.getsize(os.path.join(root, name))
+                count += 1
+            except OSError:
+                pass  # removed while we looked
+    return total, count
+
+
+def run_level(transport, files, mix, concurrency, duration=None, requests=None, uploads_folder=None,
+              seed=1, **options):
+    """
+    Drive concurrency threads of requests drawn from mix for duration
+    seconds or until requests have been sent, and summarise the results.
+    """
+    names, weights = list(mix), list(mix.values())
+    records = []  # (request type, seconds, ok)
+    lock = threading.Lock()
+    sent = 0
+    errors = {}
+
+    before = folder_usage(uploads_folder) if uploads_folder else None
+    started = time.perf_counter()
+    deadline = started + duration if duration else None
+
+    def worker(index):
+        nonlocal sent
+        rng = random.Random(seed * 1000 + index)
+        while True:
+            with lock:
+                if (requests is not None and sent >= requests) or (deadline and time.perf_counter() >= deadline):
+                    return
+                sent += 1
+            request_type = rng.choices(names, weights)[0]
+            request_started = time.perf_counter()
+            try:
+                ok = run_request(transport, request_type, files, **options)
+            except Exception as e:
+                ok = False
+                message = f"{type(e).__name__}: {str(e)}"
+                with lock:
+                    errors[message] = errors.get(message, 0) + 1
+            with lock:
+                records.append((request_type, time.perf_counter() - request_started, ok))
+
+    threads = [threading.Thread(target=worker, args=(index,), daemon=True) for index in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+    after = folder_usage(uploads_folder) if uploads_folder else None
+
+    by_type = {}
+    for request_type in names:
+        latencies = [seconds for name, seconds, _ in records if name == request_type]
+        if latencies:
+            failed = sum(1 for name, _, ok in records if name == request_type and not ok)
+            by_type[request_type] = {'requests': len(latencies), 'errors': failed,
+                                     'latency': latency_summary(latencies)}
+
+    failed = sum(1 for _, _, ok in records if not ok)
+    return {
+        'concurrency': concurrency,
+        'requests': len(records),
+        'seconds': elapsed,
+        'requestsPerSecond': len(records) / elapsed if elapsed else None,
+        'errorRate': failed / len(records) if records else None,
+        'exceptions': errors,
+        'latency': latency_summary([seconds for _, seconds, _ in records]) if records else None,
+        'byType': by_type,
+        'uploads': {
+            'bytesBefore': before[0], 'bytesAfter': after[0], 'growthBytes': after[0] - before[0],
+            'filesBefore': before[1], 'filesAfter': after[1],
+            'growthBytesPerRequest': (after[0] - before[0]) / len(records) if records else None,
+        } if uploads_folder else None,
+    }
+
+
+def free_port():
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def start_gunicorn(work_dir, workers=2, threads=1, env=None):
+    """Start gunicorn serving main:app from work_dir; returns (process, base URL)."""
+    port = free_port()
+    process = subprocess.Popen(
+        [sys.executable, '-m', 'gunicorn', 'main:app', '--pythonpath', REPO_DIR, '--bind', f'127.0.0.1:{port}',
+         '--workers', str(workers), '--threads', str(threads), '--timeout', '600',
+         '--log-level', 'warning'],
+        cwd=work_dir, env=dict(os.environ, **(env or {})))
+
+    deadline = time.monotonic() + SERVER_STARTUP_TIMEOUT
+    while True:
+        try:
+            with socket.create_connection(('127.0.0.1', port), timeout=1):
+                return process, f'http://127.0.0.1:{port}'
+        except OSError:
+            if process.poll() is not None or time.monotonic() > deadline:
+                process.kill()
+                raise RuntimeError("gunicorn did not start")
+            time.sleep(0.25)
+
+
+def print_level(level):
+    uploads = level['uploads']
+    latency = level['latency'] or {}
+    print(f"concurrency {level['concurrency']:3}: {level['requests']} requests in {level['seconds']:.1f}s, "
+          f"{level['requestsPerSecond']:.2f} req/s, errors {level['errorRate'] * 100:.1f}%, "
+          f"p50 {latency.get('p50', 0) * 1000:.0f} ms, p95 {latency.get('p95', 0) * 1000:.0f} ms, "
+          f"p99 {latency.get('p99', 0) * 1000:.0f} ms"
+          + (f", uploads +{uploads['growthBytes'] / 2 ** 20:.1f} MB ({uploads['filesAfter']} files)"
+             if uploads else ''))
+    for request_type, stats in sorted(level['byType'].items()):
+        print(f"    {request_type:16} {stats['requests']:5} requests  {stats['errors']:3} errors  "
+              f"p50 {stats['latency']['p50'] * 1000:8.0f} ms  p95 {stats['latency']['p95'] * 1000:8.0f} ms")
+    for message, count in level['exceptions'].items():
+        print(f"    {count} x {message}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Load test the web app with concurrent, mixed traffic.')
+    target = parser.add_mutually_exclusive_group()
+    target.add_argument('--url', help='base URL of a running instance (default: the Flask test client)')
+    target.add_argument('--gunicorn', action='store_true', help='start a local gunicorn to test against')
+    parser.add_argument('--workers', type=int, default=2, help='gunicorn workers')
+    parser.add_argument('--threads', type=int, default=1, help='gunicorn threads per worker')
+    parser.add_argument('--uploads', help='upload folder to watch with --url (default: not measured)')
+    parser.add_argument('--work-dir', help='directory the app runs in (default: a fresh temporary one)')
+    parser.add_argument('--profile', choices=sorted(PROFILES), default='mixed', help='traffic profile')
+    parser.add_argument('--mix', type=parse_mix, help='request type weights, e.g. compress-pdf=3,page=1')
+    parser.add_argument('--concurrency', default='1,4', help='comma separated concurrency levels')
+    parser.add_argument('--duration', type=float, help='seconds per level')
+    parser.add_argument('--requests', type=int, help='requests per level (default 50 without --duration)')
+    parser.add_argument('--async', dest='use_async', action='store_true',
+                        help='submit conversions as background jobs and poll them')
+    parser.add_argument('--no-download', dest='download', action='store_false',
+                        help='do not fetch the converted files')
+    parser.add_argument('--cache-hits', action='store_true',
+                        help='upload identical files, so repeats are served from the result cache')
+    parser.add_argument('--preset', default='small', help='benchmark corpus to upload from')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--output', help='results file (default: benchmarks/results/load-<time>.json)')
+    args = parser.parse_args(argv)
+
+    if args.duration is None and args.requests is None:
+        args.requests = 50
+    levels = [int(level) for level in args.concurrency.split(',')]
+    mix = args.mix or PROFILES[args.profile]
+    files = load_corpus(args.preset)
+
+    output = os.path.abspath(args.output or os.path.join(
+        RESULTS_DIR, f"load-{datetime.now().strftime('%Y%m%d-%H%M%S')}.json"))
+    original_dir = os.getcwd()
+    own_work_dir = not args.work_dir and not args.url
+    work_dir = args.work_dir or (tempfile.mkdtemp(prefix='nisq_load_') if not args.url else None)
+    server = None
+    try:
+        if args.url:
+            transport = HttpTransport(args.url)
+            uploads_folder = args.uploads
+        elif args.gunicorn:
+            server, base_url = start_gunicorn(work_dir, args.workers, args.threads)
+            transport = HttpTransport(base_url)
+            uploads_folder = os.path.join(work_dir, 'uploads')
+        else:
+            # app keeps its uploads relative to the working directory
+            os.chdir(work_dir)
+            logging.disable(logging.INFO)
+            from app import app as flask_app
+            transport = ClientTransport(flask_app)
+            uploads_folder = os.path.join(work_dir, 'uploads')
+
+        results = {
+            'createdAt': datetime.now().isoformat(timespec='seconds'),
+            'commit': git_commit(),
+            'target': args.url or ('gunicorn' if args.gunicorn else 'test-client'),
+            'workers': args.workers if args.gunicorn else None,
+            'threads': args.threads if args.gunicorn else None,
+            'mix': mix,
+            'async': args.use_async,
+            'download': args.download,
+            'cacheHits': args.cache_hits,
+            'preset': args.preset,
+            'env': {key: value for key, value in sorted(os.environ.items()) if key.startswith('NISQ_')},
+            'levels': [],
+        }
+        for concurrency in levels:
+            level = run_level(transport, files, mix, concurrency, args.duration, args.requests, uploads_folder,
+                              args.seed, download=args.download, use_async=args.use_async,
+                              cache_hits=args.cache_hits)
+            results['levels'].append(level)
+            print_level(level)
+    finally:
+        if server is not None:
+            server.terminate()
+            try:
+                server.wait(timeout=30)
+            except subprocess.TimeoutExpired:
+                server.kill()
+        os.chdir(original_dir)
+        if own_work_dir:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    os.makedirs(os.path.dirname(output), exist_ok=True)
+    with open(output, 'w') as f:
+        json.dump(results, f, indent=2)
+    print(f"Results written to {output}")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
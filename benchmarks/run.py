@@ -0,0 +1,253 @@
+"""
+Benchmarks for the conversion functions on a synthetic corpus.
+
+    python -m benchmarks.run                            # every case, small corpus
+    python -m benchmarks.run --preset medium --repeat 10 -k compress_file
+    python -m benchmarks.run --compare benchmarks/results/<earlier run>.json
+
+Run from the repository root. Each case runs in a fresh process (so its
+peak memory is its own) for warmup + repeat iterations on private copies
+of the inputs. Results are written as JSON to benchmarks/results/.
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import logging
+import argparse
+import platform
+import resource
+import tempfile
+import subprocess
+from datetime import datetime
+from multiprocessing import get_context
+from concurrent.futures import ProcessPoolExecutor
+from benchmarks.corpus import PRESETS, build_corpus
+from benchmarks.compare import compare_results, print_comparison
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+CORPUS_DIR = os.path.join(BENCHMARKS_DIR, '.corpus')
+RESULTS_DIR = os.path.join(BENCHMARKS_DIR, 'results')
+
+RESULTS_VERSION = 1
+
+WATERMARK = 'CONFIDENTIAL'
+
+
+def half_size_kb(path):
+    return os.path.getsize(path) / 1024 / 2
+
+
+def output_paths(result):
+    """Files a case produced, from whatever the function returned."""
+    if isinstance(result, str):
+        return [result]
+    if isinstance(result, list):
+        return [item['path'] if isinstance(item, dict) else item for item in result]
+    return []
+
+
+def _pdf_to_word(app, path):
+    from utils.pdf_docx import pdf_to_docx
+    output_path = os.path.splitext(path)[0] + '.docx'
+    pdf_to_docx(path, output_path)
+    return output_path
+
+
+def _word_to_pdf(app, path):
+    from utils.doc_utils import word_to_pdf
+    return word_to_pdf(path, os.path.splitext(path)[0] + '.pdf')
+
+
+# name -> (corpus input, call(app module, input path or paths) returning the output(s))
+CASES = {
+    'compress_file/text_pdf': ('text_pdf', lambda app, path: app.compress_file(path, half_size_kb(path))),
+    'compress_file/scanned_pdf': ('scanned_pdf', lambda app, path: app.compress_file(path, half_size_kb(path))),
+    'compress_file/photo_jpeg': ('photo_jpeg', lambda app, path: app.compress_file(path, half_size_kb(path))),
+    'compress_file/photo_png': ('photo_png', lambda app, path: app.compress_file(path, half_size_kb(path))),
+    'compress_file/docx': ('docx', lambda app, path: app.compress_file(path, half_size_kb(path))),
+    'pdf_to_images/text_pdf': ('text_pdf', lambda app, path: app.pdf_to_images(path, dpi=150)),
+    'pdf_to_images/scanned_pdf': ('scanned_pdf', lambda app, path: app.pdf_to_images(path, dpi=150)),
+    'images_to_pdf/photos': ('photos', lambda app, paths: app.images_to_pdf(
+        paths, os.path.join(os.path.dirname(paths[0]), 'photos.pdf'))),
+    'images_to_pdf/photo_png': ('photo_png', lambda app, path: app.images_to_pdf(
+        [path], os.path.splitext(path)[0] + '.pdf')),
+    'add_watermark_to_pdf/text_pdf': ('text_pdf', lambda app, path: app.add_watermark_to_pdf(path, WATERMARK)),
+    'add_watermark_to_pdf/scanned_pdf': ('scanned_pdf', lambda app, path: app.add_watermark_to_pdf(path, WATERMARK)),
+    'pdf_to_word/text_pdf': ('text_pdf', _pdf_to_word),
+    'pdf_to_word/scanned_pdf': ('scanned_pdf', _pdf_to_word),
+    'word_to_pdf/docx': ('docx', _word_to_pdf),
+}
+
+
+def percentile(values, pct):
+    """Linearly interpolated percentile of a non-empty list."""
+    ordered = sorted(values)
+    rank = (len(ordered) - 1) * pct / 100
+    low = int(rank)
+    high = min(low + 1, len(ordered) - 1)
+    return ordered[low] + (ordered[high] - ordered[low]) * (rank - low)
+
+
+def latency_summary(latencies):
+    return {
+        'min': min(latencies),
+        'mean': sum(latencies) / len(latencies),
+        'p50': percentile(latencies, 50),
+        'p90': percentile(latencies, 90),
+        'p95': percentile(latencies, 95),
+        'p99': percentile(latencies, 99),
+        'max': max(latencies),
+    }
+
+
+def peak_rss():
+    """
+    Peak resident memory of this process in bytes. Read from VmHWM where
+    available: ru_maxrss of a spawned process starts at its parent's peak.
+    """
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    from utils.metrics import peak_rss as rusage_peak_rss
+    return rusage_peak_rss()
+
+
+def run_case(name, source, repeat, warmup):
+    """
+    Run one case in this (fresh) process and return its measurements.
+    source is the corpus input, copied to a scratch directory first so
+    outputs written next to it never touch the corpus.
+    """
+    # app logs every step at DEBUG; only keep warnings and errors
+    logging.disable(logging.INFO)
+    import app
+    from utils.metrics import RU_MAXRSS_UNIT, current_rss
+
+    _, call = CASES[name]
+    work_dir = tempfile.mkdtemp(prefix='nisq_bench_')
+    try:
+        sources = source if isinstance(source, list) else [source]
+        copies = [shutil.copy(path, work_dir) for path in sources]
+        target = copies if isinstance(source, list) else copies[0]
+        bytes_in = sum(os.path.getsize(path) for path in copies)
+
+        baseline_rss = current_rss()
+        latencies = []
+        bytes_out = 0
+        for iteration in range(warmup + repeat):
+            started = time.perf_counter()
+            result = call(app, target)
+            seconds = time.perf_counter() - started
+
+            outputs = [path for path in output_paths(result) if path not in copies]
+            bytes_out = sum(os.path.getsize(path) for path in outputs)
+            for path in outputs:
+                os.remove(path)
+            if iteration >= warmup:
+                latencies.append(seconds)
+
+        total = sum(latencies)
+        return {
+            'iterations': repeat,
+            'bytesIn': bytes_in,
+            'bytesOut': bytes_out,
+            'latency': latency_summary(latencies),
+            'opsPerSecond': repeat / total if total else None,
+            'mbPerSecond': bytes_in * repeat / total / (1024 * 1024) if total else None,
+            'baselineRssBytes': baseline_rss,
+            'peakRssBytes': peak_rss(),
+            # Render and DOCX worker processes, if the case used any
+            'peakChildRssBytes': resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * RU_MAXRSS_UNIT or None,
+        }
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              check=True, cwd=BENCHMARKS_DIR).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_benchmarks(preset='small', repeat=5, warmup=1, selected=None, seed=1):
+    """Run the selected cases (all by default) and return the results document."""
+    inputs = build_corpus(os.path.join(CORPUS_DIR, preset), preset, seed)
+    names = [name for name in CASES if not selected or any(pattern in name for pattern in selected)]
+
+    results = {
+        'version': RESULTS_VERSION,
+        'createdAt': datetime.now().isoformat(timespec='seconds'),
+        'commit': git_commit(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+        'preset': preset,
+        'seed': seed,
+        'repeat': repeat,
+        'warmup': warmup,
+        'env': {key: value for key, value in sorted(os.environ.items()) if key.startswith('NISQ_')},
+        'cases': {},
+    }
+
+    for name in names:
+        source = inputs[CASES[name][0]]
+        # A fresh process per case keeps peak memory and imports per case
+        with ProcessPoolExecutor(max_workers=1, mp_context=get_context('spawn')) as executor:
+            try:
+                case = executor.submit(run_case, name, source, repeat, warmup).result()
+            except Exception as e:
+                case = {'error': f"{type(e).__name__}: {str(e)}"}
+        results['cases'][name] = case
+
+        if 'error' in case:
+            print(f"{name:36} ERROR {case['error']}")
+        else:
+            latency = case['latency']
+            print(f"{name:36} p50 {latency['p50'] * 1000:9.1f} ms  p95 {latency['p95'] * 1000:9.1f} ms  "
+                  f"{case['opsPerSecond']:7.2f} ops/s  peak {case['peakRssBytes'] / 2 ** 20:7.1f} MB")
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the conversion functions on a synthetic corpus.')
+    parser.add_argument('--preset', choices=sorted(PRESETS), default='small', help='corpus size')
+    parser.add_argument('--repeat', type=int, default=5, help='measured iterations per case')
+    parser.add_argument('--warmup', type=int, default=1, help='unmeasured iterations per case')
+    parser.add_argument('--seed', type=int, default=1, help='corpus seed')
+    parser.add_argument('-k', dest='selected', action='append',
+                        help='only run cases whose name contains this (repeatable)')
+    parser.add_argument('--output', help='results file (default: benchmarks/results/<time>-<preset>.json)')
+    parser.add_argument('--compare', metavar='BASELINE', help='results file to compare this run against')
+    parser.add_argument('--list', action='store_true', help='list the cases and exit')
+    args = parser.parse_args(argv)
+
+    if args.list:
+        print('\n'.join(CASES))
+        return 0
+
+    results = run_benchmarks(args.preset, max(1, args.repeat), max(0, args.warmup), args.selected, args.seed)
+
+    output = args.output or os.path.join(
+        RESULTS_DIR, f"{datetime.now().strftime('%Y%m%d-%H%M%S')}-{args.preset}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w') as f:
+        json.dump(results, f, indent=2)
+    print(f"Results written to {output}")
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        print_comparison(compare_results(baseline, results))
+    return 1 if any('error' in case for case in results['cases'].values()) else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
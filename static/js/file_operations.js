@@ -27,14 +27,19 @@ function initFormSubmission() {
             // Start simulating progress
             const progressInterval = simulateProgress();
             
-            // Submit form via AJAX
+            // Submit form via AJAX, running the conversion as a background job
             const formData = new FormData(form);
+            formData.append('async', '1');
             
             fetch(form.action, {
                 method: 'POST',
                 body: formData
             })
             .then(response => {
+                // Rejected uploads (too large, wrong file type) explain why in JSON
+                if (response.status === 413 || response.status === 415) {
+                    return response.json();
+                }
                 if (!response.ok) {
                     throw new Error(`HTTP error! Status: ${response.status}`);
                 }
@@ -46,6 +51,7 @@ function initFormSubmission() {
                     throw new Error('Response is not JSON');
                 }
             })
+            .then(data => data.jobId ? waitForJob(data) : data)
             .then(data => {
                 // Clear progress simulation
                 clearInterval(progressInterval);
@@ -86,6 +92,27 @@ function initFormSubmission() {
     }
 }
 
+// Poll a queued job until its result is ready
+function waitForJob(job) {
+    return new Promise((resolve, reject) => {
+        const poll = () => {
+            fetch(job.resultUrl)
+            .then(response => {
+                if (response.status === 202) {
+                    setTimeout(poll, 1000);
+                    return;
+                }
+                if (!response.ok) {
+                    throw new Error(`HTTP error! Status: ${response.status}`);
+                }
+                return response.json().then(resolve);
+            })
+            .catch(reject);
+        };
+        poll();
+    });
+}
+
 // Display operation results
 function displayResults(container, data) {
     container.style.display = 'block';
@@ -153,6 +180,10 @@ function displayResults(container, data) {
                 <span class="result-label">Images Combined:</span>
                 <span class="result-value">${data.imageCount}</span>
             </div>
+            <div class="result-item">
+                <span class="result-label">PDF Size:</span>
+                <span class="result-value">${(data.pdfSize / (1024 * 1024)).toFixed(2)} MB</span>
+            </div>
             <a href="${data.downloadUrl}" class="download-btn">
                 <i class="fas fa-download"></i> Download PDF
             </a>
@@ -177,6 +208,10 @@ function displayResults(container, data) {
                 <span class="result-label">Original File:</span>
                 <span class="result-value">${data.originalFile}</span>
             </div>
+            <div class="result-item">
+                <span class="result-label">Pages Converted:</span>
+                <span class="result-value">${data.pageCount}</span>
+            </div>
             <a href="${data.downloadUrl}" class="download-btn">
                 <i class="fas fa-download"></i> Download Word Document
             </a>
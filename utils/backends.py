@@ -0,0 +1,464 @@
+import os
+import json
+import time
+import fcntl
+import shutil
+import socket
+import logging
+import tempfile
+import threading
+import subprocess
+from utils.lazy_imports import lazy_import
+from utils.metrics import record_backend
+
+fitz = lazy_import('fitz')  # PyMuPDF
+docx = lazy_import('docx')
+Image = lazy_import('PIL.Image')
+
+# Consecutive failures (where another backend then succeeded) after which
+# a backend is taken out of rotation
+MAX_FAILURES = int(os.environ.get('NISQ_BACKEND_MAX_FAILURES', 3))
+
+# Seconds a probe or calibration run may take
+PROBE_TIMEOUT = float(os.environ.get('NISQ_BACKEND_PROBE_TIMEOUT', 60))
+
+# Seconds probe results saved to the state file are reused by other processes
+STATE_MAX_AGE = float(os.environ.get('NISQ_BACKEND_STATE_SECONDS', 24 * 3600))
+
+
+class BackendDeclined(Exception):
+    """
+    Raised by a backend that ran fine but could not meet the request (e.g.
+    a size target); the next backend is tried without counting a failure.
+    result, if given, is the best-effort output the backend did write; it
+    is used when no backend meets the request.
+    """
+
+    def __init__(self, message, result=None):
+        super().__init__(message)
+        self.result = result
+
+
+class Backend:
+    """
+    One engine able to perform an operation.
+
+    convert does the work; probe returns whether the engine is usable here
+    (binary installed, module importable); calibrate(work_dir) runs the
+    engine on a small sample so backends can be ranked by speed. Fallback
+    backends produce a degraded result (or cost much more memory) and are
+    only used once every other backend is unavailable or has failed. Costly
+    backends (slow to start, like LibreOffice) are only calibrated by a
+    full probe; a lazy one just checks they are available.
+    """
+
+    def __init__(self, operation, name, convert, probe=None, calibrate=None, fallback=False, costly=False):
+        self.operation = operation
+        self.costly = costly
+        self.name = name
+        self.convert = convert
+        self.probe = probe
+        self.calibrate = calibrate
+        self.fallback = fallback
+        self.available = None  # unknown until probed
+        self.calibration_seconds = None
+        self.calls = 0
+        self.failures = 0
+        self.consecutive_failures = 0
+        self.busy_seconds = 0.0
+
+    def stats(self):
+        return {
+            'name': self.name,
+            'available': self.available,
+            'fallback': self.fallback,
+            'calibrationSeconds': round(self.calibration_seconds, 4) if self.calibration_seconds is not None else None,
+            'calls': self.calls,
+            'failures': self.failures,
+            'averageSeconds': round(self.busy_seconds / self.calls, 4) if self.calls else None,
+        }
+
+
+class BackendRegistry:
+    """
+    Backends per operation, probed and calibrated once per operation on
+    first use (or all up front with probe()), and tried fastest first.
+
+    With state_path set, probe results are saved there and reused by every
+    other process on the host (gunicorn workers, job workers) for
+    STATE_MAX_AGE seconds, so calibration runs once rather than per process.
+
+    NISQ_BACKEND_<OPERATION>=name,name pins the order for an operation
+    (e.g. NISQ_BACKEND_PDF_COMPRESS=ghostscript).
+    """
+
+    def __init__(self, state_path=None):
+        self.state_path = state_path
+        self._backends = {}  # operation -> [Backend] in registration order
+        self._probed = set()
+        self._lock = threading.Lock()
+
+    def register(self, operation, name, convert, probe=None, calibrate=None, fallback=False, costly=False):
+        backend = Backend(operation, name, convert, probe, calibrate, fallback, costly)
+        self._backends.setdefault(operation, []).append(backend)
+        return backend
+
+    def _calibrated(self, operation):
+        """Whether every available costly backend of an operation has been calibrated."""
+        return all(backend.calibration_seconds is not None for backend in self._backends.get(operation, [])
+                   if backend.costly and backend.available and backend.calibrate)
+
+    def _probe_operation(self, operation, work_dir, full):
+        for backend in self._backends.get(operation, []):
+            try:
+                backend.available = backend.probe() if backend.probe else True
+            except Exception as e:
+                logging.info(f"Backend {operation}/{backend.name} is not usable: {str(e)}")
+                backend.available = False
+            if not backend.available or not backend.calibrate or (backend.costly and not full):
+                continue
+
+            try:
+                started = time.perf_counter()
+                backend.calibrate(work_dir)
+                backend.calibration_seconds = time.perf_counter() - started
+                logging.info(f"Backend {operation}/{backend.name} calibrated in "
+                             f"{backend.calibration_seconds:.3f}s")
+            except Exception as e:
+                logging.warning(f"Backend {operation}/{backend.name} failed calibration: {str(e)}")
+                backend.available = False
+
+    def _read_state(self):
+        """Saved probe results per operation, if the state file is from this host."""
+        try:
+            with open(self.state_path) as f:
+                state = json.load(f)
+        except (OSError, ValueError):
+            return {}
+        return state.get('operations', {}) if state.get('host') == socket.gethostname() else {}
+
+    def _load_state(self, operations, full):
+        """
+        Apply saved probe results for operations; returns the operations
+        that were found fresh (and with every registered backend) in the
+        state file. For a full probe, results without the costly
+        calibrations do not count.
+        """
+        saved_operations = self._read_state()
+        loaded = set()
+        for operation in operations:
+            saved = saved_operations.get(operation)
+            backends = self._backends.get(operation, [])
+            if not saved or time.time() - saved['probedAt'] > STATE_MAX_AGE:
+                continue
+            if not backends or any(backend.name not in saved['backends'] for backend in backends):
+                continue
+            for backend in backends:
+                backend.available = saved['backends'][backend.name]['available']
+                backend.calibration_seconds = saved['backends'][backend.name]['calibrationSeconds']
+            if full and not self._calibrated(operation):
+                continue
+            loaded.add(operation)
+        return loaded
+
+    def _save_state(self, operations):
+        """Add the probe results of operations to the state file."""
+        saved_operations = self._read_state()
+        for operation in operations:
+            saved_operations[operation] = {
+                'probedAt': time.time(),
+                'backends': {backend.name: {'available': backend.available,
+                                            'calibrationSeconds': backend.calibration_seconds}
+                             for backend in self._backends.get(operation, [])},
+            }
+        temp_path = f"{self.state_path}.{os.getpid()}.tmp"
+        with open(temp_path, 'w') as f:
+            json.dump({'host': socket.gethostname(), 'operations': saved_operations}, f)
+        os.replace(temp_path, self.state_path)
+
+    def _probe_pending(self, pending, full):
+        work_dir = tempfile.mkdtemp(prefix='nisq_calibrate_')
+        try:
+            # Build the samples up front so no backend's timing pays for them
+            sample_pdf(work_dir)
+            sample_docx(work_dir)
+            for operation in pending:
+                self._probe_operation(operation, work_dir, full)
+                self._probed.add(operation)
+        finally:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    def probe(self, operations=None, full=False):
+        """
+        Probe and calibrate backends (of every operation by default) that
+        were not yet. Costly backends are only calibrated when full is set,
+        as done at start-up (python -m utils.backends, NISQ_PROBE_BACKENDS=1);
+        lazy probes on first use reuse those results from the state file.
+        """
+        with self._lock:
+            pending = [op for op in (operations or self._backends)
+                       if op not in self._probed or (full and not self._calibrated(op))]
+            if not pending:
+                return
+            if not self.state_path:
+                self._probe_pending(pending, full)
+                return
+
+            # Processes starting together wait here for the first one's results
+            with open(self.state_path + '.lock', 'a') as lock_file:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+                loaded = self._load_state(pending, full)
+                self._probed.update(loaded)
+                pending = [op for op in pending if op not in loaded]
+                if pending:
+                    self._probe_pending(pending, full)
+                    try:
+                        self._save_state(pending)
+                    except OSError as e:
+                        logging.warning(f"Could not save backend probe results: {str(e)}")
+
+    def ranked(self, operation, prefer=None):
+        """
+        Usable backends for an operation, in the order they should be tried.
+        The prefer backend, if given and usable, goes first.
+        """
+        self.probe([operation])
+        backends = [b for b in self._backends.get(operation, [])
+                    if b.available and b.consecutive_failures < MAX_FAILURES]
+
+        # Full-fidelity engines first, fastest first; unmeasured ones after measured ones
+        backends.sort(key=lambda b: (b.fallback, b.calibration_seconds is None, b.calibration_seconds or 0))
+
+        pinned = os.environ.get('NISQ_BACKEND_' + operation.upper().replace('-', '_'))
+        order = [name.strip() for name in pinned.split(',')] if pinned else []
+        if prefer and prefer not in order:
+            order.insert(0, prefer)
+        if order:
+            backends.sort(key=lambda b: order.index(b.name) if b.name in order else len(order))
+        return backends
+
+    def run(self, operation, *args, prefer=None, **kwargs):
+        """
+        Perform an operation with the best backend, falling back to the next
+        one on failure. Returns (backend name, result of its convert).
+        """
+        backends = self.ranked(operation, prefer)
+        if not backends:
+            raise RuntimeError(f"No backend available for {operation}")
+
+        last_error = None
+        best_effort = None
+        failed = []
+        for backend in backends:
+            started = time.perf_counter()
+            try:
+                result = backend.convert(*args, **kwargs)
+            except BackendDeclined as e:
+                record_backend(operation, backend.name, 'declined', time.perf_counter() - started)
+                last_error = e
+                if e.result is not None:
+                    best_effort = (backend.name, e.result)
+                logging.info(f"Backend {operation}/{backend.name} declined: {str(e)}")
+                continue
+            except Exception as e:
+                record_backend(operation, backend.name, 'failed', time.perf_counter() - started)
+                backend.failures += 1
+                failed.append(backend)
+                last_error = e
+                logging.warning(f"Backend {operation}/{backend.name} failed: {str(e)}")
+                continue
+            seconds = time.perf_counter() - started
+            record_backend(operation, backend.name, 'ok', seconds)
+            backend.calls += 1
+            backend.consecutive_failures = 0
+            backend.busy_seconds += seconds
+            # Only count it against the engines that failed where another
+            # succeeded; when every backend fails the input is likely at fault
+            for failed_backend in failed:
+                failed_backend.consecutive_failures += 1
+                if failed_backend.consecutive_failures == MAX_FAILURES:
+                    logging.warning(f"Taking backend {operation}/{failed_backend.name} out of rotation")
+            return backend.name, result
+        if best_effort is not None and isinstance(last_error, BackendDeclined):
+            logging.info(f"No backend met the {operation} request, keeping {best_effort[0]}'s result")
+            return best_effort
+        raise last_error
+
+    def stats(self):
+        """State of every backend; operations not used yet show as unprobed (available None)."""
+        return {operation: [backend.stats() for backend in backends]
+                for operation, backends in self._backends.items()}
+
+
+def sample_pdf(work_dir):
+    """A two-page PDF with text and a photo-like image, for calibration runs."""
+    path = os.path.join(work_dir, 'sample.pdf')
+    if not os.path.exists(path):
+        image_path = sample_image(work_dir)
+        with fitz.open() as doc:
+            for page_num in range(2):
+                page = doc.new_page()
+                page.insert_text((72, 72), f"Calibration page {page_num + 1}\n" + "Lorem ipsum dolor sit amet. " * 3)
+                page.insert_image(fitz.Rect(72, 120, 472, 420), filename=image_path)
+            doc.save(path)
+    return path
+
+
+def sample_image(work_dir):
+    path = os.path.join(work_dir, 'sample.jpg')
+    if not os.path.exists(path):
+        gradient = Image.linear_gradient('L').resize((600, 400))
+        Image.merge('RGB', (gradient, gradient.rotate(90, expand=False), gradient.transpose(Image.FLIP_LEFT_RIGHT))) \
+            .save(path, 'JPEG', quality=90)
+    return path
+
+
+def sample_docx(work_dir):
+    path = os.path.join(work_dir, 'sample.docx')
+    if not os.path.exists(path):
+        document = docx.Document()
+        document.add_heading('Calibration', 1)
+        for _ in range(5):
+            document.add_paragraph('Lorem ipsum dolor sit amet, consectetur adipiscing elit. ' * 4)
+        document.save(path)
+    return path
+
+
+# --- Backends shipped with the app ---
+
+def _ghostscript_probe():
+    from utils.file_operations import find_ghostscript
+    gs_path = find_ghostscript()
+    if not gs_path:
+        return False
+    subprocess.run([gs_path, '--version'], check=True, capture_output=True, timeout=PROBE_TIMEOUT)
+    return True
+
+
+def _ghostscript_compress(input_path, output_path, target_size_mb=None):
+    from utils.file_operations import find_ghostscript, run_gs_presets
+    # Without a target the first (best) preset that works is kept
+    target = target_size_mb if target_size_mb is not None else float('inf')
+    preset = run_gs_presets(find_ghostscript(), input_path, output_path, target)
+    if not preset:
+        raise BackendDeclined("No Ghostscript preset met the target")
+    return {'engine': 'ghostscript', 'preset': preset, 'size': os.path.getsize(output_path)}
+
+
+def _pymupdf_compress(input_path, output_path, target_size_mb=None):
+    from utils.pdf_compress import compress_pdf_native
+    stats = compress_pdf_native(input_path, output_path, target_size_mb)
+    if target_size_mb is not None and stats['size'] > target_size_mb * 1024 * 1024:
+        raise BackendDeclined("PyMuPDF could not reach the target size", result=stats)
+    return stats
+
+
+def _calibrate_compress(convert):
+    def calibrate(work_dir):
+        convert(sample_pdf(work_dir), os.path.join(work_dir, 'compressed.pdf'))
+    return calibrate
+
+
+def _libreoffice_probe():
+    from utils.office_pool import find_soffice
+    return find_soffice() is not None
+
+
+def _libreoffice_word_to_pdf(input_path, output_path):
+    from utils.office_pool import office_to_pdf
+    return office_to_pdf(input_path, output_path)
+
+
+def _text_word_to_pdf(input_path, output_path):
+    from utils.doc_utils import word_to_pdf_text
+    return word_to_pdf_text(input_path, output_path)
+
+
+def _calibrate_word_to_pdf(convert):
+    def calibrate(work_dir):
+        convert(sample_docx(work_dir), os.path.join(work_dir, 'word.pdf'))
+    return calibrate
+
+
+def _streaming_images_to_pdf(image_paths, output_path):
+    from utils.pdf_writer import write_images_pdf
+    return write_images_pdf(image_paths, output_path)
+
+
+def _img2pdf_images_to_pdf(image_paths, output_path):
+    import img2pdf
+    with open(output_path, 'wb') as f:
+        img2pdf.convert(image_paths, outputstream=f)
+    return [{'path': path, 'bytes': os.path.getsize(path)} for path in image_paths]
+
+
+def _img2pdf_probe():
+    import img2pdf  # noqa: F401
+    return True
+
+
+def _calibrate_images_to_pdf(convert):
+    def calibrate(work_dir):
+        convert([sample_image(work_dir)] * 4, os.path.join(work_dir, 'images.pdf'))
+    return calibrate
+
+
+def _pdf2docx_probe():
+    import pdf2docx  # noqa: F401
+    return True
+
+
+def _pdf2docx_convert(input_path, output_path, parallel=None, text_fallback=False):
+    from utils.pdf_docx import pdf_to_docx
+    return pdf_to_docx(input_path, output_path, parallel=parallel, text_fallback=text_fallback)
+
+
+def _text_pdf_to_docx(input_path, output_path, parallel=None, text_fallback=False):
+    from utils.pdf_docx import TEXT, convert_segment
+    with fitz.open(input_path) as doc:
+        page_count = len(doc)
+    convert_segment(input_path, output_path, TEXT, 0, page_count)
+    return {'pages': page_count, 'segments': 1, 'textPages': page_count}
+
+
+def _calibrate_pdf_to_docx(convert):
+    def calibrate(work_dir):
+        convert(sample_pdf(work_dir), os.path.join(work_dir, 'converted.docx'), parallel=False)
+    return calibrate
+
+
+backends = BackendRegistry()
+
+backends.register('pdf-compress', 'ghostscript', _ghostscript_compress, _ghostscript_probe,
+                  _calibrate_compress(_ghostscript_compress))
+backends.register('pdf-compress', 'pymupdf', _pymupdf_compress, None, _calibrate_compress(_pymupdf_compress))
+
+backends.register('word-to-pdf', 'libreoffice', _libreoffice_word_to_pdf, _libreoffice_probe,
+                  _calibrate_word_to_pdf(_libreoffice_word_to_pdf), costly=True)
+backends.register('word-to-pdf', 'text', _text_word_to_pdf, None, None, fallback=True)
+
+backends.register('images-to-pdf', 'streaming', _streaming_images_to_pdf, None,
+                  _calibrate_images_to_pdf(_streaming_images_to_pdf))
+# img2pdf holds every image in memory until the PDF is written
+backends.register('images-to-pdf', 'img2pdf', _img2pdf_images_to_pdf, _img2pdf_probe,
+                  _calibrate_images_to_pdf(_img2pdf_images_to_pdf), fallback=True)
+
+backends.register('pdf-to-docx', 'pdf2docx', _pdf2docx_convert, _pdf2docx_probe,
+                  _calibrate_pdf_to_docx(_pdf2docx_convert))
+backends.register('pdf-to-docx', 'text', _text_pdf_to_docx, None, None, fallback=True)
+
+
+def run_backend(operation, *args, **kwargs):
+    """Perform an operation on the best available backend; see BackendRegistry.run."""
+    return backends.run(operation, *args, **kwargs)
+
+
+if __name__ == '__main__':
+    # Probe and calibrate every backend, costly ones included, and save the
+    # results for the app's processes: python -m utils.backends [state file]
+    import sys
+    logging.basicConfig(level=logging.INFO)
+    backends.state_path = sys.argv[1] if len(sys.argv) > 1 else os.path.join('uploads', '.backends.json')
+    os.makedirs(os.path.dirname(os.path.abspath(backends.state_path)), exist_ok=True)
+    backends.probe(full=True)
+    print(json.dumps(backends.stats(), indent=2))
@@ -0,0 +1,101 @@
+import os
+import uuid
+import logging
+import zipfile
+import posixpath
+from werkzeug.utils import secure_filename
+from utils.result_cache import CHUNK_SIZE
+
+
+def split_budget(sizes, total_bytes):
+    """
+    Share a total byte budget between files in proportion to their size.
+
+    Files whose share would be larger than the file itself keep their size
+    and the rest is shared again between the others (water filling).
+    Returns the per-file budgets in the same order as sizes.
+    """
+    budgets = [None] * len(sizes)
+    remaining = list(range(len(sizes)))
+    left = total_bytes
+
+    while remaining:
+        remaining_size = sum(sizes[i] for i in remaining)
+        if remaining_size <= 0:
+            break
+        fits = [i for i in remaining if sizes[i] <= left * sizes[i] / remaining_size]
+        if not fits:
+            for i in remaining:
+                budgets[i] = int(left * sizes[i] / remaining_size)
+            break
+        for i in fits:
+            budgets[i] = sizes[i]
+            left -= sizes[i]
+        remaining = [i for i in remaining if i not in fits]
+
+    return [budget if budget is not None else size for budget, size in zip(budgets, sizes)]
+
+
+def unique_names(names):
+    """Make archive entry names unique by numbering repeats (a.jpg, a_2.jpg)."""
+    used = set()
+    result = []
+    for name in names:
+        root, ext = os.path.splitext(name)
+        candidate, count = name, 1
+        while candidate.lower() in used:
+            count += 1
+            candidate = f"{root}_{count}{ext}"
+        used.add(candidate.lower())
+        result.append(candidate)
+    return result
+
+
+def extract_zip_members(zip_path, folder, allowed_extensions, max_member_bytes=None, max_total_bytes=None):
+    """
+    Expand the files of an uploaded ZIP into folder, one entry at a time.
+
+    Entries that are directories, hidden, of a type not in allowed_extensions
+    or larger than max_member_bytes are skipped, and extraction stops once
+    max_total_bytes have been written. Sizes are enforced on the bytes
+    actually read, not the sizes the archive claims.
+
+    Returns a list of (original name, extracted path).
+    """
+    extracted = []
+    total = 0
+
+    with zipfile.ZipFile(zip_path) as archive:
+        for info in archive.infolist():
+            name = posixpath.basename(info.filename)
+            extension = name.rsplit('.', 1)[1].lower() if '.' in name else ''
+            if info.is_dir() or not name or name.startswith('.') or extension not in allowed_extensions:
+                continue
+            if max_member_bytes is not None and info.file_size > max_member_bytes:
+                logging.warning(f"Skipping {info.filename} in {zip_path}: too large")
+                continue
+
+            path = os.path.join(folder, f"{uuid.uuid4()}_{secure_filename(name)}")
+            written = 0
+            over_limit = False
+            with archive.open(info) as source, open(path, 'wb') as f:
+                for chunk in iter(lambda: source.read(CHUNK_SIZE), b''):
+                    written += len(chunk)
+                    if (max_member_bytes is not None and written > max_member_bytes) or \
+                            (max_total_bytes is not None and total + written > max_total_bytes):
+                        over_limit = True
+                        break
+                    f.write(chunk)
+
+            if over_limit:
+                os.remove(path)
+                logging.warning(f"Stopped extracting {info.filename} from {zip_path}: size limit reached")
+                if max_total_bytes is not None and total + written > max_total_bytes:
+                    break
+                continue
+
+            total += written
+            extracted.append((name, path))
+
+    return extracted
+
@@ -1,48 +1,36 @@
 import os
-import subprocess
 import uuid
-import tempfile
 import logging
-from docx import Document
-import fitz  # PyMuPDF
+from utils.lazy_imports import lazy_import
 
-def word_to_pdf(doc_path):
+docx = lazy_import('docx')
+fitz = lazy_import('fitz')  # PyMuPDF
+
+def word_to_pdf(doc_path, output_path=None):
     """
     Convert a Word document to PDF.
+    Uses the best available backend (LibreOffice pool when installed),
+    falling back to a text-only rendering.
     Returns the path to the created PDF file.
     """
+    from utils.backends import run_backend
+    
     if not os.path.exists(doc_path):
         raise FileNotFoundError(f"Word document not found: {doc_path}")
     
-    output_dir = os.path.dirname(doc_path)
-    output_filename = f"{uuid.uuid4()}.pdf"
-    output_path = os.path.join(output_dir, output_filename)
-    
-    # Try using LibreOffice if available (common in Linux environments)
-    try:
-        # Create a temporary directory for LibreOffice conversion
-        temp_dir = tempfile.mkdtemp()
-        
-        # Run LibreOffice headless conversion
-        subprocess.run([
-            "libreoffice", "--headless", "--convert-to", "pdf",
-            "--outdir", temp_dir, doc_path
-        ], check=True, stderr=subprocess.PIPE)
-        
-        # LibreOffice keeps the original filename, just changes extension
-        base_name = os.path.basename(doc_path)
-        name_without_ext = os.path.splitext(base_name)[0]
-        libreoffice_output = os.path.join(temp_dir, f"{name_without_ext}.pdf")
-        
-        # Copy to our output location with UUID filename
-        if os.path.exists(libreoffice_output):
-            with open(libreoffice_output, 'rb') as src, open(output_path, 'wb') as dst:
-                dst.write(src.read())
-            return output_path
-    except Exception as e:
-        logging.warning(f"LibreOffice conversion failed: {str(e)}")
+    if output_path is None:
+        output_dir = os.path.dirname(doc_path)
+        output_filename = f"{uuid.uuid4()}.pdf"
+        output_path = os.path.join(output_dir, output_filename)
     
-    # Fallback method using python-docx and reportlab
+    run_backend('word-to-pdf', doc_path, output_path)
+    return output_path
+
+def word_to_pdf_text(doc_path, output_path):
+    """
+    Render the paragraphs of a Word document to PDF with reportlab.
+    Layout, images and tables are lost; used when LibreOffice is not available.
+    """
     try:
         from reportlab.lib.pagesizes import letter
         from reportlab.platypus import SimpleDocTemplate, Paragraph, Spacer
@@ -50,7 +38,7 @@ def word_to_pdf(doc_path):
         from reportlab.lib.units import inch
         
         # Extract text from the Word document
-        doc = Document(doc_path)
+        doc = docx.Document(doc_path)
         
         # Create a PDF with the extracted text
         pdf_document = SimpleDocTemplate(output_path, pagesize=letter)
@@ -81,6 +69,30 @@ def word_to_pdf(doc_path):
         logging.error(f"Fallback conversion failed: {str(e)}")
         raise
 
+def add_page_text(word_doc, page):
+    """
+    Add the text of a PDF page to a Word document, one paragraph per text block.
+    """
+    try:
+        # First try to get structured blocks
+        blocks = page.get_text("blocks")
+        
+        # Process each text block
+        for block in blocks:
+            if len(block) >= 5:  # Make sure the block has enough elements
+                text = block[4]  # The text content is at index 4
+                if text and text.strip():  # Skip empty blocks
+                    # Add the text to the Word document
+                    word_doc.add_paragraph(text.strip())
+            
+    except Exception as block_error:
+        logging.warning(f"Error getting text blocks: {str(block_error)}")
+        # Fallback to simple text extraction
+        text = page.get_text()
+        for paragraph in text.split('\n\n'):
+            if paragraph.strip():
+                word_doc.add_paragraph(paragraph.strip())
+
 def pdf_to_word(pdf_path):
     """
     Extract text from a PDF and create a Word document.
@@ -98,7 +110,7 @@ def pdf_to_word(pdf_path):
         doc = fitz.open(pdf_path)
         
         # Create a new Word document
-        word_doc = Document()
+        word_doc = docx.Document()
         
         # Add a title to the document
         original_filename = os.path.basename(pdf_path)
@@ -112,25 +124,7 @@ def pdf_to_word(pdf_path):
             word_doc.add_heading(f"Page {page_num + 1}", level=1)
             
             # Get text content
-            try:
-                # First try to get structured blocks
-                blocks = page.get_text("blocks")
-                
-                # Process each text block
-                for block in blocks:
-                    if len(block) >= 5:  # Make sure the block has enough elements
-                        text = block[4]  # The text content is at index 4
-                        if text and text.strip():  # Skip empty blocks
-                            # Add the text to the Word document
-                            word_doc.add_paragraph(text.strip())
-                    
-            except Exception as block_error:
-                logging.warning(f"Error getting text blocks: {str(block_error)}")
-                # Fallback to simple text extraction
-                text = page.get_text()
-                for paragraph in text.split('\n\n'):
-                    if paragraph.strip():
-                        word_doc.add_paragraph(paragraph.strip())
+            add_page_text(word_doc, page)
             
             # Add a page break after each page (except the last)
             if page_num < len(doc) - 1:
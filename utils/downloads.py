@@ -0,0 +1,49 @@
+import os
+import re
+import hashlib
+import threading
+from collections import OrderedDict
+from utils.result_cache import CHUNK_SIZE
+
+# Artifacts are written once under a fresh UUID prefix and never modified
+IMMUTABLE_NAME = re.compile(r'^[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}_')
+
+# One year, the longest lifetime caches are expected to honour
+IMMUTABLE_MAX_AGE = 365 * 24 * 3600
+
+# How many artifact hashes to remember
+ETAG_CACHE_SIZE = 1024
+
+_etags = OrderedDict()
+_etags_lock = threading.Lock()
+
+
+def is_immutable(filename):
+    return bool(IMMUTABLE_NAME.match(filename))
+
+
+def content_etag(path):
+    """
+    SHA-256 of a file's contents, for use as its ETag.
+
+    Hashes are remembered per (path, size, mtime), so an artifact is only
+    read once no matter how often it is downloaded.
+    """
+    stat = os.stat(path)
+    key = (path, stat.st_size, stat.st_mtime_ns)
+    with _etags_lock:
+        if key in _etags:
+            _etags.move_to_end(key)
+            return _etags[key]
+
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+            digest.update(chunk)
+    etag = digest.hexdigest()
+
+    with _etags_lock:
+        _etags[key] = etag
+        while len(_etags) > ETAG_CACHE_SIZE:
+            _etags.popitem(last=False)
+    return etag
@@ -1,10 +1,31 @@
 import os
+import fcntl
 import logging
 import tempfile
-from PIL import Image
-import PyPDF2
 import shutil
 import subprocess
+import time
+from utils.image_utils import IMAGE_FORMATS
+from utils.office_utils import OOXML_EXTENSIONS, compress_ooxml
+from utils.size_predictor import predict_target_size
+from utils.lazy_imports import lazy_import
+from utils.backends import run_backend
+from utils.metrics import stage
+
+Image = lazy_import('PIL.Image')
+PyPDF2 = lazy_import('PyPDF2')
+
+# Ghostscript presets from highest to lowest quality
+GS_PRESETS = ['/printer', '/default', '/ebook', '/screen']
+
+# Ghostscript processes allowed at once across every process on the host
+GS_MAX_PROCS = max(1, int(os.environ.get('NISQ_GS_MAX_PROCS', os.cpu_count() or 2)))
+
+# Lock files standing for the Ghostscript slots, shared by all web and job workers
+GS_SLOT_DIR = os.environ.get('NISQ_GS_SLOT_DIR', os.path.join('uploads', '.gs_slots'))
+
+# Seconds a whole preset search may take before it is abandoned
+GS_TIMEOUT = float(os.environ.get('NISQ_GS_TIMEOUT', 120))
 
 def get_file_size(file_path, unit='MB'):
     """Get the size of a file in the specified unit."""
@@ -53,24 +74,12 @@ def compress_file(file_path, target_size_mb):
         return compress_image(file_path, output_path, target_size_mb)
     elif file_extension == '.pdf':
         return compress_pdf(file_path, output_path, target_size_mb)
-    elif file_extension in ['.doc', '.docx']:
-        # For Word docs, convert to PDF and then compress
-        try:
-            from utils.doc_utils import word_to_pdf
-            logging.info("Converting Word document to PDF for compression")
-            temp_pdf = word_to_pdf(file_path)
-            pdf_output_path = output_path.replace(file_extension, '.pdf')
-            compressed_pdf = compress_pdf(temp_pdf, pdf_output_path, target_size_mb)
-            try:
-                os.remove(temp_pdf)  # Clean up temporary PDF
-            except Exception as e:
-                logging.warning(f"Failed to remove temp PDF: {str(e)}")
-            return compressed_pdf
-        except Exception as e:
-            logging.error(f"Error compressing Word document: {str(e)}")
-            # If conversion fails, create a copy of the original
-            shutil.copy(file_path, output_path)
-            return output_path
+    elif file_extension in OOXML_EXTENSIONS:
+        # Same as app.compress_file: recompress the media inside the package
+        stats = compress_ooxml(file_path, output_path, target_size_mb)
+        logging.info(f"Compressed Office document saved to {output_path} "
+                     f"({stats['recompressed']}/{stats['images']} images recompressed)")
+        return output_path
     else:
         # For unsupported types, just create a copy
         shutil.copy(file_path, output_path)
@@ -78,7 +87,7 @@ def compress_file(file_path, target_size_mb):
         return output_path
 
 def compress_image(input_path, output_path, target_size_mb):
-    """Compress an image to target size by reducing quality"""
+    """Compress an image to target size using a sampled size prediction"""
     # Ensure output path has correct extension
     root, ext = os.path.splitext(output_path)
     if not ext:
@@ -87,55 +96,22 @@ def compress_image(input_path, output_path, target_size_mb):
     
     try:
         img = Image.open(input_path)
+        fmt = IMAGE_FORMATS.get(ext.lower(), img.format or 'JPEG')
         
-        # If image is not in RGB/RGBA mode and is not supported by compression formats
-        if img.mode not in ['RGB', 'RGBA'] and ext.lower() in ['.jpg', '.jpeg']:
-            img = img.convert('RGB')
-        
-        # Start with quality 90 and gradually reduce until reaching target size
-        quality = 90
-        min_quality = 20  # Don't go below this quality
+        # Quality 20-90, then dimensions down to 30% of the original
+        result = predict_target_size(img, fmt, int(target_size_mb * 1024 * 1024),
+                                     min_quality=20, max_quality=90, min_scale=0.3)
         
-        while quality >= min_quality:
-            # Save with current quality settings
-            img.save(output_path, optimize=True, quality=quality)
-            
-            # Check current size
-            current_size = get_file_size(output_path)
-            
-            if current_size <= target_size_mb:
-                return output_path
-            
-            # Reduce quality and try again
-            quality -= 10
+        # Write only the winning encode
+        with open(output_path, 'wb') as f:
+            f.write(result['data'])
         
-        # If still too large, try reducing the dimensions
-        original_width, original_height = img.size
-        scale_factor = 0.9  # Start with 90% of original size
-        min_scale = 0.3  # Don't go below 30% of original size
+        logging.info(f"Image compressed in {result['passes']} encode passes "
+                     f"(quality {result['quality']}, scale {result['scale']:.2f})")
         
-        while scale_factor >= min_scale:
-            # Calculate new dimensions
-            new_width = int(original_width * scale_factor)
-            new_height = int(original_height * scale_factor)
-            
-            # Resize image
-            resized_img = img.resize((new_width, new_height), Image.LANCZOS)
-            
-            # Save with current quality and size
-            resized_img.save(output_path, optimize=True, quality=quality)
-            
-            # Check current size
-            current_size = get_file_size(output_path)
-            
-            if current_size <= target_size_mb:
-                return output_path
-            
-            # Reduce scale and try again
-            scale_factor -= 0.1
-        
-        # If we still couldn't compress enough, return the smallest version we created
-        logging.warning(f"Could not compress image to target size of {target_size_mb}MB")
+        if not result['fits']:
+            # We still couldn't compress enough, this is the smallest version we created
+            logging.warning(f"Could not compress image to target size of {target_size_mb}MB")
         return output_path
         
     except Exception as e:
@@ -144,72 +120,162 @@ def compress_image(input_path, output_path, target_size_mb):
         shutil.copy(input_path, output_path)
         return output_path
 
+def find_ghostscript():
+    """Path to the Ghostscript executable (GHOSTSCRIPT_PATH or the PATH), or None."""
+    return os.environ.get('GHOSTSCRIPT_PATH') or shutil.which('gs') or shutil.which('gswin64c')
+
+def acquire_gs_slot():
+    """
+    Take a free Ghostscript slot without waiting: returns the locked slot
+    file, to be passed to release_gs_slot, or None if every slot is taken.
+    The lock is dropped by the OS if the holder dies.
+    """
+    os.makedirs(GS_SLOT_DIR, exist_ok=True)
+    for index in range(GS_MAX_PROCS):
+        slot = open(os.path.join(GS_SLOT_DIR, f"{index}.lock"), 'a')
+        try:
+            fcntl.flock(slot, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            return slot
+        except BlockingIOError:
+            slot.close()
+    return None
+
+def release_gs_slot(slot):
+    slot.close()
+
+def gs_command(gs_path, preset, input_path, output_path):
+    """Ghostscript pdfwrite command line for one PDFSETTINGS preset."""
+    return [
+        gs_path, '-sDEVICE=pdfwrite', '-dCompatibilityLevel=1.4',
+        f'-dPDFSETTINGS={preset}', '-dNOPAUSE', '-dQUIET', '-dBATCH',
+        f'-sOutputFile={output_path}', input_path
+    ]
+
+@stage('subprocess')
+def run_gs_presets(gs_path, input_path, output_path, target_size_mb, presets=None, timeout=None):
+    """
+    Run Ghostscript presets concurrently and keep the best one that fits.
+
+    Presets are ordered from highest to lowest quality. They are started
+    together (within the host-wide NISQ_GS_MAX_PROCS limit), and as soon as the
+    highest-quality preset that can still win is known to fit the target,
+    the remaining processes are killed. On timeout the best preset that has
+    already fitted wins. Returns the winning preset, or None if no preset
+    produced a file within target_size_mb.
+    """
+    presets = presets or GS_PRESETS
+    timeout = timeout or GS_TIMEOUT
+    deadline = time.monotonic() + timeout
+    work_dir = tempfile.mkdtemp(prefix='gs_', dir=os.path.dirname(os.path.abspath(output_path)))
+    outputs = [os.path.join(work_dir, f"{i}.pdf") for i in range(len(presets))]
+    running = {}  # preset index -> Popen
+    slots = {}  # preset index -> Ghostscript slot held by its process
+    results = {}  # preset index -> True (fits) / False (too big or failed)
+    next_index = 0
+    winner = None
+
+    try:
+        while True:
+            # The winner is the first preset that fits with every better one ruled out
+            for i in range(len(presets)):
+                if i not in results:
+                    break
+                if results[i]:
+                    winner = i
+                    break
+            if winner is not None or len(results) == len(presets):
+                break
+
+            # Anything worse than a preset that already fits can no longer win
+            best_fit = min((i for i, fits in results.items() if fits), default=len(presets))
+            for i in [i for i in running if i > best_fit]:
+                process = running.pop(i)
+                process.kill()
+                process.wait()
+                release_gs_slot(slots.pop(i))
+                results[i] = False
+            while next_index < best_fit:
+                slot = acquire_gs_slot()
+                if slot is None:
+                    break
+                slots[next_index] = slot
+                running[next_index] = subprocess.Popen(
+                    gs_command(gs_path, presets[next_index], input_path, outputs[next_index]),
+                    stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+                )
+                next_index += 1
+            for i in range(max(next_index, best_fit + 1), len(presets)):
+                results.setdefault(i, False)
+
+            for i, process in list(running.items()):
+                if process.poll() is None:
+                    continue
+                del running[i]
+                release_gs_slot(slots.pop(i))
+                if process.returncode != 0:
+                    logging.warning(f"GhostScript {presets[i]} failed with exit code {process.returncode}")
+                    results[i] = False
+                else:
+                    results[i] = get_file_size(outputs[i]) <= target_size_mb
+                    logging.info(f"GhostScript {presets[i]}: {get_file_size(outputs[i])}MB")
+
+            if time.monotonic() > deadline:
+                # Settle for the best preset that finished in time and fits
+                winner = min((i for i, fits in results.items() if fits), default=None)
+                logging.warning("GhostScript preset search timed out")
+                break
+            time.sleep(0.05)
+
+        if winner is not None:
+            shutil.move(outputs[winner], output_path)
+            logging.info(f"GhostScript preset {presets[winner]} fits the target size")
+            return presets[winner]
+        return None
+
+    finally:
+        for process in running.values():
+            process.kill()
+            process.wait()
+        for slot in slots.values():
+            release_gs_slot(slot)
+        shutil.rmtree(work_dir, ignore_errors=True)
+
 def compress_pdf(input_path, output_path, target_size_mb):
     """Compress a PDF file to target size"""
     # Make sure output has PDF extension
     if not output_path.lower().endswith('.pdf'):
         output_path += '.pdf'
     
-    # Try using ghostscript for PDF compression if available
-    gs_compression_succeeded = False
+    # Ghostscript or PyMuPDF, whichever is available and faster
+    try:
+        run_backend('pdf-compress', input_path, output_path, target_size_mb)
+        if get_file_size(output_path) > target_size_mb:
+            logging.warning(f"Could not compress PDF to target size of {target_size_mb}MB")
+        return output_path
+    except Exception as e:
+        logging.warning(f"PDF compression backends failed: {str(e)}")
     
+    # Last resort, rewrite the file with PyPDF2
     try:
-        # Define compression levels from highest to lowest quality
-        compression_levels = [
-            '/default',  # Default - good quality
-            '/ebook',    # Medium quality
-            '/screen',   # Low quality
-            '/printer'   # High quality
-        ]
+        pdf_reader = PyPDF2.PdfReader(input_path)
+        pdf_writer = PyPDF2.PdfWriter()
+        
+        # Copy all pages from original PDF
+        for page_num in range(len(pdf_reader.pages)):
+            pdf_writer.add_page(pdf_reader.pages[page_num])
+        
+        # Save with compression
+        with open(output_path, 'wb') as output_file:
+            pdf_writer.write(output_file)
+        
+        # If still too large, we've done our best
+        if get_file_size(output_path) > target_size_mb:
+            logging.warning(f"Could not compress PDF to target size of {target_size_mb}MB with PyPDF2")
+        
+        return output_path
         
-        for level in compression_levels:
-            gs_output = output_path
-            
-            # Construct GhostScript command
-            gs_cmd = [
-                'gs', '-sDEVICE=pdfwrite', '-dCompatibilityLevel=1.4',
-                f'-dPDFSETTINGS={level}', '-dNOPAUSE', '-dQUIET', '-dBATCH',
-                f'-sOutputFile={gs_output}', input_path
-            ]
-            
-            try:
-                # Run GhostScript
-                subprocess.run(gs_cmd, check=True, stderr=subprocess.PIPE)
-                
-                # Check if file was created and is below target size
-                if os.path.exists(gs_output) and get_file_size(gs_output) <= target_size_mb:
-                    gs_compression_succeeded = True
-                    return gs_output
-            except subprocess.CalledProcessError as e:
-                logging.warning(f"GhostScript compression error: {e}")
-                continue
     except Exception as e:
-        logging.warning(f"GhostScript not available or error: {str(e)}")
-    
-    # If ghostscript failed or isn't available, use PyPDF2 as fallback
-    if not gs_compression_succeeded:
-        try:
-            pdf_reader = PyPDF2.PdfReader(input_path)
-            pdf_writer = PyPDF2.PdfWriter()
-            
-            # Copy all pages from original PDF
-            for page_num in range(len(pdf_reader.pages)):
-                pdf_writer.add_page(pdf_reader.pages[page_num])
-            
-            # Save with compression
-            with open(output_path, 'wb') as output_file:
-                pdf_writer.write(output_file)
-            
-            # If still too large, we've done our best
-            if get_file_size(output_path) > target_size_mb:
-                logging.warning(f"Could not compress PDF to target size of {target_size_mb}MB with PyPDF2")
-            
-            return output_path
-            
-        except Exception as e:
-            logging.error(f"Error in PyPDF2 compression: {str(e)}")
-            # If all compression methods fail, copy the original
-            shutil.copy(input_path, output_path)
-            return output_path
-    
-    return output_path
+        logging.error(f"Error in PyPDF2 compression: {str(e)}")
+        # If all compression methods fail, copy the original
+        shutil.copy(input_path, output_path)
+        return output_path
@@ -1,10 +1,12 @@
 import os
 import uuid
-from PIL import Image
-import img2pdf
-import tempfile
 import logging
 from io import BytesIO
+from utils.lazy_imports import lazy_import
+from utils.backends import run_backend
+from utils.metrics import stage
+
+Image = lazy_import('PIL.Image')
 
 def images_to_pdf(image_paths):
     """
@@ -24,57 +26,113 @@ def images_to_pdf(image_paths):
     output_filename = f"{uuid.uuid4()}_combined.pdf"
     output_path = os.path.join(output_dir, output_filename)
     
-    # Try using img2pdf first (better quality)
-    try:
-        # Create a list of PIL images to check formats
-        pil_images = []
-        img2pdf_compatible = True
-        
-        for img_path in image_paths:
-            try:
-                img = Image.open(img_path)
-                pil_images.append(img)
-                # img2pdf only supports RGB/RGBA for JPG/PNG and 1 for monochrome
-                if img.mode not in ('RGB', 'RGBA', '1', 'L'):
-                    img2pdf_compatible = False
-            except Exception as e:
-                logging.warning(f"Error opening image {img_path}: {str(e)}")
-                img2pdf_compatible = False
-        
-        if img2pdf_compatible:
-            with open(output_path, "wb") as f:
-                f.write(img2pdf.convert(image_paths))
-            return output_path
-    
-    except Exception as e:
-        logging.warning(f"img2pdf conversion failed: {str(e)}")
-    
-    # Fallback method using PIL
-    try:
-        # Convert images to RGB mode if needed
-        processed_images = []
-        
-        for img_path in image_paths:
-            try:
-                img = Image.open(img_path)
-                if img.mode not in ('RGB', 'RGBA'):
-                    img = img.convert('RGB')
-                processed_images.append(img)
-            except Exception as e:
-                logging.warning(f"Error processing image {img_path}: {str(e)}")
-        
-        if not processed_images:
-            raise ValueError("No valid images to convert")
-        
-        # Save as PDF using Pillow
-        first_image = processed_images[0]
-        if len(processed_images) > 1:
-            first_image.save(output_path, save_all=True, append_images=processed_images[1:])
+    # Streamed by default: one image at a time, JPEGs embedded without decoding
+    run_backend('images-to-pdf', image_paths, output_path)
+    return output_path
+
+
+# Pillow format names for the extensions we know how to re-encode
+IMAGE_FORMATS = {
+    '.jpg': 'JPEG',
+    '.jpeg': 'JPEG',
+    '.png': 'PNG',
+    '.webp': 'WEBP',
+    '.gif': 'GIF',
+    '.bmp': 'BMP',
+    '.tiff': 'TIFF',
+    '.tif': 'TIFF',
+}
+
+# Formats where the encoder takes a lossy quality setting
+QUALITY_FORMATS = ('JPEG', 'WEBP')
+
+
+@stage('encode')
+def encode_image(img, fmt, quality=None, scale=1.0):
+    """
+    Encode a PIL image into an in-memory buffer.
+    Returns the encoded bytes.
+    """
+    if scale < 1.0:
+        new_size = (max(1, int(img.width * scale)), max(1, int(img.height * scale)))
+        img = img.resize(new_size, Image.LANCZOS)
+
+    buffer = BytesIO()
+    options = {'optimize': True}
+    if quality is not None and fmt in QUALITY_FORMATS:
+        options['quality'] = quality
+    img.save(buffer, format=fmt, **options)
+    return buffer.getvalue()
+
+
+def solve_target_size(img, fmt, target_bytes, min_quality=10, max_quality=95,
+                      min_scale=0.1, scale_steps=6):
+    """
+    Find the best encoding of an image that fits in target_bytes.
+
+    Quality is bisected first (for lossy formats); if the lowest quality is
+    still too large the scale is bisected at that quality. Every attempt is
+    encoded into memory, nothing touches the disk.
+
+    Returns a dict with the encoded 'data', the chosen 'quality' and 'scale',
+    its 'size' in bytes, whether it 'fits' the target and the number of
+    encode 'passes' it took.
+    """
+    if fmt == 'JPEG' and img.mode not in ('RGB', 'L'):
+        img = img.convert('RGB')
+
+    passes = 0
+    best = None
+    smallest = None
+
+    def attempt(quality, scale):
+        nonlocal passes, best, smallest
+        passes += 1
+        data = encode_image(img, fmt, quality=quality, scale=scale)
+        result = {'data': data, 'quality': quality, 'scale': scale, 'size': len(data)}
+        if smallest is None or result['size'] < smallest['size']:
+            smallest = result
+        return result
+
+    quality = None
+    if fmt in QUALITY_FORMATS:
+        # Highest quality wins outright if it already fits
+        result = attempt(max_quality, 1.0)
+        if result['size'] <= target_bytes:
+            best = result
         else:
-            first_image.save(output_path)
-        
-        return output_path
-        
-    except Exception as e:
-        logging.error(f"Error converting images to PDF: {str(e)}")
-        raise
+            low, high = min_quality, max_quality - 1
+            while low <= high:
+                mid = (low + high) // 2
+                result = attempt(mid, 1.0)
+                if result['size'] <= target_bytes:
+                    best = result
+                    low = mid + 1
+                else:
+                    high = mid - 1
+        quality = best['quality'] if best else min_quality
+
+    if best is None:
+        # Even the lowest quality is too big, shrink the pixel dimensions
+        low, high = min_scale, 1.0
+        if fmt not in QUALITY_FORMATS:
+            result = attempt(None, 1.0)
+            if result['size'] <= target_bytes:
+                best = result
+        for _ in range(scale_steps if best is None else 0):
+            mid = (low + high) / 2
+            result = attempt(quality, mid)
+            if result['size'] <= target_bytes:
+                best = result
+                low = mid
+            else:
+                high = mid
+        if best is None:
+            result = attempt(quality, min_scale)
+            if result['size'] <= target_bytes:
+                best = result
+
+    chosen = best or smallest
+    chosen['fits'] = best is not None
+    chosen['passes'] = passes
+    return chosen
@@ -0,0 +1,272 @@
+import os
+import json
+import time
+import uuid
+import logging
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from utils.metrics import collect_timings
+
+# Job states, in the order a job moves through them
+QUEUED = 'queued'
+RUNNING = 'running'
+FINISHED = 'finished'
+FAILED = 'failed'
+
+
+class QueueFullError(Exception):
+    """Raised when an operation already has as many jobs pending as it allows."""
+
+
+def _write_state(state_dir, record):
+    """Atomically write a job record so any web worker can read it."""
+    path = os.path.join(state_dir, f"{record['id']}.json")
+    temp_path = f"{path}.{os.getpid()}.tmp"
+    with open(temp_path, 'w') as f:
+        json.dump(record, f)
+    os.replace(temp_path, path)
+
+
+def _read_state(state_dir, job_id):
+    """The job record last written to state_dir, or None."""
+    path = os.path.join(state_dir, f"{os.path.basename(job_id)}.json")
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def _input_paths(args):
+    """Files named by a job's arguments (directly or in a list), recorded so clean-up keeps them."""
+    paths = []
+    for arg in args:
+        for item in (arg if isinstance(arg, (list, tuple)) else [arg]):
+            if isinstance(item, str) and os.path.isfile(item):
+                paths.append(item)
+    return paths
+
+
+def _run_job(state_dir, record, func, args, kwargs):
+    """
+    Entry point inside the worker process: mark the job running and call func.
+    Returns its result along with the stage timings collected while it ran.
+    """
+    record = dict(record, status=RUNNING, startedAt=time.time())
+    try:
+        _write_state(state_dir, record)
+    except OSError as e:
+        logging.warning(f"Could not record start of job {record['id']}: {str(e)}")
+    with collect_timings() as timings:
+        result = func(*args, **kwargs)
+    return {'result': result, 'timings': timings.to_dict()}
+
+
+class JobQueue:
+    """
+    Run conversions in background worker processes.
+
+    Every operation type gets its own process pool so a slow operation
+    (e.g. pdf-to-word) cannot starve the others, and a bounded number of
+    pending jobs so the queue cannot grow without limit. Job records are
+    mirrored to JSON files in state_dir so the status endpoints work
+    whichever web worker the poll lands on.
+    """
+
+    def __init__(self, state_dir, concurrency=None, default_workers=2, max_pending=16,
+                 keep_seconds=24 * 3600):
+        self.state_dir = state_dir
+        self.keep_seconds = keep_seconds
+        self.concurrency = dict(concurrency or {})
+        self.default_workers = default_workers
+        self.max_pending = max_pending
+        self._executors = {}
+        self._slots = {}
+        self._jobs = {}
+        self._lock = threading.Lock()
+        os.makedirs(state_dir, exist_ok=True)
+
+    @classmethod
+    def from_env(cls, state_dir, operations):
+        """
+        Build a queue configured from environment variables.
+
+        NISQ_JOB_WORKERS sets the default pool size, NISQ_JOB_WORKERS_<OPERATION>
+        overrides it per operation (e.g. NISQ_JOB_WORKERS_PDF_TO_WORD=1) and
+        NISQ_JOB_QUEUE_SIZE caps the pending jobs per operation.
+        """
+        default_workers = int(os.environ.get('NISQ_JOB_WORKERS', max(1, (os.cpu_count() or 2) // 2)))
+        concurrency = {}
+        for operation in operations:
+            env_name = 'NISQ_JOB_WORKERS_' + operation.upper().replace('-', '_')
+            if env_name in os.environ:
+                concurrency[operation] = int(os.environ[env_name])
+        max_pending = int(os.environ.get('NISQ_JOB_QUEUE_SIZE', 16))
+        return cls(state_dir, concurrency, default_workers, max_pending)
+
+    def workers_for(self, operation):
+        """Number of worker processes used for an operation."""
+        return max(1, self.concurrency.get(operation, self.default_workers))
+
+    def _executor(self, operation):
+        # Pools are created lazily so they are started after gunicorn forks.
+        # A worker process that dies (OOM kill, segfault) breaks its whole
+        # pool for good, so a broken pool is replaced by a fresh one
+        with self._lock:
+            executor = self._executors.get(operation)
+            if executor is None or executor._broken:
+                if executor is not None:
+                    logging.warning(f"A {operation} worker process died, starting a new pool")
+                    executor.shutdown(wait=False)
+                workers = self.workers_for(operation)
+                self._executors[operation] = ProcessPoolExecutor(max_workers=workers)
+                self._slots[operation] = threading.BoundedSemaphore(workers + self.max_pending)
+            return self._executors[operation], self._slots[operation]
+
+    def submit(self, operation, func, *args, on_done=None, **kwargs):
+        """
+        Queue func(*args, **kwargs) for an operation.
+        Returns the job id; raises QueueFullError if the operation is saturated.
+
+        on_done, if given, is called in this process with the job record
+        once the job has finished or failed.
+        """
+        executor, slots = self._executor(operation)
+        self.prune()
+        if not slots.acquire(blocking=False):
+            raise QueueFullError(f"Too many pending {operation} jobs, please try again later")
+
+        job_id = uuid.uuid4().hex
+        record = {
+            'id': job_id,
+            'operation': operation,
+            'status': QUEUED,
+            'createdAt': time.time(),
+            'inputs': _input_paths(args),
+        }
+        with self._lock:
+            self._jobs[job_id] = record
+        _write_state(self.state_dir, record)
+        self._dispatch(operation, record, func, args, kwargs, on_done, executor, slots)
+        return job_id
+
+    def _dispatch(self, operation, record, func, args, kwargs, on_done, executor, slots, retry=True):
+        """
+        Send a job (holding one of slots) to executor and record its outcome.
+
+        A job caught in a broken pool is sent once more: to the operation's
+        fresh pool if it had not started, or to a one-off single-process
+        pool if it was running (it may be the one that killed its worker),
+        so only a job that kills its worker again ends up failed.
+        """
+        job_id = record['id']
+        try:
+            future = executor.submit(_run_job, self.state_dir, record, func, args, kwargs)
+        except BrokenProcessPool:
+            slots.release()
+            if not retry:
+                raise
+            executor, slots = self._executor(operation)
+            if not slots.acquire(blocking=False):
+                raise QueueFullError(f"Too many pending {operation} jobs, please try again later")
+            return self._dispatch(operation, record, func, args, kwargs, on_done, executor, slots, retry=False)
+        except Exception:
+            slots.release()
+            raise
+
+        def finish(done_future):
+            slots.release()
+            if retry and isinstance(done_future.exception(), BrokenProcessPool):
+                logging.warning(f"Job {job_id} ({operation}) lost its worker process, running it again")
+                try:
+                    new_executor, new_slots = self._executor(operation)
+                    if new_slots.acquire(blocking=False):
+                        state = _read_state(self.state_dir, job_id)
+                        started = state is not None and state.get('status') == RUNNING
+                        if started:
+                            new_executor = ProcessPoolExecutor(max_workers=1)
+                        self._dispatch(operation, record, func, args, kwargs, on_done,
+                                       new_executor, new_slots, retry=False)
+                        if started:
+                            # Exits once the job is done
+                            new_executor.shutdown(wait=False)
+                        return
+                except Exception as e:
+                    logging.error(f"Could not run job {job_id} again: {str(e)}")
+
+            # Build on the running state the worker wrote, which has startedAt
+            running = _read_state(self.state_dir, job_id)
+            base = running if running and running.get('status') == RUNNING else record
+            finished = dict(base, finishedAt=time.time())
+            try:
+                outcome = done_future.result()
+                finished['result'] = outcome['result']
+                finished['timings'] = outcome['timings']
+                finished['status'] = FINISHED
+            except Exception as e:
+                logging.error(f"Job {job_id} ({operation}) failed: {str(e)}")
+                finished['status'] = FAILED
+                finished['error'] = str(e)
+            with self._lock:
+                self._jobs[job_id] = finished
+            try:
+                _write_state(self.state_dir, finished)
+            except OSError as e:
+                logging.error(f"Could not record result of job {job_id}: {str(e)}")
+            if on_done is not None:
+                try:
+                    on_done(finished)
+                except Exception as e:
+                    logging.error(f"Job {job_id} completion hook failed: {str(e)}")
+
+        future.add_done_callback(finish)
+
+    def get(self, job_id):
+        """Return the record for a job, or None if it is unknown."""
+        with self._lock:
+            record = self._jobs.get(job_id)
+        if record is not None and record['status'] in (FINISHED, FAILED):
+            return record
+
+        # Fall back to the shared state file, which also has the running state
+        return _read_state(self.state_dir, job_id) or record
+
+    def prune(self):
+        """Forget finished jobs older than keep_seconds, in memory and on disk."""
+        cutoff = time.time() - self.keep_seconds
+        with self._lock:
+            expired = [job_id for job_id, record in self._jobs.items()
+                       if record.get('finishedAt', cutoff) < cutoff]
+            for job_id in expired:
+                del self._jobs[job_id]
+        try:
+            names = os.listdir(self.state_dir)
+        except OSError:
+            return
+        for name in names:
+            path = os.path.join(self.state_dir, name)
+            try:
+                if os.path.getmtime(path) < cutoff:
+                    os.remove(path)
+            except OSError:
+                pass
+
+    def stats(self):
+        """Pool size and in-flight job count per operation."""
+        with self._lock:
+            pending = {}
+            for record in self._jobs.values():
+                if record['status'] in (QUEUED, RUNNING):
+                    pending[record['operation']] = pending.get(record['operation'], 0) + 1
+            return {
+                operation: {'workers': self.workers_for(operation), 'pending': pending.get(operation, 0)}
+                for operation in self._executors
+            }
+
+    def shutdown(self, wait=True):
+        with self._lock:
+            executors = list(self._executors.values())
+            self._executors.clear()
+        for executor in executors:
+            executor.shutdown(wait=wait)
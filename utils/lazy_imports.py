@@ -0,0 +1,83 @@
+import sys
+import time
+import logging
+import importlib
+import threading
+
+# name -> LazyModule for every module registered with lazy_import
+_registry = {}
+# name -> seconds the first import took, and what asked for it
+_loaded = {}
+_lock = threading.RLock()
+
+
+class LazyModule:
+    """
+    Stand-in for a module that is imported on first attribute access.
+
+    Heavy conversion libraries (PyMuPDF, pdf2docx, python-docx, Pillow...)
+    are bound to these at module level, so importing the app only pays for
+    the libraries a request actually uses.
+    """
+
+    __slots__ = ('_name',)
+
+    def __init__(self, name):
+        self._name = name
+
+    def __getattr__(self, attr):
+        return getattr(load_module(self._name, attr), attr)
+
+    def __repr__(self):
+        state = 'loaded' if self._name in _loaded else 'not loaded'
+        return f"<lazy module '{self._name}' ({state})>"
+
+
+def lazy_import(name):
+    """Register a module to be imported on first use and return its LazyModule."""
+    with _lock:
+        if name not in _registry:
+            _registry[name] = LazyModule(name)
+        return _registry[name]
+
+
+def load_module(name, trigger=None):
+    """Import a registered module now, recording how long it took."""
+    if name in _loaded:
+        return sys.modules[name]
+    with _lock:
+        if name not in _loaded:
+            started = time.perf_counter()
+            importlib.import_module(name)
+            seconds = time.perf_counter() - started
+            _loaded[name] = {'seconds': seconds, 'trigger': trigger}
+            logging.info(f"Imported {name} in {seconds:.3f}s")
+    return sys.modules[name]
+
+
+def preload(names=None):
+    """
+    Import registered modules up front (all of them by default).
+
+    Called in the gunicorn master (NISQ_PRELOAD=1 with gunicorn --preload)
+    the libraries are loaded once and shared copy-on-write by the forked
+    workers instead of being imported again in each one.
+    Returns import_report().
+    """
+    for name in list(names or _registry):
+        try:
+            load_module(name, trigger='preload')
+        except ImportError as e:
+            logging.warning(f"Could not preload {name}: {str(e)}")
+    return import_report()
+
+
+def import_report():
+    """Load state and first-import time of every lazily imported module."""
+    return [{
+        'module': name,
+        # Another library may have imported it first
+        'loaded': name in sys.modules,
+        'seconds': round(_loaded[name]['seconds'], 4) if name in _loaded else None,
+        'trigger': _loaded[name]['trigger'] if name in _loaded else None,
+    } for name in sorted(_registry)]
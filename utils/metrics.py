@@ -0,0 +1,319 @@
+import os
+import time
+import resource
+import threading
+import contextvars
+from contextlib import contextmanager
+
+# Latency buckets in seconds
+SECONDS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+# Size buckets in bytes, 1 KB to 1 GB in steps of 4
+BYTES_BUCKETS = tuple(1024 * 4 ** i for i in range(11))
+
+# Linux reports ru_maxrss in kilobytes, macOS in bytes
+RU_MAXRSS_UNIT = 1 if os.uname().sysname == 'Darwin' else 1024
+
+
+def _escape_label_value(value):
+    """Escape a label value for the Prometheus text format."""
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(names, values):
+    if not names:
+        return ''
+    pairs = ','.join(f'{name}="{_escape_label_value(value)}"' for name, value in zip(names, values))
+    return '{' + pairs + '}'
+
+
+class Counter:
+    def __init__(self, name, documentation, label_names=()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(label_names)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = tuple(labels.get(name, '') for name in self.label_names)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def lines(self):
+        yield f'# HELP {self.name} {self.documentation}'
+        yield f'# TYPE {self.name} counter'
+        with self._lock:
+            for key, value in sorted(self._values.items()):
+                yield f'{self.name}{_format_labels(self.label_names, key)} {value}'
+
+
+class Histogram:
+    def __init__(self, name, documentation, label_names=(), buckets=SECONDS_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(label_names)
+        self.buckets = tuple(buckets)
+        self._values = {}  # labels -> [per-bucket counts, sum, count]
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(labels.get(name, '') for name in self.label_names)
+        with self._lock:
+            counts, total, count = self._values.get(key) or ([0] * len(self.buckets), 0.0, 0)
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+            self._values[key] = (counts, total + value, count + 1)
+
+    def lines(self):
+        yield f'# HELP {self.name} {self.documentation}'
+        yield f'# TYPE {self.name} histogram'
+        names = self.label_names + ('le',)
+        with self._lock:
+            for key, (counts, total, count) in sorted(self._values.items()):
+                for bound, bucket_count in zip(self.buckets, counts):
+                    yield f'{self.name}_bucket{_format_labels(names, key + (f"{bound:g}",))} {bucket_count}'
+                yield f'{self.name}_bucket{_format_labels(names, key + ("+Inf",))} {count}'
+                yield f'{self.name}_sum{_format_labels(self.label_names, key)} {total}'
+                yield f'{self.name}_count{_format_labels(self.label_names, key)} {count}'
+
+
+class Gauge:
+    """A value read from a function at scrape time."""
+
+    def __init__(self, name, documentation, read):
+        self.name = name
+        self.documentation = documentation
+        self.read = read
+
+    def lines(self):
+        yield f'# HELP {self.name} {self.documentation}'
+        yield f'# TYPE {self.name} gauge'
+        yield f'{self.name} {self.read()}'
+
+
+class MetricsRegistry:
+    """
+    Metrics of this process, rendered in the Prometheus text format.
+
+    Each gunicorn worker keeps its own; scrape the workers individually
+    (or run one worker) to see all of them.
+    """
+
+    def __init__(self):
+        self._metrics = []
+
+    def add(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def render(self):
+        return '\n'.join(line for metric in self._metrics for line in metric.lines()) + '\n'
+
+
+def current_rss():
+    """Resident memory of this process in bytes."""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        return peak_rss()
+
+
+def peak_rss():
+    """Peak resident memory of this process in bytes."""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * RU_MAXRSS_UNIT
+
+
+def _vm_hwm():
+    """Peak resident memory since the last reset (Linux VmHWM) in bytes, or None."""
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError, IndexError):
+        pass
+    return None
+
+
+# Highest peak seen before a VmHWM reset, which also resets ru_maxrss
+_process_peak = 0
+
+
+def process_peak_rss():
+    """Peak resident memory of this process over its lifetime, in bytes."""
+    return max(_process_peak, peak_rss())
+
+
+def _reset_vm_hwm():
+    global _process_peak
+    _process_peak = process_peak_rss()
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return True
+    except OSError:
+        return False
+
+
+class PeakRss:
+    """Result of measure_peak_rss; bytes is set when the block exits."""
+
+    def __init__(self):
+        self.bytes = None
+
+
+_peak_lock = threading.Lock()
+_peak_active = 0
+
+
+@contextmanager
+def measure_peak_rss():
+    """
+    Measure the peak resident memory of this process while the block runs.
+
+    On Linux the VmHWM high-water mark is reset when the first of any
+    overlapping measurements starts, so concurrent conversions in one
+    process each report the peak since the earliest of them began. Without
+    a resettable high-water mark, ru_maxrss is used if it rose during the
+    block, else the larger of the resident sizes at start and end.
+    """
+    global _peak_active
+    result = PeakRss()
+    with _peak_lock:
+        resettable = _peak_active > 0 or _reset_vm_hwm()
+        _peak_active += 1
+    start_rss, start_max = current_rss(), peak_rss()
+    try:
+        yield result
+    finally:
+        with _peak_lock:
+            _peak_active -= 1
+        high_water = _vm_hwm() if resettable else None
+        if high_water is not None:
+            result.bytes = high_water
+        else:
+            end_max = peak_rss()
+            result.bytes = end_max if end_max > start_max else max(start_rss, current_rss())
+
+
+class Timings:
+    """
+    Time spent per stage, and per backend call, while handling one request
+    or job. Safe to update from the worker threads of that request.
+    """
+
+    def __init__(self):
+        self.stages = {}
+        self.backends = []  # (operation, backend, outcome, seconds)
+        self.peak_rss = None
+        self._lock = threading.Lock()
+
+    def add_stage(self, name, seconds):
+        with self._lock:
+            self.stages[name] = self.stages.get(name, 0.0) + seconds
+
+    def add_backend(self, operation, backend, outcome, seconds):
+        with self._lock:
+            self.backends.append((operation, backend, outcome, seconds))
+
+    def to_dict(self):
+        with self._lock:
+            return {'stages': dict(self.stages), 'backends': list(self.backends), 'peakRssBytes': self.peak_rss}
+
+    def merge(self, data):
+        """Add timings reported by a job process."""
+        for name, seconds in data.get('stages', {}).items():
+            self.add_stage(name, seconds)
+        for call in data.get('backends', []):
+            self.add_backend(*call)
+        if data.get('peakRssBytes'):
+            self.peak_rss = max(self.peak_rss or 0, data['peakRssBytes'])
+
+
+_timings = contextvars.ContextVar('nisq_timings', default=None)
+
+
+def start_timings():
+    """Start collecting timings in the current context; returns (Timings, token)."""
+    timings = Timings()
+    return timings, _timings.set(timings)
+
+
+def stop_timings(token):
+    _timings.reset(token)
+
+
+@contextmanager
+def collect_timings():
+    """Collect the timings of the code in the block (e.g. one job)."""
+    timings, token = start_timings()
+    try:
+        with measure_peak_rss() as peak:
+            yield timings
+    finally:
+        timings.peak_rss = peak.bytes
+        stop_timings(token)
+
+
+@contextmanager
+def stage(name):
+    """Time a block of work as one stage of the current request or job, if any."""
+    timings = _timings.get()
+    if timings is None:
+        yield
+        return
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings.add_stage(name, time.perf_counter() - started)
+
+
+def submit_with_timings(executor, func, *args):
+    """
+    executor.submit for thread pools that keeps reporting stages to the
+    caller's request or job.
+    """
+    return executor.submit(contextvars.copy_context().run, func, *args)
+
+
+def record_backend(operation, backend, outcome, seconds):
+    timings = _timings.get()
+    if timings is not None:
+        timings.add_backend(operation, backend, outcome, seconds)
+    else:
+        BACKEND_SECONDS.observe(seconds, operation=operation, backend=backend, outcome=outcome)
+
+
+metrics = MetricsRegistry()
+
+REQUEST_SECONDS = metrics.add(Histogram(
+    'nisq_request_duration_seconds', 'Time to handle a request, including sending the response',
+    ('route', 'method', 'status')))
+REQUEST_BYTES_IN = metrics.add(Histogram(
+    'nisq_request_bytes_in', 'Request body size', ('route',), BYTES_BUCKETS))
+RESPONSE_BYTES_OUT = metrics.add(Histogram(
+    'nisq_response_bytes_out', 'Response body size, when known up front', ('route',), BYTES_BUCKETS))
+STAGE_SECONDS = metrics.add(Histogram(
+    'nisq_stage_duration_seconds', 'Time spent per processing stage of a request or job', ('route', 'stage')))
+BACKEND_SECONDS = metrics.add(Histogram(
+    'nisq_backend_duration_seconds', 'Time spent in a conversion backend', ('operation', 'backend', 'outcome')))
+CONVERSIONS = metrics.add(Counter(
+    'nisq_conversions_total', 'Conversions run, inline or as jobs', ('operation', 'status')))
+CONVERSION_PEAK_RSS = metrics.add(Histogram(
+    'nisq_conversion_peak_rss_bytes', 'Peak resident memory while a conversion ran',
+    ('operation',), BYTES_BUCKETS))
+metrics.add(Gauge('nisq_process_resident_bytes', 'Resident memory of this process', current_rss))
+metrics.add(Gauge('nisq_process_peak_resident_bytes', 'Peak resident memory of this process', process_peak_rss))
+
+
+def observe_timings(route, timings):
+    """Export the stage and backend timings collected for a request or job."""
+    data = timings.to_dict()
+    for name, seconds in data['stages'].items():
+        STAGE_SECONDS.observe(seconds, route=route, stage=name)
+    for operation, backend, outcome, seconds in data['backends']:
+        BACKEND_SECONDS.observe(seconds, operation=operation, backend=backend, outcome=outcome)
@@ -0,0 +1,565 @@
+import os
+import json
+import time
+import fcntl
+import atexit
+import shutil
+import signal
+import socket
+import logging
+import tempfile
+import threading
+import subprocess
+from utils.metrics import stage
+
+try:
+    import uno
+    from com.sun.star.beans import PropertyValue
+except ImportError:
+    # The UNO bridge ships with LibreOffice's own Python, not on PyPI
+    uno = None
+
+# LibreOffice export filter per source extension
+PDF_EXPORT_FILTERS = {
+    '.doc': 'writer_pdf_Export',
+    '.docx': 'writer_pdf_Export',
+    '.odt': 'writer_pdf_Export',
+    '.rtf': 'writer_pdf_Export',
+    '.txt': 'writer_pdf_Export',
+    '.xls': 'calc_pdf_Export',
+    '.xlsx': 'calc_pdf_Export',
+    '.ods': 'calc_pdf_Export',
+    '.ppt': 'impress_pdf_Export',
+    '.pptx': 'impress_pdf_Export',
+    '.odp': 'impress_pdf_Export',
+}
+
+# Seconds a fresh instance gets to start accepting connections
+STARTUP_TIMEOUT = 30
+
+# Seconds an instance gets to answer a liveness check before it counts as hung
+HEALTH_TIMEOUT = 10
+
+# Lock files, state and profiles of the LibreOffice slots, shared by all web and job workers
+SLOT_DIR = os.environ.get('NISQ_SOFFICE_SLOT_DIR', os.path.join('uploads', '.soffice_slots'))
+
+# Seconds between liveness checks of idle instances
+CHECK_INTERVAL = float(os.environ.get('NISQ_SOFFICE_CHECK_SECONDS', 60))
+
+# Instances started by this process, kept so they are reaped once they exit
+_children = []
+_children_lock = threading.Lock()
+
+
+def find_soffice():
+    """Path of the LibreOffice binary (NISQ_SOFFICE_PATH, soffice or libreoffice), or None."""
+    configured = os.environ.get('NISQ_SOFFICE_PATH')
+    if configured:
+        return configured if os.path.exists(configured) else None
+    return shutil.which('soffice') or shutil.which('libreoffice')
+
+
+def find_unoconv():
+    """Path of the unoconv client (NISQ_UNOCONV_PATH or unoconv), or None."""
+    configured = os.environ.get('NISQ_UNOCONV_PATH')
+    if configured:
+        return configured if os.path.exists(configured) else None
+    return shutil.which('unoconv')
+
+
+def pool_mode(unoconv_path):
+    """
+    How workers talk to LibreOffice: 'uno' in-process over the UNO bridge,
+    'unoconv' by submitting to a listening instance with the unoconv client,
+    or 'cli' with one soffice --convert-to (a cold start) per document.
+    """
+    if uno is not None:
+        return 'uno'
+    return 'unoconv' if unoconv_path else 'cli'
+
+
+def free_port():
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def _reap():
+    """Forget (and reap) the instances this process started that have exited."""
+    with _children_lock:
+        _children[:] = [process for process in _children if process.poll() is None]
+
+
+def uno_property(name, value):
+    prop = PropertyValue()
+    prop.Name = name
+    prop.Value = value
+    return prop
+
+
+
+
+class OfficeWorker:
+    """
+    One headless LibreOffice slot, shared by every process on the host.
+
+    The slot is a lock file; whoever holds it has the slot's instance and
+    profile to itself until it releases it. The instance listens on a local
+    socket and outlives the process that started it, so the next holder
+    reuses it warm. Its pid, port and counters live in a state file next to
+    the lock. With the UNO bridge available documents are converted
+    in-process; otherwise they are submitted to the listener with the
+    unoconv client. The instance is restarted after max_conversions, after
+    a crash or when a conversion overruns its timeout. With neither, each
+    conversion runs soffice --convert-to, only reusing the slot's profile.
+    """
+
+    def __init__(self, slot_dir, index, soffice_path, max_conversions=200, timeout=120, unoconv_path=None):
+        self.index = index
+        self.soffice_path = soffice_path
+        self.unoconv_path = unoconv_path
+        self.mode = pool_mode(unoconv_path)
+        self.max_conversions = max_conversions
+        self.timeout = timeout
+        self.lock_path = os.path.join(slot_dir, f"{index}.lock")
+        self.state_path = os.path.join(slot_dir, f"{index}.json")
+        self.profile_dir = os.path.abspath(os.path.join(slot_dir, f"profile_{index}"))
+        self.pid = None
+        self.port = None
+        self.desktop = None
+        self.conversions = 0
+        self.starts = 0
+        self._slot = None
+
+    def read_state(self):
+        try:
+            with open(self.state_path) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def _save_state(self):
+        temp_path = f"{self.state_path}.{os.getpid()}.tmp"
+        try:
+            with open(temp_path, 'w') as f:
+                json.dump({'pid': self.pid, 'port': self.port,
+                           'conversions': self.conversions, 'starts': self.starts}, f)
+            os.replace(temp_path, self.state_path)
+        except OSError as e:
+            logging.error(f"Could not save LibreOffice slot state: {str(e)}")
+
+    def acquire(self):
+        """Take the slot without waiting and load its state; False if another holder has it."""
+        slot = open(self.lock_path, 'a')
+        try:
+            fcntl.flock(slot, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            slot.close()
+            return False
+        self._slot = slot
+        state = self.read_state()
+        if state.get('pid') != self.pid:
+            # Another process replaced the instance; our UNO connection is stale
+            self.desktop = None
+        self.pid = state.get('pid')
+        self.port = state.get('port')
+        self.conversions = state.get('conversions', 0)
+        self.starts = state.get('starts', 0)
+        return True
+
+    def release(self):
+        self._save_state()
+        self._slot.close()
+        self._slot = None
+
+    def idle(self):
+        """Whether no process holds the slot right now."""
+        with open(self.lock_path, 'a') as slot:
+            try:
+                fcntl.flock(slot, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                return True
+            except BlockingIOError:
+                return False
+
+    def _command(self, *args):
+        profile_url = 'file://' + self.profile_dir
+        return [self.soffice_path, '--headless', '--invisible', '--nologo', '--norestore',
+                '--nodefault', '--nolockcheck', f'-env:UserInstallation={profile_url}', *args]
+
+    def _connection(self):
+        return f'socket,host=127.0.0.1,port={self.port};urp;StarOffice.ComponentContext'
+
+    def _running(self):
+        """Whether the recorded pid is still this slot's instance (not exited, not reused)."""
+        if self.pid is None:
+            return False
+        try:
+            os.kill(self.pid, 0)
+        except OSError:
+            return False
+        try:
+            with open(f'/proc/{self.pid}/cmdline', 'rb') as f:
+                # Empty for a zombie, someone else's command line for a reused pid
+                return self.profile_dir.encode() in f.read()
+        except OSError:
+            return True
+
+    def _signal(self, pid, sig):
+        # Instances run in their own session, so this reaches soffice.bin as well
+        try:
+            os.killpg(pid, sig)
+        except OSError:
+            pass
+
+    def start(self):
+        """Start the listening instance and connect to it (not in CLI mode)."""
+        if self.mode == 'cli':
+            return
+        self.port = free_port()
+        process = subprocess.Popen(self._command(f'--accept={self._connection()}'),
+                                   stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+                                   start_new_session=True)
+        with _children_lock:
+            _children.append(process)
+        self.pid = process.pid
+        self.conversions = 0
+        try:
+            if self.mode == 'unoconv':
+                self._wait_for_listener()
+            else:
+                self._connect(STARTUP_TIMEOUT)
+        except Exception:
+            self.stop()
+            raise RuntimeError("LibreOffice did not start")
+        self.starts += 1
+        self._save_state()
+        logging.info(f"Started LibreOffice instance {self.index} (pid {self.pid}, port {self.port})")
+
+    def _connect(self, timeout):
+        local_context = uno.getComponentContext()
+        resolver = local_context.ServiceManager.createInstanceWithContext(
+            'com.sun.star.bridge.UnoUrlResolver', local_context)
+        deadline = time.monotonic() + timeout
+        while True:
+            try:
+                context = resolver.resolve(f'uno:{self._connection()}')
+                break
+            except Exception:
+                if not self._running() or time.monotonic() > deadline:
+                    raise
+                time.sleep(0.25)
+        self.desktop = context.ServiceManager.createInstanceWithContext('com.sun.star.frame.Desktop', context)
+
+    def _wait_for_listener(self):
+        deadline = time.monotonic() + STARTUP_TIMEOUT
+        while True:
+            try:
+                with socket.create_connection(('127.0.0.1', self.port), timeout=1):
+                    return
+            except OSError:
+                if not self._running() or time.monotonic() > deadline:
+                    raise
+                time.sleep(0.25)
+
+    def stop(self):
+        if self._running():
+            try:
+                if self.desktop is not None:
+                    self.desktop.terminate()
+                else:
+                    self._signal(self.pid, signal.SIGTERM)
+            except Exception:
+                pass
+            deadline = time.monotonic() + 5
+            while self._running() and time.monotonic() < deadline:
+                time.sleep(0.1)
+            if self._running():
+                self._signal(self.pid, signal.SIGKILL)
+        self.pid = None
+        self.port = None
+        self.desktop = None
+        _reap()
+
+    def restart(self):
+        self.stop()
+        self.start()
+
+    def healthy(self):
+        """Whether the instance is running and answers within HEALTH_TIMEOUT."""
+        if self.mode == 'cli':
+            return True
+        if not self._running():
+            return False
+
+        # A hung instance is killed by the watchdog and so fails the check
+        watchdog = threading.Timer(HEALTH_TIMEOUT, self._signal, (self.pid, signal.SIGKILL))
+        watchdog.start()
+        try:
+            if self.mode == 'unoconv':
+                # Hangs while converting are caught by the conversion timeout
+                with socket.create_connection(('127.0.0.1', self.port), timeout=HEALTH_TIMEOUT):
+                    pass
+            else:
+                if self.desktop is None:
+                    self._connect(0)
+                self.desktop.getFrames()
+            answered = True
+        except Exception:
+            answered = False
+        finally:
+            watchdog.cancel()
+        return answered and self._running()
+
+    @stage('subprocess')
+    def convert(self, input_path, output_path):
+        """Convert a document to PDF, restarting the instance first if needed."""
+        if not self.healthy() or (self.max_conversions and self.conversions >= self.max_conversions):
+            self.restart()
+
+        if self.mode == 'uno':
+            self._convert_uno(input_path, output_path)
+        elif self.mode == 'unoconv':
+            self._convert_unoconv(input_path, output_path)
+        else:
+            self._convert_cli(input_path, output_path)
+        self.conversions += 1
+
+    def _convert_uno(self, input_path, output_path):
+        export_filter = PDF_EXPORT_FILTERS.get(os.path.splitext(input_path)[1].lower(), 'writer_pdf_Export')
+
+        # A hung conversion is ended by killing the instance
+        timed_out = threading.Event()
+        pid = self.pid
+
+        def kill():
+            timed_out.set()
+            self._signal(pid, signal.SIGKILL)
+
+        watchdog = threading.Timer(self.timeout, kill)
+        watchdog.start()
+        try:
+            document = self.desktop.loadComponentFromURL(
+                uno.systemPathToFileUrl(os.path.abspath(input_path)), '_blank', 0,
+                (uno_property('Hidden', True), uno_property('ReadOnly', True)))
+            if document is None:
+                raise ValueError(f"LibreOffice could not open {os.path.basename(input_path)}")
+            try:
+                document.storeToURL(uno.systemPathToFileUrl(os.path.abspath(output_path)),
+                                    (uno_property('FilterName', export_filter),))
+            finally:
+                document.close(True)
+        except Exception:
+            # The instance may be left in a bad state; start clean next time
+            self.stop()
+            if timed_out.is_set():
+                raise TimeoutError(f"Conversion took longer than {self.timeout} seconds")
+            raise
+        finally:
+            watchdog.cancel()
+
+    def _convert_unoconv(self, input_path, output_path):
+        # --no-launch: fail rather than have unoconv start a cold instance of its own
+        try:
+            subprocess.run([self.unoconv_path, '--connection', self._connection(), '--no-launch',
+                            '-f', 'pdf', '-o', output_path, input_path],
+                           check=True, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+                           timeout=self.timeout)
+        except subprocess.TimeoutExpired:
+            # The listener may be stuck on the document; start clean next time
+            self.stop()
+            raise TimeoutError(f"Conversion took longer than {self.timeout} seconds")
+        if not os.path.exists(output_path):
+            raise RuntimeError("LibreOffice did not produce a PDF")
+
+    def _convert_cli(self, input_path, output_path):
+        out_dir = tempfile.mkdtemp(prefix='soffice_out_', dir=os.path.dirname(os.path.abspath(output_path)))
+        try:
+            try:
+                subprocess.run(self._command('--convert-to', 'pdf', '--outdir', out_dir, input_path),
+                               check=True, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+                               timeout=self.timeout)
+            except subprocess.TimeoutExpired:
+                raise TimeoutError(f"Conversion took longer than {self.timeout} seconds")
+
+            result = os.path.join(out_dir, os.path.splitext(os.path.basename(input_path))[0] + '.pdf')
+            if not os.path.exists(result):
+                raise RuntimeError("LibreOffice did not produce a PDF")
+            os.replace(result, output_path)
+        finally:
+            shutil.rmtree(out_dir, ignore_errors=True)
+
+
+class OfficePool:
+    """
+    The host-wide set of LibreOffice slots, seen from one process.
+
+    Every web and job worker builds its own OfficePool over the same slot
+    directory, so together they never run more than size instances, and an
+    instance started by one process is reused warm by the others.
+    Conversions wait up to queue_timeout seconds for a free slot. Instances
+    are started on first use; a background thread checks the idle ones every
+    check_interval seconds and restarts those that died or hung.
+
+    Only the 'uno' and 'unoconv' modes keep instances warm; in 'cli' mode
+    the slots just bound how many cold soffice runs go at once, and stats
+    say so.
+    """
+
+    def __init__(self, soffice_path, size=2, max_conversions=200, timeout=120, queue_timeout=300,
+                 unoconv_path=None, slot_dir=None, check_interval=CHECK_INTERVAL):
+        self.soffice_path = soffice_path
+        self.size = size
+        self.queue_timeout = queue_timeout
+        self.check_interval = check_interval
+        self.mode = pool_mode(unoconv_path)
+        self.slot_dir = slot_dir or SLOT_DIR
+        os.makedirs(self.slot_dir, exist_ok=True)
+        self._workers = [OfficeWorker(self.slot_dir, index, soffice_path, max_conversions, timeout, unoconv_path)
+                         for index in range(size)]
+        self._thread = None
+        self._thread_pid = None
+        self._lock = threading.Lock()
+        self.completed = 0
+        self.failed = 0
+        atexit.register(self.shutdown)
+
+    @classmethod
+    def from_env(cls, soffice_path):
+        """
+        Build a pool configured from NISQ_SOFFICE_WORKERS, NISQ_SOFFICE_MAX_CONVERSIONS,
+        NISQ_SOFFICE_TIMEOUT and NISQ_SOFFICE_QUEUE_TIMEOUT.
+        """
+        unoconv_path = find_unoconv()
+        if pool_mode(unoconv_path) == 'cli':
+            logging.warning("Neither the UNO bridge nor unoconv is available; every Word to PDF "
+                            "conversion will start LibreOffice from cold")
+        return cls(
+            soffice_path,
+            size=max(1, int(os.environ.get('NISQ_SOFFICE_WORKERS', 2))),
+            max_conversions=int(os.environ.get('NISQ_SOFFICE_MAX_CONVERSIONS', 200)),
+            timeout=float(os.environ.get('NISQ_SOFFICE_TIMEOUT', 120)),
+            queue_timeout=float(os.environ.get('NISQ_SOFFICE_QUEUE_TIMEOUT', 300)),
+            unoconv_path=unoconv_path,
+        )
+
+    def _acquire(self):
+        deadline = time.monotonic() + self.queue_timeout
+        while True:
+            for worker in self._workers:
+                if worker.acquire():
+                    return worker
+            if time.monotonic() > deadline:
+                raise TimeoutError("No LibreOffice worker became free in time")
+            time.sleep(0.1)
+
+    def convert(self, input_path, output_path):
+        """Convert a document to PDF in the next free slot."""
+        self.ensure_started()
+        worker = self._acquire()
+        try:
+            worker.convert(input_path, output_path)
+            self.completed += 1
+        except Exception:
+            self.failed += 1
+            raise
+        finally:
+            worker.release()
+
+    def check(self):
+        """Restart the idle instances that died or stopped answering."""
+        for worker in self._workers:
+            if not worker.acquire():
+                # Busy; a stuck conversion is ended by its own timeout
+                continue
+            try:
+                if worker.pid is not None and not worker.healthy():
+                    logging.warning(f"LibreOffice instance {worker.index} (pid {worker.pid}) "
+                                    f"is not answering, restarting it")
+                    worker.restart()
+            except Exception as e:
+                logging.error(f"LibreOffice liveness check failed: {str(e)}")
+            finally:
+                worker.release()
+        _reap()
+
+    def _run(self):
+        while True:
+            time.sleep(self.check_interval)
+            self.check()
+
+    def ensure_started(self):
+        """Start the background liveness checks in this process if they are not running yet."""
+        if self.mode == 'cli':
+            return
+        # Threads do not survive a fork, so track the owning process
+        if self._thread_pid == os.getpid() and self._thread.is_alive():
+            return
+        with self._lock:
+            if self._thread_pid == os.getpid() and self._thread.is_alive():
+                return
+            self._thread = threading.Thread(target=self._run, name='office-liveness', daemon=True)
+            self._thread_pid = os.getpid()
+            self._thread.start()
+
+    def shutdown(self):
+        """Stop the idle instances this process started; the others belong to their holders."""
+        _reap()
+        with _children_lock:
+            started = {process.pid for process in _children}
+        for worker in self._workers:
+            if not worker.acquire():
+                continue
+            try:
+                if worker.pid in started:
+                    worker.stop()
+            finally:
+                worker.release()
+
+    def stats(self):
+        """Host-wide slot usage and restarts; completed and failed count this process only."""
+        states = [worker.read_state() for worker in self._workers]
+        return {
+            'workers': self.size,
+            'idle': sum(1 for worker in self._workers if worker.idle()),
+            'mode': self.mode,
+            'warm': self.mode != 'cli',
+            'completed': self.completed,
+            'failed': self.failed,
+            'restarts': sum(max(0, state.get('starts', 0) - 1) for state in states),
+        }
+
+
+_pool = None
+_pool_pid = None
+_pool_lock = threading.Lock()
+
+
+def get_office_pool():
+    """
+    This process's view of the LibreOffice slots, or None if LibreOffice is
+    not installed. The instances themselves are shared host-wide.
+    """
+    global _pool, _pool_pid
+    # Pool objects (and their threads) are not shared across a fork
+    if _pool_pid == os.getpid():
+        return _pool
+    with _pool_lock:
+        if _pool_pid != os.getpid():
+            soffice_path = find_soffice()
+            _pool = OfficePool.from_env(soffice_path) if soffice_path else None
+            _pool_pid = os.getpid()
+            if _pool is None:
+                logging.warning("LibreOffice not found, Word to PDF will use the text-only fallback")
+    return _pool
+
+
+def office_to_pdf(input_path, output_path):
+    """
+    Convert an Office document to PDF with the LibreOffice pool.
+    Raises RuntimeError if LibreOffice is not installed.
+    """
+    pool = get_office_pool()
+    if pool is None:
+        raise RuntimeError("LibreOffice is not installed")
+    pool.convert(input_path, output_path)
+    return output_path
@@ -0,0 +1,239 @@
+import os
+import zipfile
+import logging
+import posixpath
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+from xml.etree import ElementTree
+from utils.image_utils import IMAGE_FORMATS, encode_image, solve_target_size
+from utils.lazy_imports import lazy_import
+from utils.metrics import submit_with_timings
+
+Image = lazy_import('PIL.Image')
+
+# Office Open XML packages (zip archives) we know how to recompress
+OOXML_EXTENSIONS = ('.docx', '.xlsx', '.pptx')
+
+# Folders inside the package that hold embedded media
+MEDIA_FOLDERS = ('word/media/', 'xl/media/', 'ppt/media/')
+
+# Embedded image types we re-encode; anything else is copied as is
+RECOMPRESSIBLE_MEDIA = ('.jpg', '.jpeg', '.png')
+
+# Images are downscaled when they have this many times the pixels their
+# displayed size needs at display_dpi
+OVERSIZE_FACTOR = 1.5
+EMU_PER_INCH = 914400
+
+PACKAGE_RELS_NS = 'http://schemas.openxmlformats.org/package/2006/relationships'
+RELATIONSHIPS_NS = 'http://schemas.openxmlformats.org/officeDocument/2006/relationships'
+DRAWINGML_NS = 'http://schemas.openxmlformats.org/drawingml/2006/main'
+WORD_DRAWING_NS = 'http://schemas.openxmlformats.org/drawingml/2006/wordprocessingDrawing'
+PRESENTATION_NS = 'http://schemas.openxmlformats.org/presentationml/2006/main'
+SHEET_DRAWING_NS = 'http://schemas.openxmlformats.org/drawingml/2006/spreadsheetDrawing'
+
+# Elements wrapping a picture, and where their displayed extent lives
+DRAWING_EXTENTS = (
+    (f'{{{WORD_DRAWING_NS}}}inline', f'{{{WORD_DRAWING_NS}}}extent'),
+    (f'{{{WORD_DRAWING_NS}}}anchor', f'{{{WORD_DRAWING_NS}}}extent'),
+    (f'{{{PRESENTATION_NS}}}pic', f'.//{{{DRAWINGML_NS}}}xfrm/{{{DRAWINGML_NS}}}ext'),
+    (f'{{{SHEET_DRAWING_NS}}}pic', f'.//{{{DRAWINGML_NS}}}xfrm/{{{DRAWINGML_NS}}}ext'),
+)
+
+
+def is_recompressible_media(name):
+    return name.startswith(MEDIA_FOLDERS) and name.lower().endswith(RECOMPRESSIBLE_MEDIA)
+
+
+def copy_entry_info(info, compress_type):
+    """Fresh ZipInfo for writing an entry under the same name and timestamp."""
+    new_info = zipfile.ZipInfo(info.filename, date_time=info.date_time)
+    new_info.external_attr = info.external_attr
+    new_info.compress_type = compress_type
+    return new_info
+
+
+def resolve_target(part_name, target):
+    """Resolve a relationship target relative to the part that owns it."""
+    if target.startswith('/'):
+        return target.lstrip('/')
+    return posixpath.normpath(posixpath.join(posixpath.dirname(part_name), target))
+
+
+def media_display_sizes(source):
+    """
+    Work out how large each embedded image is actually displayed.
+
+    Scans the parts that reference media (document.xml, slides, drawings)
+    for drawing extents. Returns {media name: (width, height)} in EMU,
+    taking the largest extent when an image is used more than once.
+    """
+    names = set(source.namelist())
+    sizes = {}
+
+    for rels_name in names:
+        if not rels_name.endswith('.rels') or '/_rels/' not in rels_name:
+            continue
+        folder, rels_file = rels_name.split('/_rels/', 1)
+        part_name = posixpath.join(folder, rels_file[:-len('.rels')])
+        if part_name not in names:
+            continue
+
+        # Only parse parts that actually point at media
+        media_targets = {}
+        for rel in ElementTree.fromstring(source.read(rels_name)).iter(f'{{{PACKAGE_RELS_NS}}}Relationship'):
+            if rel.get('TargetMode') == 'External':
+                continue
+            target = resolve_target(part_name, rel.get('Target', ''))
+            if target.startswith(MEDIA_FOLDERS):
+                media_targets[rel.get('Id')] = target
+        if not media_targets:
+            continue
+
+        try:
+            root = ElementTree.fromstring(source.read(part_name))
+        except ElementTree.ParseError as e:
+            logging.warning(f"Could not parse {part_name}: {e}")
+            continue
+
+        for tag, extent_path in DRAWING_EXTENTS:
+            for container in root.iter(tag):
+                extent = container.find(extent_path)
+                if extent is None:
+                    continue
+                cx, cy = int(extent.get('cx', 0)), int(extent.get('cy', 0))
+                for blip in container.iter(f'{{{DRAWINGML_NS}}}blip'):
+                    target = media_targets.get(blip.get(f'{{{RELATIONSHIPS_NS}}}embed'))
+                    if target:
+                        width, height = sizes.get(target, (0, 0))
+                        sizes[target] = (max(width, cx), max(height, cy))
+
+    return sizes
+
+
+def recompress_media(name, data, budget=None, quality=50, max_size=None):
+    """
+    Re-encode one embedded image in memory, keeping its format.
+
+    Images much larger than max_size (pixels) are downscaled to it first.
+    With a byte budget the quality (then scale) is solved to fit it,
+    otherwise the image is saved once at the given quality.
+    Returns (data, passes, downscaled); the original data is returned when
+    the new encoding would not be smaller.
+    """
+    fmt = IMAGE_FORMATS[os.path.splitext(name)[1].lower()]
+    downscaled = False
+    with Image.open(BytesIO(data)) as img:
+        if max_size and (img.width > max_size[0] * OVERSIZE_FACTOR
+                         or img.height > max_size[1] * OVERSIZE_FACTOR):
+            ratio = min(max_size[0] / img.width, max_size[1] / img.height)
+            img = img.resize((max(1, int(img.width * ratio)), max(1, int(img.height * ratio))), Image.LANCZOS)
+            downscaled = True
+
+        if budget is not None:
+            result = solve_target_size(img, fmt, budget)
+            new_data, passes = result['data'], result['passes']
+        else:
+            if fmt == 'JPEG' and img.mode not in ('RGB', 'L'):
+                img = img.convert('RGB')
+            new_data, passes = encode_image(img, fmt, quality=quality), 1
+
+    if len(new_data) >= len(data):
+        return data, passes, False
+    return new_data, passes, downscaled
+
+
+def compress_ooxml(input_path, output_path, target_size_mb=None, quality=50,
+                   display_dpi=200, max_workers=None):
+    """
+    Recompress a DOCX/XLSX/PPTX package without extracting it.
+
+    The source archive is read entry by entry and the output archive is
+    written directly. Embedded JPEG/PNG media are re-encoded in memory on a
+    thread pool of max_workers (NISQ_MEDIA_WORKERS by default), and images
+    with far more pixels than their displayed size needs at display_dpi are
+    downscaled first. With a target size, the bytes left after the non-media
+    entries are shared between the images in proportion to their current
+    size. Entries that would not shrink are copied unchanged.
+
+    Returns a dict with the number of 'images', how many were 'recompressed'
+    and 'downscaled', the 'savedBytes' and the total encode 'passes'.
+    """
+    stats = {'images': 0, 'recompressed': 0, 'downscaled': 0, 'savedBytes': 0, 'passes': 0}
+    if max_workers is None:
+        max_workers = int(os.environ.get('NISQ_MEDIA_WORKERS', min(4, os.cpu_count() or 1)))
+
+    with zipfile.ZipFile(input_path, 'r') as source:
+        infos = source.infolist()
+        media = [info for info in infos if is_recompressible_media(info.filename)]
+        media_bytes = sum(info.file_size for info in media)
+
+        # Byte budget per unit of original media size
+        budget_ratio = None
+        if target_size_mb is not None and media_bytes:
+            media_names = {info.filename for info in media}
+            other_bytes = sum(info.compress_size for info in infos if info.filename not in media_names)
+            media_budget = target_size_mb * 1024 * 1024 - other_bytes
+            budget_ratio = max(media_budget, 0) / media_bytes
+
+        try:
+            display_sizes = media_display_sizes(source) if media else {}
+        except Exception as e:
+            logging.warning(f"Could not read image display sizes: {e}")
+            display_sizes = {}
+
+        with zipfile.ZipFile(output_path, 'w', zipfile.ZIP_DEFLATED) as output, \
+                ThreadPoolExecutor(max_workers=max(1, max_workers)) as executor:
+            pending = deque()
+
+            def write_media(info, data, future):
+                try:
+                    new_data, passes, downscaled = future.result()
+                    stats['passes'] += passes
+                except Exception as e:
+                    logging.warning(f"Failed to compress {info.filename}: {e}")
+                    new_data, downscaled = data, False
+
+                if len(new_data) < len(data):
+                    stats['recompressed'] += 1
+                    stats['downscaled'] += int(downscaled)
+                    stats['savedBytes'] += len(data) - len(new_data)
+                    logging.info(f"Compressed {info.filename}: {len(data)} -> {len(new_data)} bytes")
+
+                # Media are already compressed, deflating them again only costs time
+                output.writestr(copy_entry_info(info, zipfile.ZIP_STORED), new_data)
+
+            for info in infos:
+                data = source.read(info)
+
+                if not is_recompressible_media(info.filename):
+                    output.writestr(copy_entry_info(info, zipfile.ZIP_DEFLATED), data)
+                    continue
+
+                stats['images'] += 1
+                budget = None
+                if budget_ratio is not None:
+                    if budget_ratio >= 1:
+                        # Already within budget, nothing to gain
+                        output.writestr(copy_entry_info(info, zipfile.ZIP_STORED), data)
+                        continue
+                    budget = max(1, int(info.file_size * budget_ratio))
+
+                max_size = None
+                if info.filename in display_sizes:
+                    cx, cy = display_sizes[info.filename]
+                    max_size = (max(1, int(cx / EMU_PER_INCH * display_dpi)),
+                                max(1, int(cy / EMU_PER_INCH * display_dpi)))
+
+                future = submit_with_timings(executor, recompress_media, info.filename, data, budget, quality, max_size)
+                pending.append((info, data, future))
+
+                # Bound the number of images held in memory at once
+                if len(pending) >= max_workers * 2:
+                    write_media(*pending.popleft())
+
+            while pending:
+                write_media(*pending.popleft())
+
+    return stats
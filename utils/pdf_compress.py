@@ -0,0 +1,284 @@
+import os
+import hashlib
+import logging
+from io import BytesIO
+from utils.lazy_imports import lazy_import
+from utils.metrics import stage
+
+Image = lazy_import('PIL.Image')
+fitz = lazy_import('fitz')  # PyMuPDF
+
+# (dpi, JPEG quality) image settings, from best looking to smallest
+PDF_IMAGE_SETTINGS = [
+    (200, 85),
+    (150, 75),
+    (120, 65),
+    (96, 55),
+    (72, 45),
+    (60, 35),
+    (50, 25),
+]
+
+# Images smaller than this (in pixels per side) are not worth touching
+MIN_IMAGE_SIDE = 64
+
+# Pages whose images are encoded at every setting to predict the output size
+SAMPLE_PAGES = 4
+
+# A guess this far under the target gets a corrective step to a better setting
+UNDERSHOOT = 0.85
+
+
+def collect_pdf_images(doc):
+    """
+    Find the raster images worth recompressing in an open PDF.
+
+    Images with a soft mask or fewer than 8 bits per component (masks,
+    line art) are left alone. Identical image streams stored under
+    different xrefs are grouped so they are only encoded once.
+
+    Returns a dict keyed by content hash with the 'xrefs' sharing it, the
+    pixel 'width'/'height', the current 'raw_size' of the stream, the
+    lowest effective 'dpi' the image is displayed at (None if unknown) and
+    the 'pages' it appears on.
+    """
+    images = {}
+    seen_xrefs = {}
+
+    for page in doc:
+        for xref, smask, width, height, bpc, *_ in page.get_images(full=True):
+            if smask or bpc < 8 or min(width, height) < MIN_IMAGE_SIDE:
+                continue
+
+            if xref not in seen_xrefs:
+                raw = doc.xref_stream_raw(xref)
+                if raw is None:
+                    continue
+                key = hashlib.sha256(raw).hexdigest()
+                seen_xrefs[xref] = key
+                image = images.setdefault(key, {
+                    'xrefs': [],
+                    'width': width,
+                    'height': height,
+                    'raw_size': len(raw),
+                    'dpi': None,
+                    'pages': [],
+                })
+                image['xrefs'].append(xref)
+            image = images[seen_xrefs[xref]]
+            if page.number not in image['pages']:
+                image['pages'].append(page.number)
+
+            # The largest rectangle the image is drawn in decides the DPI it needs
+            try:
+                rects = page.get_image_rects(xref)
+            except Exception:
+                rects = []
+            for rect in rects:
+                if rect.width <= 0:
+                    continue
+                dpi = width / (rect.width / 72)
+                if image['dpi'] is None or dpi < image['dpi']:
+                    image['dpi'] = dpi
+
+    return images
+
+
+@stage('decode')
+def load_pdf_image(doc, xref):
+    """Decode an image XObject into a PIL image (RGB or L)."""
+    pix = fitz.Pixmap(doc, xref)
+    if pix.alpha:
+        pix = fitz.Pixmap(pix, 0)
+    if pix.colorspace is None or pix.colorspace.n not in (1, 3):
+        pix = fitz.Pixmap(fitz.csRGB, pix)
+    mode = 'L' if pix.n == 1 else 'RGB'
+    return Image.frombytes(mode, (pix.width, pix.height), pix.samples)
+
+
+def encode_pdf_image(img, image, dpi, quality):
+    """
+    Downsample an image to dpi (if it is displayed above it) and JPEG-encode it.
+    Returns (data, width, height, grayscale).
+    """
+    if image['dpi'] and image['dpi'] > dpi:
+        scale = dpi / image['dpi']
+        size = (max(1, int(img.width * scale)), max(1, int(img.height * scale)))
+        img = img.resize(size, Image.LANCZOS)
+
+    buffer = BytesIO()
+    img.save(buffer, format='JPEG', quality=quality, optimize=True)
+    return buffer.getvalue(), img.width, img.height, img.mode == 'L'
+
+
+def sample_pdf_images(images, sample_pages=SAMPLE_PAGES):
+    """
+    Pick the images shown on up to sample_pages pages spread evenly
+    through the document. Returns their keys.
+    """
+    pages = sorted({page for image in images.values() for page in image['pages']})
+    if len(pages) > sample_pages:
+        step = len(pages) / sample_pages
+        pages = [pages[int(i * step + step / 2)] for i in range(sample_pages)]
+    pages = set(pages)
+    return [key for key, image in images.items() if pages.intersection(image['pages'])]
+
+
+def encode_all(doc, images, dpi, quality, keys=None):
+    """
+    Encode every collected image (or only those in keys) at one setting.
+    Returns {hash: (data, width, height, grayscale)} for the images that got smaller.
+    """
+    encoded = {}
+    for key in keys if keys is not None else images:
+        image = images[key]
+        try:
+            img = load_pdf_image(doc, image['xrefs'][0])
+            result = encode_pdf_image(img, image, dpi, quality)
+        except Exception as e:
+            logging.warning(f"Skipping image xref {image['xrefs'][0]}: {str(e)}")
+            continue
+        if len(result[0]) < image['raw_size']:
+            encoded[key] = result
+    return encoded
+
+
+def replace_pdf_image(doc, xref, data, width, height, grayscale):
+    """Swap an image XObject's stream for a JPEG, keeping the xref."""
+    doc.update_stream(xref, data, compress=False)
+    doc.xref_set_key(xref, 'Filter', '/DCTDecode')
+    doc.xref_set_key(xref, 'Width', str(width))
+    doc.xref_set_key(xref, 'Height', str(height))
+    doc.xref_set_key(xref, 'BitsPerComponent', '8')
+    doc.xref_set_key(xref, 'ColorSpace', '/DeviceGray' if grayscale else '/DeviceRGB')
+    for key in ('DecodeParms', 'Decode', 'Intent'):
+        doc.xref_set_key(xref, key, 'null')
+
+
+def save_compressed_pdf(doc, output_path):
+    """Save with unused objects dropped, duplicates merged and streams deflated."""
+    options = {'garbage': 4, 'deflate': True, 'deflate_images': True, 'deflate_fonts': True}
+    try:
+        doc.save(output_path, use_objstms=1, **options)
+    except TypeError:
+        # Older PyMuPDF without object stream support
+        doc.save(output_path, **options)
+
+
+def compress_pdf_native(input_path, output_path, target_size_mb=None, settings=None):
+    """
+    Compress a PDF in-process with PyMuPDF, without Ghostscript.
+
+    Image XObjects are downsampled to a DPI and re-encoded as JPEG at a
+    quality taken from settings (PDF_IMAGE_SETTINGS by default).
+
+    With a target size, the images on a few sample pages are encoded at
+    every setting and their size ratio is extrapolated to the whole file
+    to pick the best setting predicted to fit target_size_mb. All images
+    are then encoded once at that setting and the exact size (current file
+    minus the replaced image streams plus their new encodings) is checked;
+    a miss gets one corrective step, and only then are the remaining
+    settings bisected. The file is written once with duplicate objects
+    merged and streams deflated.
+
+    Returns a dict with the chosen 'dpi' and 'quality', the number of
+    'images' replaced, the 'sampledSize' the sample model predicted, the
+    'predictedSize' and final 'size' in bytes and the number of full
+    encode 'passes' over the images.
+    """
+    settings = settings or PDF_IMAGE_SETTINGS
+    target_bytes = int(target_size_mb * 1024 * 1024) if target_size_mb is not None else None
+    original_size = os.path.getsize(input_path)
+
+    with fitz.open(input_path) as doc:
+        images = collect_pdf_images(doc)
+
+        def predict(encoded):
+            # Duplicates all get the new stream and are then merged into one
+            saved = sum(images[key]['raw_size'] * len(images[key]['xrefs']) - len(result[0])
+                        for key, result in encoded.items())
+            return original_size - saved
+
+        passes = 0
+        index, encoded = None, {}
+        sampled_size = None
+        attempts = {}
+
+        def attempt(i):
+            nonlocal passes
+            if i not in attempts:
+                attempts[i] = encode_all(doc, images, *settings[i])
+                passes += 1
+            return attempts[i]
+
+        if images and target_bytes is None:
+            # Without a target the best looking setting is used
+            index, encoded = 0, attempt(0)
+        elif images:
+            # Fit the size ratio per setting on the sample pages
+            sample = sample_pdf_images(images)
+            sample_raw = sum(images[key]['raw_size'] for key in sample)
+            all_raw = sum(image['raw_size'] * len(image['xrefs']) for image in images.values())
+            guess = len(settings) - 1
+            for i in range(len(settings)):
+                sample_encoded = encode_all(doc, images, *settings[i], keys=sample)
+                sample_new = sum(len(sample_encoded[key][0]) if key in sample_encoded
+                                 else images[key]['raw_size'] for key in sample)
+                predicted = original_size - all_raw * (1 - sample_new / max(sample_raw, 1))
+                if len(sample) == len(images):
+                    # The sample is the whole file, the prediction is exact
+                    attempts[i] = sample_encoded
+                    passes += 1
+                if predicted <= target_bytes:
+                    guess, sampled_size = i, int(predicted)
+                    break
+            if sampled_size is None:
+                sampled_size = int(predicted)
+
+            # Encode everything once at the guess, with one corrective step either way
+            guess_size = predict(attempt(guess))
+            if guess_size <= target_bytes:
+                index = guess
+                # Well under the target, the better looking setting may fit too
+                if guess > 0 and guess_size < target_bytes * UNDERSHOOT \
+                        and predict(attempt(guess - 1)) <= target_bytes:
+                    index = guess - 1
+            elif guess < len(settings) - 1 and predict(attempt(guess + 1)) <= target_bytes:
+                index = guess + 1
+
+            if index is None and guess + 2 < len(settings):
+                # The model was well off, bisect the settings left
+                low, high = guess + 2, len(settings) - 1
+                while low <= high:
+                    mid = (low + high) // 2
+                    if predict(attempt(mid)) <= target_bytes:
+                        index, high = mid, mid - 1
+                    else:
+                        low = mid + 1
+                logging.info(f"PDF size prediction missed, bisected to setting {index}")
+
+            if index is None:
+                # Nothing fits, go as small as we can
+                index = len(settings) - 1
+            encoded = attempt(index)
+
+        for key, (data, width, height, grayscale) in encoded.items():
+            for xref in images[key]['xrefs']:
+                replace_pdf_image(doc, xref, data, width, height, grayscale)
+
+        save_compressed_pdf(doc, output_path)
+
+    dpi, quality = settings[index] if index is not None else (None, None)
+    stats = {
+        'engine': 'pymupdf',
+        'dpi': dpi,
+        'quality': quality,
+        'images': sum(len(images[key]['xrefs']) for key in encoded),
+        'sampledSize': sampled_size,
+        'predictedSize': predict(encoded),
+        'size': os.path.getsize(output_path),
+        'passes': passes,
+    }
+    logging.info(f"Native PDF compression: {original_size} -> {stats['size']} bytes "
+                 f"(dpi {dpi}, quality {quality}, {stats['images']} images, {passes} passes)")
+    return stats
@@ -0,0 +1,205 @@
+import os
+import copy
+import math
+import shutil
+import logging
+import tempfile
+from io import BytesIO
+from concurrent.futures import ProcessPoolExecutor
+from utils.doc_utils import add_page_text
+from utils.lazy_imports import lazy_import
+
+fitz = lazy_import('fitz')  # PyMuPDF
+docx = lazy_import('docx')
+pdf2docx = lazy_import('pdf2docx')
+
+# pdf2docx is slow to start in a fresh process; give each worker at least this many pages
+MIN_PAGES_PER_WORKER = 4
+
+# Relationship attributes that can appear in a document body
+RELATIONSHIP_ATTRIBUTES = ('r:embed', 'r:link', 'r:id')
+
+LAYOUT = 'layout'
+TEXT = 'text'
+
+
+def is_text_only(page):
+    """Whether a page holds nothing but text (no images, vector graphics or table rules)."""
+    return bool(page.get_text().strip()) and not page.get_images() and not page.get_drawings()
+
+
+def plan_segments(pdf_path, parts, text_fallback=False):
+    """
+    Split a PDF into contiguous (kind, start, end) page segments.
+
+    Layout pages are shared out in up to parts ranges for pdf2docx. With
+    text_fallback, runs of text-only pages become TEXT segments that are
+    converted with the text-block extractor instead.
+    """
+    with fitz.open(pdf_path) as doc:
+        kinds = [TEXT if text_fallback and is_text_only(page) else LAYOUT for page in doc]
+
+    runs = []
+    for page_num, kind in enumerate(kinds):
+        if runs and runs[-1][0] == kind:
+            runs[-1][2] = page_num + 1
+        else:
+            runs.append([kind, page_num, page_num + 1])
+
+    layout_pages = kinds.count(LAYOUT)
+    chunk = max(MIN_PAGES_PER_WORKER, math.ceil(layout_pages / max(1, parts)))
+    segments = []
+    for kind, start, end in runs:
+        if kind == TEXT:
+            segments.append((kind, start, end))
+            continue
+        for chunk_start in range(start, end, chunk):
+            segments.append((kind, chunk_start, min(end, chunk_start + chunk)))
+    return segments
+
+
+def convert_segment(pdf_path, docx_path, kind, start, end):
+    """Convert pages start..end-1 of a PDF to a DOCX file."""
+    if kind == LAYOUT:
+        cv = pdf2docx.Converter(pdf_path)
+        try:
+            cv.convert(docx_path, start=start, end=end)
+        finally:
+            cv.close()
+        return docx_path
+
+    from docx.shared import Pt
+
+    word_doc = docx.Document()
+    with fitz.open(pdf_path) as doc:
+        # Match the page size of the PDF
+        section = word_doc.sections[0]
+        section.page_width = Pt(doc[start].rect.width)
+        section.page_height = Pt(doc[start].rect.height)
+        for page_num in range(start, end):
+            add_page_text(word_doc, doc[page_num])
+            if page_num < end - 1:
+                word_doc.add_page_break()
+    word_doc.save(docx_path)
+    return docx_path
+
+
+def copy_relationships(element, source_part, target_part):
+    """Re-create the images and links element refers to in target_part, updating the ids."""
+    from docx.opc.constants import RELATIONSHIP_TYPE as RT
+    from docx.oxml.ns import qn
+
+    for node in element.iter():
+        for attribute in map(qn, RELATIONSHIP_ATTRIBUTES):
+            rel_id = node.get(attribute)
+            if not rel_id or rel_id not in source_part.rels:
+                continue
+            rel = source_part.rels[rel_id]
+            if rel.is_external:
+                new_id = target_part.relate_to(rel.target_ref, rel.reltype, is_external=True)
+            elif rel.reltype == RT.IMAGE:
+                new_id, _ = target_part.get_or_add_image(BytesIO(rel.target_part.blob))
+            else:
+                logging.warning(f"Dropping unsupported relationship {rel.reltype} while merging")
+                continue
+            node.set(attribute, new_id)
+
+
+def merge_docx(docx_paths, output_path):
+    """
+    Append the bodies of several DOCX files in order into one document.
+    Each file starts a new section so its page setup is kept.
+    """
+    from docx.oxml import OxmlElement
+    from docx.oxml.ns import qn
+
+    merged = docx.Document(docx_paths[0])
+    body = merged.element.body
+
+    for path in docx_paths[1:]:
+        part = docx.Document(path)
+        section = body.find(qn('w:sectPr'))
+
+        # Close the current last section with a section break paragraph
+        if section is not None:
+            paragraph = OxmlElement('w:p')
+            properties = OxmlElement('w:pPr')
+            properties.append(copy.deepcopy(section))
+            paragraph.append(properties)
+            section.addprevious(paragraph)
+
+        for child in part.element.body:
+            child = copy.deepcopy(child)
+            if child.tag == qn('w:sectPr'):
+                for reference in child.findall(qn('w:headerReference')) + child.findall(qn('w:footerReference')):
+                    child.remove(reference)
+            copy_relationships(child, part.part, merged.part)
+
+            if child.tag == qn('w:sectPr'):
+                # The appended file's final section becomes the document's
+                if section is not None:
+                    section.addnext(child)
+                    body.remove(section)
+                else:
+                    body.append(child)
+                section = child
+            elif section is not None:
+                section.addprevious(child)
+            else:
+                body.append(child)
+
+    merged.save(output_path)
+    return output_path
+
+
+def pdf_to_docx(pdf_path, output_path, parallel=None, text_fallback=False, workers=None):
+    """
+    Convert a PDF to DOCX with pdf2docx, optionally in page ranges.
+
+    With parallel (by default when the PDF has NISQ_DOCX_PARALLEL_PAGES pages
+    or more) the pages are split in ranges converted in up to workers
+    processes (NISQ_DOCX_WORKERS or the CPU count) and the results merged in
+    order. With text_fallback, text-only pages skip pdf2docx and go through
+    the much faster text-block extractor.
+
+    Returns a dict with 'pages', 'segments' and 'textPages'.
+    """
+    if not os.path.exists(pdf_path):
+        raise FileNotFoundError(f"PDF file not found: {pdf_path}")
+
+    if workers is None:
+        workers = int(os.environ.get('NISQ_DOCX_WORKERS', os.cpu_count() or 1))
+    with fitz.open(pdf_path) as doc:
+        page_count = len(doc)
+    if parallel is None:
+        parallel = page_count >= int(os.environ.get('NISQ_DOCX_PARALLEL_PAGES', 8))
+    parts = max(1, workers) if parallel else 1
+
+    segments = plan_segments(pdf_path, parts, text_fallback)
+    text_pages = sum(end - start for kind, start, end in segments if kind == TEXT)
+    stats = {'pages': page_count, 'segments': len(segments), 'textPages': text_pages}
+
+    if len(segments) == 1:
+        convert_segment(pdf_path, output_path, *segments[0])
+        return stats
+
+    temp_dir = tempfile.mkdtemp(prefix='pdf_docx_', dir=os.path.dirname(os.path.abspath(output_path)))
+    try:
+        paths = [os.path.join(temp_dir, f'{index:04d}.docx') for index in range(len(segments))]
+        layout_segments = sum(1 for kind, _, _ in segments if kind == LAYOUT)
+        pool_size = min(workers, layout_segments) if parallel else 1
+
+        if pool_size <= 1:
+            for path, segment in zip(paths, segments):
+                convert_segment(pdf_path, path, *segment)
+        else:
+            with ProcessPoolExecutor(max_workers=pool_size) as executor:
+                futures = [executor.submit(convert_segment, pdf_path, path, *segment)
+                           for path, segment in zip(paths, segments)]
+                for future in futures:
+                    future.result()
+
+        merge_docx(paths, output_path)
+    finally:
+        shutil.rmtree(temp_dir, ignore_errors=True)
+    return stats
@@ -1,63 +1,342 @@
 import os
 import uuid
-import tempfile
-from PyPDF2 import PdfReader, PdfWriter
-from reportlab.pdfgen import canvas
-from reportlab.lib.pagesizes import letter
-from reportlab.lib.units import inch
-from reportlab.lib.colors import lightgrey
-import fitz  # PyMuPDF
+import math
+import shutil
 import logging
+import time
+from io import BytesIO
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from utils.lazy_imports import lazy_import
+from utils.metrics import stage
+
+fitz = lazy_import('fitz')  # PyMuPDF
+Image = lazy_import('PIL.Image')
+
+# Fewer pages than this per worker process is not worth the process startup
+MIN_PAGES_PER_WORKER = 2
+
+# Watermark look: Helvetica, light grey, half transparent, across 80% of the page
+WATERMARK_FONT_SIZE = 60
+WATERMARK_COLOR = (0.83, 0.83, 0.83)
+WATERMARK_OPACITY = 0.5
+WATERMARK_COVERAGE = 0.8
+
+# Resource name pages refer to the shared watermark XObject by
+WATERMARK_XOBJECT = 'NisqWatermark'
+
+# Output formats for rendered pages, mapped to their file extension
+PAGE_IMAGE_FORMATS = {
+    'png': 'png',
+    'jpg': 'jpg',
+    'jpeg': 'jpg',
+    'webp': 'webp',
+}
+
+
+@stage('encode')
+def encode_pixmap(pix, output_format, quality=85):
+    """
+    Encode a rendered page pixmap as PNG, JPEG or WebP.
+    Returns the encoded bytes.
+    """
+    output_format = output_format.lower()
+    if output_format == 'png':
+        return pix.tobytes('png')
+    if output_format in ('jpg', 'jpeg'):
+        return pix.tobytes('jpeg', jpg_quality=quality)
+    if output_format == 'webp':
+        # MuPDF has no WebP writer, hand the raw samples to Pillow
+        img = Image.frombytes('RGB', (pix.width, pix.height), pix.samples)
+        buffer = BytesIO()
+        img.save(buffer, format='WEBP', quality=quality)
+        return buffer.getvalue()
+    raise ValueError(f"Unsupported image format: {output_format}")
+
+
+def render_page_range(pdf_path, start, end, dpi, output_format, output_dir, prefix):
+    """
+    Render pages start..end-1 of a PDF into image files.
+
+    Each call opens the document itself so ranges can be rendered in
+    separate processes. Returns a list of dicts with the 'page' number
+    (1-based), the image 'path' and the 'seconds' it took.
+    """
+    extension = PAGE_IMAGE_FORMATS[output_format.lower()]
+    zoom = dpi / 72  # PDF uses 72 dpi by default
+    matrix = fitz.Matrix(zoom, zoom)
+    pages = []
+
+    with fitz.open(pdf_path) as doc:
+        for page_num in range(start, end):
+            started = time.perf_counter()
+            with stage('render'):
+                pix = doc.load_page(page_num).get_pixmap(matrix=matrix, alpha=False)
+            image_path = os.path.join(output_dir, f"{prefix}_page_{page_num + 1}.{extension}")
+            with open(image_path, 'wb') as f:
+                f.write(encode_pixmap(pix, output_format))
+            pages.append({
+                'page': page_num + 1,
+                'path': image_path,
+                'seconds': round(time.perf_counter() - started, 4),
+            })
+            logging.debug(f"Created image: {image_path}")
+
+    return pages
+
+
+def split_page_ranges(page_count, parts):
+    """Split page_count pages into at most parts contiguous (start, end) ranges."""
+    parts = max(1, min(parts, page_count))
+    size, extra = divmod(page_count, parts)
+    ranges = []
+    start = 0
+    for i in range(parts):
+        end = start + size + (1 if i < extra else 0)
+        ranges.append((start, end))
+        start = end
+    return ranges
+
+
+def render_pdf_pages(pdf_path, dpi=300, output_format='png', output_dir=None, workers=None):
+    """
+    Render every page of a PDF, splitting the pages across worker processes.
+
+    workers defaults to NISQ_RENDER_WORKERS or the CPU count; small documents
+    are rendered in-process. Returns the per-page dicts from render_page_range
+    in page order.
+    """
+    if not os.path.exists(pdf_path):
+        raise FileNotFoundError(f"PDF file not found: {pdf_path}")
+
+    if output_format.lower() not in PAGE_IMAGE_FORMATS:
+        raise ValueError(f"Unsupported image format: {output_format}")
+
+    output_dir = output_dir or os.path.dirname(pdf_path)
+    prefix = os.path.splitext(os.path.basename(pdf_path))[0]
+
+    with fitz.open(pdf_path) as doc:
+        page_count = len(doc)
+    if page_count == 0:
+        raise ValueError("PDF has no pages")
+
+    if workers is None:
+        workers = int(os.environ.get('NISQ_RENDER_WORKERS', os.cpu_count() or 1))
+    parts = min(workers, page_count // MIN_PAGES_PER_WORKER)
+
+    if parts <= 1:
+        return render_page_range(pdf_path, 0, page_count, dpi, output_format, output_dir, prefix)
+
+    ranges = split_page_ranges(page_count, parts)
+    pages = []
+    with ProcessPoolExecutor(max_workers=len(ranges)) as executor:
+        futures = [
+            executor.submit(render_page_range, pdf_path, start, end, dpi, output_format, output_dir, prefix)
+            for start, end in ranges
+        ]
+        for future in futures:
+            pages.extend(future.result())
+    return pages
+
+
+def render_page_bytes(pdf_path, start, end, dpi, output_format):
+    """
+    Render pages start..end-1 of a PDF into memory.
+    Returns a list of dicts with the 'page' number, encoded 'data' and 'seconds'.
+    """
+    zoom = dpi / 72
+    matrix = fitz.Matrix(zoom, zoom)
+    pages = []
+
+    with fitz.open(pdf_path) as doc:
+        for page_num in range(start, end):
+            started = time.perf_counter()
+            with stage('render'):
+                pix = doc.load_page(page_num).get_pixmap(matrix=matrix, alpha=False)
+            pages.append({
+                'page': page_num + 1,
+                'data': encode_pixmap(pix, output_format),
+                'seconds': round(time.perf_counter() - started, 4),
+            })
+
+    return pages
+
+
+def iter_rendered_pages(pdf_path, dpi=300, output_format='png', workers=None):
+    """
+    Render a PDF page by page, yielding each page in order as soon as it is ready.
+
+    Small batches of pages are farmed out to worker processes with a bounded
+    look-ahead, so only a few encoded pages are held in memory at any time.
+    Yields the dicts from render_page_bytes.
+    """
+    if not os.path.exists(pdf_path):
+        raise FileNotFoundError(f"PDF file not found: {pdf_path}")
+
+    if output_format.lower() not in PAGE_IMAGE_FORMATS:
+        raise ValueError(f"Unsupported image format: {output_format}")
+
+    with fitz.open(pdf_path) as doc:
+        page_count = len(doc)
+    if page_count == 0:
+        raise ValueError("PDF has no pages")
+
+    if workers is None:
+        workers = int(os.environ.get('NISQ_RENDER_WORKERS', os.cpu_count() or 1))
+    workers = min(workers, page_count // MIN_PAGES_PER_WORKER)
+
+    if workers <= 1:
+        for page_num in range(page_count):
+            yield from render_page_bytes(pdf_path, page_num, page_num + 1, dpi, output_format)
+        return
+
+    batches = [(start, min(start + MIN_PAGES_PER_WORKER, page_count))
+               for start in range(0, page_count, MIN_PAGES_PER_WORKER)]
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        pending = deque()
+        for start, end in batches:
+            pending.append(executor.submit(render_page_bytes, pdf_path, start, end, dpi, output_format))
+            # Keep a couple of batches per worker in flight, no more
+            if len(pending) >= workers * 2:
+                yield from pending.popleft().result()
+        while pending:
+            yield from pending.popleft().result()
+
 
 def pdf_to_images(pdf_path, dpi=300, output_format='png'):
     """
     Convert a PDF to a series of images.
     Returns a list of paths to the created image files.
     """
-    if not os.path.exists(pdf_path):
-        raise FileNotFoundError(f"PDF file not found: {pdf_path}")
-    
-    output_dir = os.path.dirname(pdf_path)
-    image_paths = []
-    
     try:
-        # Open the PDF using PyMuPDF (fitz)
-        doc = fitz.open(pdf_path)
-        
-        if len(doc) == 0:
-            raise ValueError("PDF has no pages")
-        
-        for page_num in range(len(doc)):
-            page = doc.load_page(page_num)
-            
-            # Set the matrix for higher quality rendering
-            zoom = dpi / 72  # PDF uses 72 dpi by default
-            matrix = fitz.Matrix(zoom, zoom)
-            
-            # Render page to an image
-            pix = page.get_pixmap(matrix=matrix, alpha=False)
-            
-            # Generate output path for this image
-            image_filename = f"page_{page_num+1}_{uuid.uuid4()}"
-            if output_format.lower() in ('jpg', 'jpeg'):
-                image_path = os.path.join(output_dir, f"{image_filename}.jpg")
-                pix.save(image_path, "jpeg")
-            else:  # Default to PNG
-                image_path = os.path.join(output_dir, f"{image_filename}.png")
-                pix.save(image_path)
-            
-            image_paths.append(image_path)
-            logging.debug(f"Created image: {image_path}")
-        
-        return image_paths
+        pages = render_pdf_pages(pdf_path, dpi=dpi, output_format=output_format)
+        return [page['path'] for page in pages]
     
     except Exception as e:
         logging.error(f"Error converting PDF to images: {str(e)}")
         raise
 
-def add_watermark_to_pdf(pdf_path, watermark_text):
+def build_watermark(text, font_size=WATERMARK_FONT_SIZE, color=WATERMARK_COLOR, opacity=WATERMARK_OPACITY):
+    """
+    Lay out a watermark once, as a one-page PDF.
+    The text runs diagonally across a square page just large enough for it.
+    """
+    text_width = fitz.get_text_length(text, fontname='helv', fontsize=font_size)
+    side = (text_width + font_size) / math.sqrt(2) + font_size
+    watermark = fitz.open()
+    page = watermark.new_page(width=side, height=side)
+    center = fitz.Point(side / 2, side / 2)
+    page.insert_text(fitz.Point(center.x - text_width / 2, center.y + font_size * 0.35), text,
+                     fontname='helv', fontsize=font_size, color=color, fill_opacity=opacity,
+                     morph=(center, fitz.Matrix(45)))
+    return watermark
+
+
+def fit_matrix(source, target, rotate=0):
+    """
+    Matrix that draws the source rect centred in the target rect (both in
+    PDF coordinates), turned by rotate degrees and keeping its proportions.
+    """
+    center = (source.tl + source.br) / 2
+    matrix = fitz.Matrix(1, 0, 0, 1, -center.x, -center.y) * fitz.Matrix(rotate)
+    turned = source * matrix
+    scale = min(target.width / turned.width, target.height / turned.height)
+    center = (target.tl + target.br) / 2
+    return matrix * fitz.Matrix(scale, scale) * fitz.Matrix(1, 0, 0, 1, center.x, center.y)
+
+
+def set_page_resource(doc, page, category, name, value):
+    """Set /Resources/<category>/<name> of a page, following indirect dictionaries."""
+    xref, path = page.xref, ''
+    for key in ('Resources', category):
+        path = f'{path}/{key}' if path else key
+        kind, ref = doc.xref_get_key(xref, path)
+        if kind == 'xref':
+            xref, path = int(ref.split()[0]), ''
+    doc.xref_set_key(xref, f'{path}/{name}' if path else name, value)
+
+
+def stamp_watermark(doc, watermark, coverage=WATERMARK_COVERAGE):
+    """
+    Draw a watermark built by build_watermark over every page of an open PDF.
+
+    The watermark becomes one Form XObject shared by all pages. Each page
+    only gets a reference to it in its /Resources and a content stream
+    drawing it (shared by pages of the same size and rotation), scaled to
+    cover a fraction of the page and turned with the page's rotation so it
+    reads upright. The first page, where show_pdf_page grafts it in, draws
+    it through show_pdf_page's wrapper instead.
+    """
+    source = watermark[0].rect * ~watermark[0].transformation_matrix
+    shared = None  # xref of the watermark Form XObject
+    contents = {}  # (name, matrix) -> content stream xref
+    for page in doc:
+        # Work in unrotated page space; the page rotation is applied on display
+        rect = page.rect * page.derotation_matrix
+        side = min(rect.width, rect.height) * coverage
+        center = fitz.Point((rect.x0 + rect.x1) / 2, (rect.y0 + rect.y1) / 2)
+        target = fitz.Rect(center.x - side / 2, center.y - side / 2, center.x + side / 2, center.y + side / 2)
+
+        if shared is None or doc.xref_get_key(page.xref, 'Resources')[0] == 'null':
+            # Grafts the watermark in as a Form XObject (once: later calls reuse
+            # it) behind a small wrapper; also the way for pages inheriting resources
+            shared = page.show_pdf_page(target, watermark, 0, overlay=True, rotate=page.rotation)
+            continue
+
+        names = {item[1]: item[0] for item in doc.get_page_xobjects(page.number)}
+        names.update((item[7], item[0]) for item in doc.get_page_images(page.number))
+        name, count = WATERMARK_XOBJECT, 0
+        while names.get(name, shared) != shared:
+            count += 1
+            name = f'{WATERMARK_XOBJECT}{count}'
+        set_page_resource(doc, page, 'XObject', name, f'{shared} 0 R')
+
+        matrix = fit_matrix(source, target * ~page.transformation_matrix, page.rotation)
+        key = (name, tuple(round(value, 4) for value in matrix))
+        if key not in contents:
+            contents[key] = doc.get_new_xref()
+            doc.update_object(contents[key], '<<>>')
+            drawing = ' '.join(f'{value:.4f}' for value in key[1])
+            doc.update_stream(contents[key], f'q {drawing} cm /{name} Do Q'.encode())
+        page.wrap_contents()
+        kids = page.get_contents() + [contents[key]]
+        doc.xref_set_key(page.xref, 'Contents', '[' + ' '.join(f'{xref} 0 R' for xref in kids) + ']')
+
+
+def edit_pdf(pdf_path, output_path, edit, incremental=False):
+    """
+    Apply edit(doc) to a PDF and write the result to output_path.
+
+    A full save rewrites every object (dropping unused ones and deflating
+    streams). An incremental save copies the original bytes as they are and
+    appends only the objects edit added or changed as a PDF incremental
+    update, so its cost follows the size of the edit, not of the file.
+    Files that cannot take an incremental update (repaired or encrypted)
+    get a full save. Returns the save mode used, 'incremental' or 'full'.
+    """
+    if incremental:
+        # A plain byte copy (copy_file_range/sendfile), nothing is parsed
+        shutil.copyfile(pdf_path, output_path)
+        with fitz.open(output_path) as doc:
+            if doc.can_save_incrementally():
+                edit(doc)
+                doc.save(output_path, incremental=True, encryption=fitz.PDF_ENCRYPT_KEEP)
+                return 'incremental'
+        logging.info(f"{pdf_path} cannot be updated incrementally, rewriting it")
+
+    with fitz.open(pdf_path) as doc:
+        edit(doc)
+        doc.save(output_path, garbage=1, deflate=True)
+    return 'full'
+
+
+def add_watermark_to_pdf(pdf_path, watermark_text, output_path=None, incremental=False, stats=None):
     """
     Add a text watermark to each page of a PDF.
+
+    With incremental=True the watermark is appended to the original bytes
+    as an incremental update (see edit_pdf). The save mode used is recorded
+    in the optional stats dict.
     Returns the path to the watermarked PDF.
     """
     if not os.path.exists(pdf_path):
@@ -66,62 +345,21 @@ def add_watermark_to_pdf(pdf_path, watermark_text):
     if not watermark_text or not watermark_text.strip():
         raise ValueError("Watermark text cannot be empty")
     
-    output_dir = os.path.dirname(pdf_path)
-    watermarked_filename = f"watermarked_{uuid.uuid4()}.pdf"
-    output_path = os.path.join(output_dir, watermarked_filename)
-    
-    # Create a temporary PDF with the watermark
-    watermark_pdf = tempfile.NamedTemporaryFile(suffix='.pdf', delete=False).name
+    if output_path is None:
+        output_dir = os.path.dirname(pdf_path)
+        output_path = os.path.join(output_dir, f"watermarked_{uuid.uuid4()}.pdf")
     
     try:
-        # Create the watermark using reportlab
-        c = canvas.Canvas(watermark_pdf, pagesize=letter)
-        width, height = letter
-        
-        # Watermark properties
-        c.setFont("Helvetica", 60)
-        c.setFillColor(lightgrey)
-        c.setFillAlpha(0.5)  # Make it semi-transparent
-        c.saveState()
-        
-        # Rotate and position the watermark
-        c.translate(width/2, height/2)
-        c.rotate(45)
-        c.drawCentredString(0, 0, watermark_text)
-        c.restoreState()
-        c.save()
-        
-        # Apply the watermark to each page
-        with open(pdf_path, 'rb') as input_file, open(output_path, 'wb') as output_file:
-            try:
-                pdf_reader = PdfReader(input_file)
-                watermark_reader = PdfReader(watermark_pdf)
-                pdf_writer = PdfWriter()
-                
-                # Check if we have valid PDFs
-                if len(pdf_reader.pages) == 0:
+        with build_watermark(watermark_text) as watermark:
+            def stamp(doc):
+                if doc.page_count == 0:
                     raise ValueError("Input PDF has no pages")
-                
-                if len(watermark_reader.pages) == 0:
-                    raise ValueError("Watermark PDF has no pages")
-                
-                # Get the watermark page
-                watermark_page = watermark_reader.pages[0]
-                
-                # Apply to each page
-                for page_num in range(len(pdf_reader.pages)):
-                    page = pdf_reader.pages[page_num]
-                    # Use merge_page to add the watermark underneath the content
-                    page.merge_page(watermark_page)
-                    pdf_writer.add_page(page)
-                
-                # Write the output file
-                pdf_writer.write(output_file)
-                
-            except Exception as pdf_error:
-                logging.error(f"PyPDF2 error: {str(pdf_error)}")
-                raise
+                stamp_watermark(doc, watermark)
+            
+            save_mode = edit_pdf(pdf_path, output_path, stamp, incremental)
         
+        if stats is not None:
+            stats['saveMode'] = save_mode
         return output_path
         
     except Exception as e:
@@ -130,14 +368,6 @@ def add_watermark_to_pdf(pdf_path, watermark_text):
         if os.path.exists(output_path):
             try:
                 os.remove(output_path)
-            except:
+            except OSError:
                 pass
         raise
-    
-    finally:
-        # Clean up the temporary watermark file
-        try:
-            if os.path.exists(watermark_pdf):
-                os.unlink(watermark_pdf)
-        except Exception as e:
-            logging.error(f"Error removing temporary file: {str(e)}")
@@ -0,0 +1,390 @@
+import os
+import zlib
+import struct
+import logging
+from io import BytesIO
+from utils.lazy_imports import lazy_import
+
+Image = lazy_import('PIL.Image')
+ImageOps = lazy_import('PIL.ImageOps')
+JpegImagePlugin = lazy_import('PIL.JpegImagePlugin')
+ImageSequence = lazy_import('PIL.ImageSequence')
+
+# Pages are sized as if images were scanned at this resolution when the
+# file does not say (matches what Pillow's PDF export used before)
+DEFAULT_IMAGE_DPI = 100.0
+
+# Rows of decoded pixels compressed at a time for non-JPEG images
+BAND_ROWS = 256
+
+# JPEG quality for decoded photos (images that are neither a JPEG nor a plain PNG)
+PHOTO_QUALITY = int(os.environ.get('NISQ_IMAGE_PDF_QUALITY', 90))
+
+# Modes of palette and bilevel images, which are graphics: kept lossless
+GRAPHIC_MODES = ('1', 'P', 'PA')
+
+# Copy size for JPEG passthrough
+COPY_CHUNK = 1024 * 1024
+
+# EXIF orientation values that are a pure rotation, and the page /Rotate for them
+EXIF_ROTATIONS = {1: 0, 3: 180, 6: 90, 8: 270}
+
+# JPEG colour modes we can embed without decoding
+JPEG_COLORSPACES = {'RGB': '/DeviceRGB', 'L': '/DeviceGray', 'CMYK': '/DeviceCMYK'}
+
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+
+# PNG colour types whose pixel data we can embed without decoding: colour space, channels
+PNG_COLORSPACES = {0: ('/DeviceGray', 1), 2: ('/DeviceRGB', 3)}
+
+
+class StreamingPdfWriter:
+    """
+    Write a PDF of full-page images one page at a time.
+
+    Objects are written to the output file as soon as each page is added
+    and only their byte offsets are kept, so memory use does not grow with
+    the number of pages. JPEGs and plain PNGs are embedded as they are
+    (DCTDecode, FlateDecode with PNG predictors) without being decoded;
+    other images are decoded one at a time and stored as JPEGs, or
+    losslessly (FlateDecode) BAND_ROWS rows at a time.
+    """
+
+    def __init__(self, output_path):
+        self._file = open(output_path, 'wb')
+        self._offsets = {}
+        self._next_id = 3  # 1 is the catalog, 2 the page tree
+        self._pages = []
+        self._file.write(b'%PDF-1.4\n%\xe2\xe3\xcf\xd3\n')
+
+    def _reserve(self):
+        obj_id = self._next_id
+        self._next_id += 1
+        return obj_id
+
+    def _begin(self, obj_id):
+        self._offsets[obj_id] = self._file.tell()
+        self._file.write(f'{obj_id} 0 obj\n'.encode())
+
+    def _write_object(self, obj_id, body):
+        self._begin(obj_id)
+        self._file.write(body.encode() + b'\nendobj\n')
+
+    def _write_stream(self, obj_id, dictionary, chunks, length=None):
+        """Write a stream object; without a known length it goes in a follow-up object."""
+        length_id = None
+        if length is None:
+            length_id = self._reserve()
+            length_ref = f'{length_id} 0 R'
+        else:
+            length_ref = str(length)
+
+        self._begin(obj_id)
+        self._file.write(f'<< {dictionary} /Length {length_ref} >>\nstream\n'.encode())
+        start = self._file.tell()
+        for chunk in chunks:
+            self._file.write(chunk)
+        written = self._file.tell() - start
+        self._file.write(b'\nendstream\nendobj\n')
+
+        if length_id is not None:
+            self._write_object(length_id, str(written))
+        return written
+
+    def _add_page(self, image_dictionary, chunks, width, height, dpi, rotate=0, length=None):
+        """
+        Write an image, its content stream and page. If anything fails part
+        way (e.g. the image does not decode) the partial page is dropped.
+        """
+        first_id = self._next_id
+        start = self._file.tell()
+        try:
+            return self._write_page(image_dictionary, chunks, width, height, dpi, rotate, length)
+        except BaseException:
+            self._file.seek(start)
+            self._file.truncate()
+            for obj_id in range(first_id, self._next_id):
+                self._offsets.pop(obj_id, None)
+            self._next_id = first_id
+            raise
+
+    def _write_page(self, image_dictionary, chunks, width, height, dpi, rotate, length):
+        image_id = self._reserve()
+        image_bytes = self._write_stream(
+            image_id, f'/Type /XObject /Subtype /Image /Width {width} /Height {height} {image_dictionary}',
+            chunks, length)
+
+        page_width = width * 72.0 / dpi[0]
+        page_height = height * 72.0 / dpi[1]
+        content = f'q {page_width:.4f} 0 0 {page_height:.4f} 0 0 cm /Im0 Do Q'.encode()
+        content_id = self._reserve()
+        self._write_stream(content_id, '', [content], len(content))
+
+        page_id = self._reserve()
+        rotation = f' /Rotate {rotate}' if rotate else ''
+        self._write_object(page_id, (
+            f'<< /Type /Page /Parent 2 0 R /MediaBox [0 0 {page_width:.4f} {page_height:.4f}]'
+            f' /Resources << /XObject << /Im0 {image_id} 0 R >> >> /Contents {content_id} 0 R{rotation} >>'))
+        self._pages.append(page_id)
+        return image_bytes
+
+    def add_jpeg(self, source, dpi=None):
+        """
+        Embed a JPEG (path or bytes) as a page without decoding it.
+        Returns the bytes the image takes in the PDF.
+        """
+        if isinstance(source, (bytes, bytearray)):
+            length = len(source)
+            opener = lambda: BytesIO(source)
+        else:
+            length = os.path.getsize(source)
+            opener = lambda: open(source, 'rb')
+
+        with opener() as f:
+            # Only the header is parsed here
+            with Image.open(f) as img:
+                width, height, mode = img.width, img.height, img.mode
+                orientation = img.getexif().get(0x0112, 1)
+                dpi = dpi or image_dpi(img)
+                adobe = 'adobe' in img.info
+
+            if mode not in JPEG_COLORSPACES or orientation not in EXIF_ROTATIONS:
+                raise ValueError(f"JPEG in mode {mode} with orientation {orientation} needs decoding")
+
+            decode = ''
+            if mode == 'CMYK' and adobe:
+                # Photoshop writes inverted CMYK
+                decode = ' /Decode [1 0 1 0 1 0 1 0]'
+
+            f.seek(0)
+            return self._add_page(
+                f'/ColorSpace {JPEG_COLORSPACES[mode]} /BitsPerComponent 8 /Filter /DCTDecode{decode}',
+                iter(lambda: f.read(COPY_CHUNK), b''), width, height, dpi,
+                rotate=EXIF_ROTATIONS[orientation], length=length)
+
+    def add_png(self, source, dpi=None):
+        """
+        Embed a PNG (path or bytes) as a page without decoding it: its
+        compressed pixel data is a Flate stream with PNG predictors.
+        Returns the bytes the image takes in the PDF.
+        """
+        if not isinstance(source, (bytes, bytearray)):
+            with open(source, 'rb') as f:
+                source = f.read()
+        width, height, color_type, data = png_image_data(source)
+        if dpi is None:
+            with Image.open(BytesIO(source)) as img:
+                dpi = image_dpi(img)
+
+        colorspace, colors = PNG_COLORSPACES[color_type]
+        return self._add_page(
+            f'/ColorSpace {colorspace} /BitsPerComponent 8 /Filter /FlateDecode'
+            f' /DecodeParms << /Predictor 15 /Colors {colors} /Columns {width} >>',
+            [data], width, height, dpi, length=len(data))
+
+    def add_image(self, img, dpi=None, quality=None):
+        """
+        Embed a decoded PIL image as a page: losslessly, or as a JPEG of
+        the given quality. Transparency is flattened onto white.
+        Returns the bytes the image takes in the PDF.
+        """
+        dpi = dpi or image_dpi(img)
+        # Decode up front so a broken file fails before anything is written
+        img.load()
+        img = flatten_image(img)
+        if quality is not None:
+            buffer = BytesIO()
+            img.save(buffer, 'JPEG', quality=quality)
+            return self.add_jpeg(buffer.getvalue(), dpi=dpi)
+        colorspace = '/DeviceGray' if img.mode == 'L' else '/DeviceRGB'
+
+        def chunks():
+            compressor = zlib.compressobj(6)
+            for top in range(0, img.height, BAND_ROWS):
+                band = img.crop((0, top, img.width, min(img.height, top + BAND_ROWS)))
+                yield compressor.compress(band.tobytes())
+            yield compressor.flush()
+
+        return self._add_page(f'/ColorSpace {colorspace} /BitsPerComponent 8 /Filter /FlateDecode',
+                              chunks(), img.width, img.height, dpi)
+
+    def add_transposed_jpeg(self, source, dpi=None):
+        """
+        Embed a JPEG whose EXIF orientation is not a pure rotation (it is
+        mirrored) by turning it upright and re-encoding it as a JPEG with
+        its own quantization tables and subsampling, so it keeps roughly
+        its quality and size. Returns the bytes the image takes in the PDF.
+        """
+        if isinstance(source, (bytes, bytearray)):
+            source = BytesIO(source)
+        with Image.open(source) as img:
+            if img.format != 'JPEG' or img.mode not in ('RGB', 'L'):
+                raise ValueError(f"{img.format} in mode {img.mode} cannot be re-encoded as it was")
+            orientation = img.getexif().get(0x0112, 1)
+            dpi = dpi or image_dpi(img)
+            if orientation in (5, 6, 7, 8):
+                # The axes swap along with the pixels
+                dpi = (dpi[1], dpi[0])
+            options = {'qtables': img.quantization, 'subsampling': JpegImagePlugin.get_sampling(img)}
+            buffer = BytesIO()
+            ImageOps.exif_transpose(img).save(buffer, 'JPEG', **options)
+        return self.add_jpeg(buffer.getvalue(), dpi=dpi)
+
+    def close(self):
+        """Write the page tree, catalog and cross-reference table."""
+        kids = ' '.join(f'{page_id} 0 R' for page_id in self._pages)
+        self._write_object(1, '<< /Type /Catalog /Pages 2 0 R >>')
+        self._write_object(2, f'<< /Type /Pages /Kids [{kids}] /Count {len(self._pages)} >>')
+
+        xref_offset = self._file.tell()
+        size = self._next_id
+        lines = [f'xref\n0 {size}\n', '0000000000 65535 f \n']
+        for obj_id in range(1, size):
+            lines.append(f'{self._offsets[obj_id]:010d} 00000 n \n')
+        lines.append(f'trailer\n<< /Size {size} /Root 1 0 R >>\nstartxref\n{xref_offset}\n%%EOF\n')
+        self._file.write(''.join(lines).encode())
+        self._file.close()
+
+    @property
+    def page_count(self):
+        return len(self._pages)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self._file.close()
+
+
+def image_dpi(img):
+    """The resolution an image declares, or DEFAULT_IMAGE_DPI."""
+    dpi = img.info.get('dpi')
+    try:
+        x, y = float(dpi[0]), float(dpi[1])
+        if x > 1 and y > 1:
+            return x, y
+    except (TypeError, ValueError, IndexError):
+        pass
+    return DEFAULT_IMAGE_DPI, DEFAULT_IMAGE_DPI
+
+
+def png_image_data(data):
+    """
+    Width, height, colour type and compressed pixel data (the IDAT chunks)
+    of a PNG. Raises ValueError for PNGs that cannot be embedded as they
+    are: palette, alpha or transparency, other than 8 bits, or interlaced.
+    """
+    if not data.startswith(PNG_SIGNATURE):
+        raise ValueError("Not a PNG")
+    header = None
+    chunks = []
+    pos = len(PNG_SIGNATURE)
+    while pos + 8 <= len(data):
+        length, kind = struct.unpack('>I4s', data[pos:pos + 8])
+        body = data[pos + 8:pos + 8 + length]
+        if kind == b'IHDR':
+            header = struct.unpack('>IIBBBBB', body)
+        elif kind == b'IDAT':
+            chunks.append(body)
+        elif kind == b'tRNS':
+            raise ValueError("PNG with transparency needs decoding")
+        elif kind == b'IEND':
+            break
+        pos += length + 12  # length, type and CRC
+
+    if header is None or not chunks:
+        raise ValueError("Truncated PNG")
+    width, height, bit_depth, color_type, _, _, interlace = header
+    if bit_depth != 8 or color_type not in PNG_COLORSPACES or interlace:
+        raise ValueError(f"PNG with colour type {color_type}, depth {bit_depth} needs decoding")
+    return width, height, color_type, b''.join(chunks)
+
+
+def flatten_image(img):
+    """Convert an image to RGB or L, putting any transparency on white."""
+    if img.mode in ('RGB', 'L'):
+        return img
+    if img.mode in ('RGBA', 'LA', 'PA') or (img.mode == 'P' and 'transparency' in img.info):
+        rgba = img.convert('RGBA')
+        background = Image.new('RGB', img.size, (255, 255, 255))
+        background.paste(rgba, mask=rgba.getchannel('A'))
+        return background
+    if img.mode in ('1', 'I;16', 'I'):
+        return img.convert('L')
+    return img.convert('RGB')
+
+
+def add_png_or_photo(writer, path):
+    """
+    Embed a plain PNG as it is or, if smaller, as a JPEG of PHOTO_QUALITY.
+    Raises ValueError for PNGs that cannot be passed through.
+    Returns the bytes the image takes in the PDF.
+    """
+    with open(path, 'rb') as f:
+        data = f.read()
+    png_image_data(data)
+
+    with Image.open(BytesIO(data)) as img:
+        dpi = image_dpi(img)
+        buffer = BytesIO()
+        img.save(buffer, 'JPEG', quality=PHOTO_QUALITY)
+    if buffer.tell() < len(data):
+        return writer.add_jpeg(buffer.getvalue(), dpi=dpi)
+    return writer.add_png(data, dpi=dpi)
+
+
+def write_images_pdf(image_paths, output_path):
+    """
+    Stream image files into a PDF, one page per image (or per frame).
+
+    JPEGs are passed through untouched and plain PNGs too unless a JPEG of
+    them is smaller (photos saved as PNG); other images are decoded and
+    written one at a time, photos as JPEGs of PHOTO_QUALITY and palette or
+    bilevel graphics losslessly. Unreadable images are skipped
+    with a warning.
+    Returns a list with the 'path' and embedded 'bytes' of each page.
+    """
+    pages = []
+    with StreamingPdfWriter(output_path) as writer:
+        for path in image_paths:
+            try:
+                with Image.open(path) as img:
+                    is_jpeg = img.format == 'JPEG'
+                    is_png = img.format == 'PNG'
+                if is_png:
+                    try:
+                        pages.append({'path': path, 'bytes': add_png_or_photo(writer, path)})
+                        continue
+                    except ValueError as e:
+                        logging.info(f"Decoding {path}: {str(e)}")
+                elif is_jpeg:
+                    try:
+                        pages.append({'path': path, 'bytes': writer.add_jpeg(path)})
+                        continue
+                    except ValueError as e:
+                        logging.info(f"Re-encoding {path}: {str(e)}")
+                    try:
+                        # Mirrored orientations: still a JPEG, just upright
+                        pages.append({'path': path, 'bytes': writer.add_transposed_jpeg(path)})
+                        continue
+                    except ValueError as e:
+                        logging.info(f"Decoding {path}: {str(e)}")
+
+                with Image.open(path) as img:
+                    dpi = image_dpi(img)
+                    for frame in ImageSequence.Iterator(img):
+                        if is_jpeg:
+                            # Orientation the passthrough could not express as a page rotation
+                            frame = ImageOps.exif_transpose(frame)
+                        quality = None if frame.mode in GRAPHIC_MODES else PHOTO_QUALITY
+                        pages.append({'path': path, 'bytes': writer.add_image(frame, dpi, quality)})
+            except Exception as e:
+                logging.warning(f"Skipping image {path}: {str(e)}")
+
+    if not pages:
+        os.remove(output_path)
+        raise ValueError("No valid images to convert")
+    return pages
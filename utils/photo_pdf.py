@@ -0,0 +1,216 @@
+import os
+import logging
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from utils.image_utils import encode_image
+from utils.pdf_writer import (EXIF_ROTATIONS, JPEG_COLORSPACES, StreamingPdfWriter, flatten_image,
+                              image_dpi, png_image_data)
+from utils.size_predictor import predict_target_size
+from utils.lazy_imports import lazy_import
+from utils.backends import run_backend
+from utils.batch import split_budget
+from utils.metrics import stage, submit_with_timings
+
+Image = lazy_import('PIL.Image')
+ImageOps = lazy_import('PIL.ImageOps')
+ImageSequence = lazy_import('PIL.ImageSequence')
+
+# Page sizes in inches (portrait)
+PAGE_SIZES = {
+    'a4': (8.27, 11.69),
+    'letter': (8.5, 11.0),
+    'legal': (8.5, 14.0),
+}
+
+# Rough bytes a page costs on top of its image (page, content and xref entries)
+PAGE_OVERHEAD = 400
+
+# Quality range used when re-encoding photos for a PDF
+MIN_PHOTO_QUALITY = 30
+DEFAULT_PHOTO_QUALITY = 85
+
+
+def page_box(page_size, dpi, landscape):
+    """Pixel box an image must fit in to print on page_size at dpi."""
+    width, height = PAGE_SIZES[page_size]
+    if landscape:
+        width, height = height, width
+    return int(width * dpi), int(height * dpi)
+
+
+def source_passthrough(img, path):
+    """
+    The format ('JPEG' or 'PNG') and bytes of an image file the PDF writer
+    can embed without decoding, or None.
+    """
+    if getattr(img, 'n_frames', 1) != 1:
+        return None
+    if img.format == 'JPEG':
+        if img.mode not in JPEG_COLORSPACES or img.getexif().get(0x0112, 1) not in EXIF_ROTATIONS:
+            return None
+    elif img.format != 'PNG':
+        return None
+
+    with open(path, 'rb') as f:
+        data = f.read()
+    if img.format == 'PNG':
+        try:
+            png_image_data(data)
+        except ValueError:
+            return None
+    return img.format, data
+
+
+def prepare_page_image(path, page_size=None, dpi=150, budget=None, quality=DEFAULT_PHOTO_QUALITY):
+    """
+    Resize and JPEG-encode the frames of an image for embedding in a PDF.
+
+    With a page_size, frames larger than the page at dpi are shrunk to fit
+    it. With a byte budget (shared between the frames) the quality, then
+    the scale, is solved to fit it; otherwise frames are encoded at quality.
+    The declared resolution is adjusted so the page keeps its physical size.
+    A JPEG or PNG source the writer can embed as it is is kept instead when
+    it fits the budget or is no larger than the re-encoded frame.
+
+    Returns a list of dicts with the 'data', its 'format' ('JPEG' or 'PNG'),
+    page 'dpi', pixel 'width'/'height' and 'quality' (None for a kept
+    source) of each frame.
+    """
+    frames = []
+    with Image.open(path) as img:
+        frame_count = getattr(img, 'n_frames', 1)
+        source = source_passthrough(img, path)
+        for frame in ImageSequence.Iterator(img):
+            dpi_x, dpi_y = image_dpi(img)
+            with stage('decode'):
+                frame = flatten_image(ImageOps.exif_transpose(frame))
+
+            if page_size:
+                box = page_box(page_size, dpi, frame.width > frame.height)
+                scale = min(box[0] / frame.width, box[1] / frame.height)
+                if scale < 1:
+                    size = (max(1, int(frame.width * scale)), max(1, int(frame.height * scale)))
+                    frame = frame.resize(size, Image.LANCZOS)
+                # Never let the page come out larger than page_size
+                fit_dpi = max(frame.width / box[0], frame.height / box[1]) * dpi
+                dpi_x = dpi_y = max(fit_dpi, min(dpi_x, dpi_y))
+
+            if source and budget is not None and len(source[1]) <= budget:
+                data = None
+                scale = 1.0
+            elif budget is not None:
+                result = predict_target_size(frame, 'JPEG', max(1, budget // frame_count),
+                                             min_quality=MIN_PHOTO_QUALITY, max_quality=quality,
+                                             min_scale=0.25)
+                data, frame_quality, scale = result['data'], result['quality'], result['scale']
+            else:
+                data, frame_quality, scale = encode_image(frame, 'JPEG', quality=quality), quality, 1.0
+
+            if source and (data is None or len(source[1]) <= len(data)):
+                # The source has more pixels (or as many) on the same page size
+                factor = max(img.size) / max(frame.width * scale, frame.height * scale)
+                frames.append({
+                    'data': source[1],
+                    'format': source[0],
+                    'dpi': (dpi_x * scale * factor, dpi_y * scale * factor),
+                    'width': round(frame.width * scale * factor),
+                    'height': round(frame.height * scale * factor),
+                    'quality': None,
+                })
+                continue
+
+            frames.append({
+                'data': data,
+                'format': 'JPEG',
+                'dpi': (dpi_x * scale, dpi_y * scale),
+                'width': max(1, int(frame.width * scale)),
+                'height': max(1, int(frame.height * scale)),
+                'quality': frame_quality,
+            })
+    return frames
+
+
+def fitted_source_bytes(path, page_size, dpi):
+    """
+    File size of an image, less the share of its pixels it loses when
+    fitted to the page; the header is all that is read.
+    """
+    scale = 1.0
+    if page_size:
+        with Image.open(path) as img:
+            width, height = img.size
+        box = page_box(page_size, dpi, width > height)
+        scale = min(1.0, box[0] / width, box[1] / height)
+    return os.path.getsize(path) * scale * scale
+
+
+def build_photo_pdf(image_paths, output_path, page_size=None, dpi=150, target_bytes=None,
+                    quality=DEFAULT_PHOTO_QUALITY, max_workers=None):
+    """
+    Combine images into a PDF, optionally fitting them to a page size and
+    the whole file to target_bytes.
+
+    Without a page_size or target the images go in untouched, on the best
+    'images-to-pdf' backend (see utils/backends.py). Otherwise each image is resized and re-encoded on a
+    thread pool of max_workers (NISQ_MEDIA_WORKERS by default), the target
+    being shared between the images by their (page-fitted) file size with
+    no image getting more than that, and the pages are written in order as
+    they become ready.
+
+    Returns a list with the 'path', embedded 'bytes', 'width', 'height' and
+    'quality' of each page.
+    """
+    if not page_size and target_bytes is None:
+        backend, pages = run_backend('images-to-pdf', image_paths, output_path)
+        return pages
+
+    if max_workers is None:
+        max_workers = int(os.environ.get('NISQ_MEDIA_WORKERS', min(4, os.cpu_count() or 1)))
+
+    budgets = [None] * len(image_paths)
+    if target_bytes is not None:
+        sizes = []
+        for path in image_paths:
+            try:
+                sizes.append(fitted_source_bytes(path, page_size, dpi))
+            except Exception as e:
+                logging.warning(f"Could not read image size of {path}: {str(e)}")
+                sizes.append(0)
+        image_budget = max(target_bytes - PAGE_OVERHEAD * (len(image_paths) + 1), len(image_paths))
+        budgets = [int(budget) for budget in split_budget(sizes, image_budget)]
+
+    pages = []
+    with StreamingPdfWriter(output_path) as writer, \
+            ThreadPoolExecutor(max_workers=max(1, max_workers)) as executor:
+        pending = deque()
+
+        def write_pages(path, future):
+            try:
+                frames = future.result()
+            except Exception as e:
+                logging.warning(f"Skipping image {path}: {str(e)}")
+                return
+            for frame in frames:
+                add = writer.add_png if frame['format'] == 'PNG' else writer.add_jpeg
+                embedded = add(frame['data'], dpi=frame['dpi'])
+                pages.append({
+                    'path': path,
+                    'bytes': embedded,
+                    'width': frame['width'],
+                    'height': frame['height'],
+                    'quality': frame['quality'],
+                })
+
+        for path, budget in zip(image_paths, budgets):
+            pending.append((path, submit_with_timings(executor, prepare_page_image, path, page_size, dpi, budget, quality)))
+            # Bound the number of encoded images held in memory at once
+            if len(pending) >= max_workers * 2:
+                write_pages(*pending.popleft())
+
+        while pending:
+            write_pages(*pending.popleft())
+
+    if not pages:
+        os.remove(output_path)
+        raise ValueError("No valid images to convert")
+    return pages
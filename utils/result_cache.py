@@ -0,0 +1,168 @@
+import os
+import json
+import time
+import fcntl
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+
+# Size of the chunks read while hashing/copying uploads
+CHUNK_SIZE = 1024 * 1024
+
+
+def copy_and_hash(source, destination_path, chunk_size=CHUNK_SIZE):
+    """
+    Copy a readable stream to destination_path in chunks, hashing as it goes.
+    Returns the hex SHA-256 digest of the copied bytes.
+    """
+    digest = hashlib.sha256()
+    with open(destination_path, 'wb') as f:
+        while True:
+            chunk = source.read(chunk_size)
+            if not chunk:
+                break
+            digest.update(chunk)
+            f.write(chunk)
+    return digest.hexdigest()
+
+
+def make_key(operation, input_hashes, params=None):
+    """
+    Build the cache key for an operation run on some inputs with some parameters.
+    The order of input_hashes matters (e.g. page order for photo-to-pdf).
+    """
+    material = json.dumps({
+        'operation': operation,
+        'inputs': list(input_hashes),
+        'params': params or {},
+    }, sort_keys=True)
+    return hashlib.sha256(material.encode('utf-8')).hexdigest()
+
+
+class ResultCache:
+    """
+    Content-addressed cache of conversion results.
+
+    Entries map a key from make_key to the JSON payload a route returned and
+    the artifact file it produced in folder. Entries are evicted least
+    recently used first once the artifacts add up to more than max_bytes.
+    The index is persisted next to the artifacts; every change reloads it
+    under a file lock so concurrent workers do not overwrite each other.
+    """
+
+    def __init__(self, folder, max_bytes, index_name='.result_cache.json'):
+        self.folder = folder
+        self.max_bytes = max_bytes
+        self.index_path = os.path.join(folder, index_name)
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self._load()
+
+    def _load(self):
+        try:
+            with open(self.index_path) as f:
+                entries = json.load(f)
+        except FileNotFoundError:
+            entries = []
+        except (OSError, ValueError) as e:
+            logging.warning(f"Ignoring unreadable result cache index: {str(e)}")
+            entries = []
+        entries.sort(key=lambda entry: entry['lastUsed'])
+        self._entries = OrderedDict((entry['key'], entry) for entry in entries)
+
+    def _save(self):
+        temp_path = f"{self.index_path}.{os.getpid()}.tmp"
+        try:
+            with open(temp_path, 'w') as f:
+                json.dump(list(self._entries.values()), f)
+            os.replace(temp_path, self.index_path)
+        except OSError as e:
+            logging.error(f"Could not save result cache index: {str(e)}")
+
+    @contextmanager
+    def _index_locked(self):
+        """
+        Read-modify-write the index: hold this process's lock and the file
+        lock, reload the index on entry and save it on exit.
+        """
+        with self._lock, open(self.index_path + '.lock', 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            self._load()
+            yield
+            self._save()
+
+    def total_bytes(self):
+        return sum(entry['size'] for entry in self._entries.values())
+
+    def get(self, key):
+        """Return the cached payload for key, or None on a miss."""
+        with self._index_locked():
+            entry = self._entries.get(key)
+            if entry is not None and not os.path.exists(os.path.join(self.folder, entry['filename'])):
+                # The artifact was removed behind our back
+                del self._entries[key]
+                entry = None
+
+            if entry is None:
+                self.misses += 1
+                return None
+
+            self.hits += 1
+            entry['lastUsed'] = time.time()
+            self._entries.move_to_end(key)
+            return dict(entry['payload'], cached=True)
+
+    def discard(self, key):
+        """Forget key after get returned it but its artifact turned out to be gone."""
+        with self._index_locked():
+            self._entries.pop(key, None)
+            self.hits -= 1
+            self.misses += 1
+
+    def put(self, key, payload, artifact_path):
+        """Remember payload and its artifact under key, evicting old entries if needed."""
+        if not payload.get('success') or not artifact_path or not os.path.exists(artifact_path):
+            return
+
+        size = os.path.getsize(artifact_path)
+        if size > self.max_bytes:
+            return
+
+        with self._index_locked():
+            self._entries[key] = {
+                'key': key,
+                'filename': os.path.basename(artifact_path),
+                'size': size,
+                'payload': payload,
+                'lastUsed': time.time(),
+            }
+            self._entries.move_to_end(key)
+            self._evict()
+
+    def _evict(self):
+        total = self.total_bytes()
+        while total > self.max_bytes and self._entries:
+            _, entry = self._entries.popitem(last=False)
+            total -= entry['size']
+            path = os.path.join(self.folder, entry['filename'])
+            try:
+                if os.path.exists(path):
+                    os.remove(path)
+                logging.info(f"Evicted cached result {entry['filename']} ({entry['size']} bytes)")
+            except OSError as e:
+                logging.error(f"Error evicting cached result {path}: {str(e)}")
+
+    def stats(self):
+        with self._lock:
+            self._load()
+            return {
+                'entries': len(self._entries),
+                'bytes': self.total_bytes(),
+                'maxBytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+            }
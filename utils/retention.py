@@ -0,0 +1,233 @@
+import os
+import json
+import time
+import fcntl
+import logging
+import threading
+from contextlib import contextmanager
+from utils.jobs import QUEUED, RUNNING
+
+
+class RetentionManager:
+    """
+    Keep the upload folder within a time-to-live and a total size quota.
+
+    Every file in folder is an artifact with a size, a creation time and the
+    time it was last downloaded. A sweep removes artifacts not used for
+    ttl_seconds, then removes the least recently used ones until the folder
+    fits in max_bytes. Files younger than grace_seconds are never evicted for
+    quota reasons, so in-flight conversions keep their inputs, and the
+    inputs of jobs still queued or running in jobs_dir are never evicted.
+    Dot files (job state, cache and retention indexes) are left alone.
+
+    The folder itself is the source of truth: each sweep rescans it, so
+    artifacts written by job worker processes or earlier runs are picked up.
+    Creation and download times are persisted in an index file next to the
+    artifacts, updated under a file lock shared by every process.
+    """
+
+    def __init__(self, folder, ttl_seconds, max_bytes, sweep_interval=300, grace_seconds=600,
+                 index_name='.retention.json', jobs_dir=None):
+        self.folder = folder
+        self.jobs_dir = jobs_dir
+        self.ttl_seconds = ttl_seconds
+        self.max_bytes = max_bytes
+        self.sweep_interval = sweep_interval
+        self.grace_seconds = grace_seconds
+        self.index_path = os.path.join(folder, index_name)
+        self._artifacts = {}
+        self._lock = threading.Lock()
+        self._thread = None
+        self._thread_pid = None
+        self.evicted_files = 0
+        self.evicted_bytes = 0
+        self.last_sweep = None
+        self._load()
+
+    @classmethod
+    def from_env(cls, folder, jobs_dir=None):
+        """
+        Build a manager configured from NISQ_RETENTION_HOURS, NISQ_UPLOAD_QUOTA_MB
+        and NISQ_SWEEP_SECONDS.
+        """
+        ttl_hours = float(os.environ.get('NISQ_RETENTION_HOURS', 24))
+        quota_mb = float(os.environ.get('NISQ_UPLOAD_QUOTA_MB', 1024))
+        sweep_seconds = float(os.environ.get('NISQ_SWEEP_SECONDS', 300))
+        return cls(folder, ttl_hours * 3600, int(quota_mb * 1024 * 1024), sweep_seconds, jobs_dir=jobs_dir)
+
+    def _load(self):
+        try:
+            with open(self.index_path) as f:
+                self._artifacts = json.load(f)
+        except (OSError, ValueError):
+            self._artifacts = {}
+
+    def _save(self):
+        temp_path = f"{self.index_path}.{os.getpid()}.tmp"
+        try:
+            with open(temp_path, 'w') as f:
+                json.dump(self._artifacts, f)
+            os.replace(temp_path, self.index_path)
+        except OSError as e:
+            logging.error(f"Could not save retention index: {str(e)}")
+
+    @contextmanager
+    def _index_locked(self):
+        """
+        Read-modify-write the index: hold this process's lock and the file
+        lock, reload the index on entry and save it on exit.
+        """
+        with self._lock, open(self.index_path + '.lock', 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            self._load()
+            yield
+            self._save()
+
+    def _record(self, name, size, created_at):
+        record = self._artifacts.get(name)
+        if record is None:
+            record = {'createdAt': created_at, 'lastDownload': None}
+            self._artifacts[name] = record
+        record['size'] = size
+        return record
+
+    def track(self, path):
+        """Start tracking a newly written artifact."""
+        try:
+            size = os.path.getsize(path)
+        except OSError:
+            return
+        with self._index_locked():
+            self._record(os.path.basename(path), size, time.time())
+
+    def touch(self, filename):
+        """
+        Record a download of an artifact. Returns False when the artifact is
+        gone; the check runs under the index lock so a sweep cannot remove it
+        between the check and the touch.
+        """
+        with self._index_locked():
+            try:
+                stat = os.stat(os.path.join(self.folder, filename))
+            except OSError:
+                self._artifacts.pop(filename, None)
+                return False
+            record = self._artifacts.get(filename) or self._record(filename, stat.st_size, stat.st_mtime)
+            record['lastDownload'] = time.time()
+            return True
+
+    @staticmethod
+    def last_used(record):
+        return max(record['createdAt'], record['lastDownload'] or 0)
+
+    def _scan(self):
+        """Sync the index with the files actually in the folder."""
+        seen = set()
+        with os.scandir(self.folder) as entries:
+            for entry in entries:
+                if entry.name.startswith('.') or not entry.is_file():
+                    continue
+                try:
+                    stat = entry.stat()
+                except OSError:
+                    continue
+                seen.add(entry.name)
+                self._record(entry.name, stat.st_size, stat.st_mtime)
+        for name in list(self._artifacts):
+            if name not in seen:
+                del self._artifacts[name]
+
+    def _job_inputs(self):
+        """Names of the files in folder that queued or running jobs will read."""
+        names = set()
+        if not self.jobs_dir:
+            return names
+        folder = os.path.abspath(self.folder)
+        try:
+            job_files = os.listdir(self.jobs_dir)
+        except OSError:
+            return names
+        for job_file in job_files:
+            if not job_file.endswith('.json'):
+                continue
+            try:
+                with open(os.path.join(self.jobs_dir, job_file)) as f:
+                    record = json.load(f)
+            except (OSError, ValueError):
+                continue
+            if record.get('status') in (QUEUED, RUNNING):
+                names.update(os.path.basename(path) for path in record.get('inputs', [])
+                             if os.path.dirname(os.path.abspath(path)) == folder)
+        return names
+
+    def _remove(self, name):
+        record = self._artifacts.pop(name)
+        try:
+            os.remove(os.path.join(self.folder, name))
+        except FileNotFoundError:
+            return
+        except OSError as e:
+            logging.error(f"Error removing expired file {name}: {str(e)}")
+            return
+        self.evicted_files += 1
+        self.evicted_bytes += record['size']
+        logging.info(f"Retention removed {name} ({record['size']} bytes)")
+
+    def sweep(self):
+        """Evict expired artifacts, then least recently used ones over the quota."""
+        now = time.time()
+        with self._index_locked():
+            self._scan()
+            in_use = self._job_inputs()
+
+            for name, record in list(self._artifacts.items()):
+                if now - self.last_used(record) > self.ttl_seconds and name not in in_use:
+                    self._remove(name)
+
+            total = sum(record['size'] for record in self._artifacts.values())
+            if total > self.max_bytes:
+                candidates = sorted(
+                    (name for name, record in self._artifacts.items()
+                     if now - record['createdAt'] > self.grace_seconds and name not in in_use),
+                    key=lambda name: self.last_used(self._artifacts[name])
+                )
+                for name in candidates:
+                    if total <= self.max_bytes:
+                        break
+                    total -= self._artifacts[name]['size']
+                    self._remove(name)
+
+            self.last_sweep = now
+
+    def _run(self):
+        while True:
+            try:
+                self.sweep()
+            except Exception as e:
+                logging.error(f"Retention sweep failed: {str(e)}")
+            time.sleep(self.sweep_interval)
+
+    def ensure_started(self):
+        """Start the background sweeper in this process if it is not running yet."""
+        # Threads do not survive a fork, so track the owning process
+        if self._thread_pid == os.getpid() and self._thread.is_alive():
+            return
+        with self._lock:
+            if self._thread_pid == os.getpid() and self._thread.is_alive():
+                return
+            self._thread = threading.Thread(target=self._run, name='retention-sweeper', daemon=True)
+            self._thread_pid = os.getpid()
+            self._thread.start()
+
+    def stats(self):
+        with self._lock:
+            return {
+                'files': len(self._artifacts),
+                'bytes': sum(record['size'] for record in self._artifacts.values()),
+                'maxBytes': self.max_bytes,
+                'ttlSeconds': self.ttl_seconds,
+                'sweepInterval': self.sweep_interval,
+                'lastSweep': self.last_sweep,
+                'evictedFiles': self.evicted_files,
+                'evictedBytes': self.evicted_bytes,
+            }
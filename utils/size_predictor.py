@@ -0,0 +1,242 @@
+import math
+import logging
+from utils.image_utils import QUALITY_FORMATS, encode_image, solve_target_size
+from utils.lazy_imports import lazy_import
+
+Image = lazy_import('PIL.Image')
+
+# Qualities the sample tiles are encoded at to fit the size model
+SAMPLE_QUALITIES = (90, 70, 50, 30, 15)
+
+# Size and number of tiles cut from an image for sampling
+TILE_SIZE = 256
+TILE_COUNT = 6
+
+# A first guess this far under the target gets a corrective pass upwards
+UNDERSHOOT = 0.85
+
+# The corrective pass aims this far below the target to absorb model error;
+# bisection stops once a fit is this close
+CORRECTION_MARGIN = 0.97
+
+# Bisection steps after the model's guesses, and the smallest scale step
+MAX_BISECT_PASSES = 8
+SCALE_TOLERANCE = 0.01
+
+
+def sample_mosaic(img, tile_size=TILE_SIZE, count=TILE_COUNT):
+    """
+    Cut count tiles spread evenly across an image and paste them into one
+    mosaic, so the sample is encoded with a single set of headers.
+    Small images are returned whole.
+    """
+    columns = max(1, int(math.sqrt(count)))
+    rows = max(1, math.ceil(count / columns))
+    if img.width <= tile_size * columns * 2 or img.height <= tile_size * rows * 2:
+        return img
+
+    mosaic = Image.new(img.mode, (tile_size * columns, tile_size * rows))
+    for row in range(rows):
+        for column in range(columns):
+            left = int((img.width - tile_size) * (column + 0.5) / columns)
+            top = int((img.height - tile_size) * (row + 0.5) / rows)
+            tile = img.crop((left, top, left + tile_size, top + tile_size))
+            mosaic.paste(tile, (column * tile_size, row * tile_size))
+    return mosaic
+
+
+def log_interpolate(points, x):
+    """
+    Piecewise-linear interpolation of log(size) over a setting.
+    points is a list of (setting, size) sorted by setting; the end
+    segments are extended for values outside the sampled range.
+    """
+    if len(points) == 1:
+        return points[0][1]
+    for i in range(len(points) - 1):
+        (x0, y0), (x1, y1) = points[i], points[i + 1]
+        if x <= x1 or i == len(points) - 2:
+            t = (x - x0) / (x1 - x0)
+            return math.exp(math.log(y0) + t * (math.log(y1) - math.log(y0)))
+
+
+def fit_image_model(img, fmt):
+    """
+    Encode a sample mosaic of an image and scale the result up to the whole image.
+    Returns a function predicting the encoded size for (quality, scale).
+    """
+    sample = sample_mosaic(img)
+    sample_pixels = sample.width * sample.height
+    image_pixels = img.width * img.height
+    blank = Image.new(img.mode, (8, 8))
+    qualities = SAMPLE_QUALITIES if fmt in QUALITY_FORMATS else (None,)
+
+    # Pixel data cost per quality, and the fixed cost of headers and tables
+    points = []
+    overheads = []
+    for quality in qualities:
+        overhead = len(encode_image(blank, fmt, quality=quality))
+        sample_bytes = max(1, len(encode_image(sample, fmt, quality=quality)) - overhead)
+        points.append((quality or 0, sample_bytes / sample_pixels))
+        overheads.append((quality or 0, overhead))
+    points.sort()
+    overheads.sort()
+
+    def predict(quality, scale=1.0):
+        bytes_per_pixel = log_interpolate(points, quality or 0)
+        overhead = log_interpolate(overheads, quality or 0)
+        return int(bytes_per_pixel * image_pixels * scale * scale + overhead)
+
+    return predict
+
+
+def choose_image_setting(predict, target_bytes, min_quality, max_quality, lossy, correction=1.0):
+    """Best (quality, scale) whose corrected prediction fits target_bytes."""
+    if lossy:
+        for quality in range(max_quality, min_quality - 1, -1):
+            if predict(quality) * correction <= target_bytes:
+                return quality, 1.0
+        quality = min_quality
+    else:
+        quality = None
+        if predict(None) * correction <= target_bytes:
+            return quality, 1.0
+
+    # Size grows with the pixel count, i.e. the square of the scale
+    full_size = predict(quality) * correction
+    scale = math.sqrt(target_bytes / max(full_size, 1))
+    return quality, min(1.0, scale * 0.98)
+
+
+def ladder_position(quality, scale, min_quality, max_quality):
+    """
+    Place a (quality, scale) setting on one axis the encoded size grows
+    along: scales below 1.0 (at min_quality) map to the scale itself,
+    qualities at full scale to 1.0..2.0.
+    """
+    if scale < 1.0:
+        return scale
+    return 1.0 + (quality - min_quality) / max(1, max_quality - min_quality)
+
+
+def ladder_setting(position, min_quality, max_quality):
+    """The (quality, scale) setting at a ladder position."""
+    if position < 1.0:
+        return min_quality, position
+    return round(min_quality + (position - 1.0) * (max_quality - min_quality)), 1.0
+
+
+def predict_target_size(img, fmt, target_bytes, min_quality=10, max_quality=95, min_scale=0.1):
+    """
+    Encode an image to fit target_bytes using a sampled size model.
+
+    A mosaic of tiles is encoded at several qualities to fit a size-vs-quality
+    model, the predicted setting is encoded once, and at most one
+    corrective pass (with the model rescaled by the observed error) follows.
+    If that still leaves no fit, or a fit far under the target, the setting
+    is bisected between the encodes measured so far. Formats without a
+    quality setting go straight to the bisection solver.
+
+    Returns the same dict as solve_target_size plus the 'predictedSize'
+    of the first guess (None when no model was used).
+    """
+    if fmt not in QUALITY_FORMATS:
+        # Lossless sizes barely follow a sampled model; every guess was a miss
+        result = solve_target_size(img, fmt, target_bytes, min_quality, max_quality, min_scale)
+        result['predictedSize'] = None
+        return result
+
+    if fmt == 'JPEG' and img.mode not in ('RGB', 'L'):
+        img = img.convert('RGB')
+
+    attempts = []
+
+    def attempt(quality, scale):
+        data = encode_image(img, fmt, quality=quality, scale=scale)
+        result = {'data': data, 'quality': quality, 'scale': scale, 'size': len(data)}
+        attempts.append(result)
+        return result
+
+    def best_fit():
+        fits = [a for a in attempts if a['size'] <= target_bytes]
+        return max(fits, key=lambda a: a['size']) if fits else None
+
+    def position(result):
+        return ladder_position(result['quality'], result['scale'], min_quality, max_quality)
+
+    predict = fit_image_model(img, fmt)
+    quality, scale = choose_image_setting(predict, target_bytes, min_quality, max_quality, True)
+    scale = max(scale, min_scale)
+    predicted_size = int(predict(quality, scale))
+    first = attempt(quality, scale)
+
+    # One corrective pass if we overshot, or undershot by a lot with room to improve
+    can_improve = quality < max_quality or scale < 1.0
+    if first['size'] > target_bytes or (first['size'] < target_bytes * UNDERSHOOT and can_improve):
+        correction = first['size'] / max(predict(quality, scale), 1)
+        new_quality, new_scale = choose_image_setting(predict, target_bytes * CORRECTION_MARGIN,
+                                                      min_quality, max_quality, True, correction)
+        new_scale = max(new_scale, min_scale)
+        if (new_quality, new_scale) != (quality, scale):
+            attempt(new_quality, new_scale)
+
+    best = best_fit()
+    if best is None or (best['size'] < target_bytes * UNDERSHOOT and position(best) < 2.0):
+        if best is None:
+            logging.info("Size prediction missed the target, bisecting")
+        best = bisect_ladder(attempt, attempts, target_bytes, min_quality, max_quality, min_scale)
+
+    if best is None:
+        # The smallest setting allowed was tried and is still too big
+        smallest = min(attempts, key=lambda a: a['size'])
+        result = dict(smallest, fits=False, passes=len(attempts))
+    else:
+        result = dict(best, fits=True, passes=len(attempts))
+    result['predictedSize'] = predicted_size
+    return result
+
+
+def bisect_ladder(attempt, attempts, target_bytes, min_quality, max_quality, min_scale):
+    """
+    Bisect the setting ladder between the largest measured encode that fits
+    and the smallest one that does not, encoding with attempt. The ends are
+    measured first when no encode brackets them. Returns the best fitting
+    attempt, or None if even the smallest setting is too big.
+    """
+    def position(result):
+        return ladder_position(result['quality'], result['scale'], min_quality, max_quality)
+
+    fits = [a for a in attempts if a['size'] <= target_bytes]
+    over = [a for a in attempts if a['size'] > target_bytes]
+    best = max(fits, key=lambda a: a['size']) if fits else None
+
+    if best is None:
+        result = attempt(min_quality, min_scale)
+        if result['size'] > target_bytes:
+            return None
+        best = result
+    low = position(best)
+
+    if over:
+        high = min(position(a) for a in over)
+    else:
+        result = attempt(max_quality, 1.0)
+        if result['size'] <= target_bytes:
+            return result
+        high = 2.0
+
+    for _ in range(MAX_BISECT_PASSES):
+        if best['size'] >= target_bytes * CORRECTION_MARGIN or high - low < SCALE_TOLERANCE:
+            break
+        quality, scale = ladder_setting((low + high) / 2, min_quality, max_quality)
+        setting = (quality, scale)
+        if setting in (ladder_setting(low, min_quality, max_quality), ladder_setting(high, min_quality, max_quality)):
+            break  # adjacent qualities, nothing left in between
+        result = attempt(quality, scale)
+        if result['size'] <= target_bytes:
+            low = position(result)
+            if result['size'] > best['size']:
+                best = result
+        else:
+            high = position(result)
+    return best
@@ -0,0 +1,127 @@
+import os
+import uuid
+import hashlib
+import logging
+from flask import Request, current_app
+from werkzeug.exceptions import RequestEntityTooLarge, UnsupportedMediaType
+
+# Leading bytes each file type starts with; types not listed are not sniffed
+MAGIC_SIGNATURES = {
+    'pdf': (b'%PDF-',),
+    'jpg': (b'\xff\xd8\xff',),
+    'jpeg': (b'\xff\xd8\xff',),
+    'png': (b'\x89PNG\r\n\x1a\n',),
+    'gif': (b'GIF87a', b'GIF89a'),
+    'bmp': (b'BM',),
+    'tiff': (b'II*\x00', b'MM\x00*'),
+    'doc': (b'\xd0\xcf\x11\xe0\xa1\xb1\x1a\xe1',),
+    'docx': (b'PK\x03\x04',),
+    'xlsx': (b'PK\x03\x04',),
+    'pptx': (b'PK\x03\x04',),
+    'zip': (b'PK\x03\x04', b'PK\x05\x06'),
+    'rar': (b'Rar!\x1a\x07',),
+}
+
+# Enough leading bytes to check every signature
+SNIFF_BYTES = max(len(magic) for magics in MAGIC_SIGNATURES.values() for magic in magics)
+
+# Prefix of the partial upload files; dot files are skipped by retention
+PARTIAL_PREFIX = '.upload-'
+
+
+def magic_matches(extension, head):
+    """Whether head (the first bytes of a file) fits what extension promises."""
+    magics = MAGIC_SIGNATURES.get(extension.lower())
+    if magics is None:
+        return True
+    return any(head.startswith(magic) for magic in magics)
+
+
+class IngestFile:
+    """
+    Write target for one uploaded file while the request body is parsed.
+
+    Chunks go straight to a partial file in folder as they arrive, are
+    hashed with SHA-256 and counted, and the first bytes are checked
+    against the signature of the file's extension. A type mismatch raises
+    415 and a file over max_bytes raises 413 while the upload is still
+    streaming. claim() moves the finished file into place; unclaimed
+    partial files are removed on close().
+    """
+
+    def __init__(self, folder, filename, max_bytes=None):
+        self.filename = filename or ''
+        self.extension = self.filename.rsplit('.', 1)[1] if '.' in self.filename else ''
+        self.max_bytes = max_bytes
+        self.path = os.path.join(folder, f"{PARTIAL_PREFIX}{uuid.uuid4().hex}.part")
+        self.size = 0
+        self._digest = hashlib.sha256()
+        self._head = b''
+        self._sniffed = False
+        self._file = open(self.path, 'w+b')
+
+    def _sniff(self):
+        self._sniffed = True
+        if not magic_matches(self.extension, self._head):
+            logging.warning(f"Rejected upload {self.filename}: content does not look like .{self.extension}")
+            raise UnsupportedMediaType(f"File content does not match the .{self.extension} extension")
+
+    def write(self, data):
+        self.size += len(data)
+        if self.max_bytes is not None and self.size > self.max_bytes:
+            logging.warning(f"Rejected upload {self.filename}: larger than {self.max_bytes} bytes")
+            raise RequestEntityTooLarge(f"File is larger than {self.max_bytes / (1024 * 1024):.1f} MB")
+
+        if not self._sniffed:
+            self._head += data[:SNIFF_BYTES - len(self._head)]
+            if len(self._head) >= SNIFF_BYTES:
+                self._sniff()
+
+        self._digest.update(data)
+        return self._file.write(data)
+
+    def seek(self, offset, whence=0):
+        # The parser rewinds the file once it has been fully received
+        if not self._sniffed:
+            self._sniff()
+        return self._file.seek(offset, whence)
+
+    def hexdigest(self):
+        return self._digest.hexdigest()
+
+    def claim(self, destination_path):
+        """Move the received file to destination_path; returns its SHA-256 digest."""
+        self._file.close()
+        os.replace(self.path, destination_path)
+        self.path = None
+        return self.hexdigest()
+
+    def close(self):
+        if not self._file.closed:
+            self._file.close()
+        if self.path and os.path.exists(self.path):
+            os.remove(self.path)
+            self.path = None
+
+    def __getattr__(self, name):
+        return getattr(self._file, name)
+
+
+class IngestRequest(Request):
+    """
+    Request that streams file uploads to the upload folder through
+    IngestFile instead of spooling them in memory or a temp directory.
+    The per-file limit is read from the app's MAX_FILE_SIZE setting.
+    """
+
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        ingest_file = IngestFile(current_app.config['UPLOAD_FOLDER'], filename,
+                                 current_app.config.get('MAX_FILE_SIZE'))
+        self.__dict__.setdefault('_ingest_files', []).append(ingest_file)
+        return ingest_file
+
+    def close(self):
+        super().close()
+        # Also covers files left behind by a body rejected half way through
+        for ingest_file in self.__dict__.get('_ingest_files', ()):
+            ingest_file.close()
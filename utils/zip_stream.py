@@ -0,0 +1,51 @@
+import time
+import zipfile
+
+# Payloads that are already compressed and gain nothing from deflate
+STORED_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.webp', '.gif', '.zip', '.docx', '.xlsx', '.pptx')
+
+
+class _ChunkSink:
+    """Write-only file object that collects whatever zipfile writes to it."""
+
+    def __init__(self):
+        self._chunks = []
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        data = b''.join(self._chunks)
+        self._chunks = []
+        return data
+
+
+def stream_zip(entries):
+    """
+    Build a ZIP archive on the fly from (name, data) pairs.
+
+    Yields the archive bytes piece by piece as each entry is added, so it can
+    be sent as a chunked response without ever existing as a whole in memory
+    or on disk. Already-compressed payloads are stored rather than deflated.
+    """
+    sink = _ChunkSink()
+    # zipfile falls back to data descriptors because the sink is not seekable
+    with zipfile.ZipFile(sink, 'w') as zip_file:
+        for name, data in entries:
+            info = zipfile.ZipInfo(name, date_time=time.localtime()[:6])
+            info.external_attr = 0o644 << 16
+            if name.lower().endswith(STORED_EXTENSIONS):
+                info.compress_type = zipfile.ZIP_STORED
+            else:
+                info.compress_type = zipfile.ZIP_DEFLATED
+            zip_file.writestr(info, data)
+            chunk = sink.drain()
+            if chunk:
+                yield chunk
+    chunk = sink.drain()
+    if chunk:
+        yield chunk